@@ -0,0 +1,121 @@
+"""
+Synthetic books_data.csv and Books_rating.csv with the columns of the Kaggle dataset, at any size.
+Titles are reviewed with a Zipf skew, review texts have a log-normal length, publishing dates spread
+over two centuries with a bump around the 90s and 2000s, and categories follow a fixed mix, so that
+every query of the system has results.
+
+    python -m benchmarks.datasets --books 10000 --reviews 100000 --output-dir .data/synthetic
+"""
+from argparse import ArgumentParser
+from bisect import bisect
+from csv import writer
+from itertools import accumulate
+import os
+import random
+
+BOOK_HEADERS = ['Title', 'description', 'authors', 'image', 'previewLink', 'publisher', 'publishedDate', 'infoLink', 'categories', 'ratingsCount']
+REVIEW_HEADERS = ['Id', 'Title', 'Price', 'User_id', 'profileName', 'review/helpfulness', 'review/score', 'review/time', 'review/summary', 'review/text']
+BOOKS_FILE = 'books_data.csv'
+REVIEWS_FILE = 'Books_rating.csv'
+
+CATEGORIES = [
+    ("['Fiction']", 0.25), ("['Juvenile Fiction']", 0.1), ("['Young adult fiction']", 0.05), ("['Computers']", 0.1),
+    ("['History']", 0.15), ("['Religion']", 0.1), ("['Biography & Autobiography']", 0.1), ('', 0.15),
+]
+DECADE_WEIGHTS = {**{decade: 1 for decade in range(1800, 1960, 10)}, 1960: 2, 1970: 3, 1980: 5, 1990: 10, 2000: 14, 2010: 8, 2020: 1}
+TITLE_WORDS = ['distributed', 'systems', 'the', 'night', 'garden', 'river', 'history', 'of', 'love', 'war', 'code',
+               'a', 'computing', 'secret', 'city', 'guide', 'house', 'dark', 'modern', 'life', 'stars', 'cloud']
+TEXT_WORDS = ['book', 'story', 'read', 'great', 'characters', 'author', '"really"', 'plot', 'pages', 'ending',
+              'good,', 'bad', 'loved', 'boring', 'recommend', 'not', 'wonderful', 'terrible', 'classic', 'again']
+PROLIFIC_AUTHORS = 50
+ZIPF_EXPONENT = 1.1
+REVIEW_LENGTH_MU = 4
+REVIEW_LENGTH_SIGMA = 1
+
+
+class Sampler:
+    "Picks values with the given weights in O(log n), random.choices recomputes the cumulative weights on every call."
+    def __init__(self, values, weights, rng):
+        self.values = values
+        self.cumulative = list(accumulate(weights))
+        self.rng = rng
+
+    def sample(self):
+        return self.values[bisect(self.cumulative, self.rng.random() * self.cumulative[-1])]
+
+
+def published_date(rng, decades):
+    year = decades.sample() + rng.randrange(10)
+    style = rng.random()
+    if style < 0.5:
+        return str(year)
+    if style < 0.8:
+        return f'{year}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}'
+    if style < 0.95:
+        return f'{year}-{rng.randrange(1, 13):02d}'
+    return ''
+
+
+def book_rows(count, rng):
+    "Yields the rows of `count` books with unique titles."
+    decades = Sampler(list(DECADE_WEIGHTS), list(DECADE_WEIGHTS.values()), rng)
+    categories = Sampler(*zip(*CATEGORIES), rng)
+    for book_id in range(count):
+        title = ' '.join(rng.choice(TITLE_WORDS) for _ in range(rng.randrange(1, 6))).capitalize() + f' {book_id}'
+        if rng.random() < 0.2:
+            # Prolific authors publish in every decade, so some of them make it to the authors query.
+            authors = [f'Author {rng.randrange(PROLIFIC_AUTHORS)}']
+        else:
+            authors = [f'Author {rng.randrange(PROLIFIC_AUTHORS, count + PROLIFIC_AUTHORS)}' for _ in range(rng.randrange(1, 3))]
+        yield [title, f'About {title.lower()}.', str(authors), '', '', 'Some Publisher', published_date(rng, decades),
+               '', categories.sample(), str(rng.randrange(100))]
+
+
+def review_rows(count, titles, rng):
+    "Yields the rows of `count` reviews, the first titles are the most reviewed ones."
+    title_sampler = Sampler(titles, [1 / rank ** ZIPF_EXPONENT for rank in range(1, len(titles) + 1)], rng)
+    for _ in range(count):
+        words = int(rng.lognormvariate(REVIEW_LENGTH_MU, REVIEW_LENGTH_SIGMA)) + 1
+        text = ' '.join(rng.choice(TEXT_WORDS) for _ in range(words))
+        if rng.random() < 0.05:
+            text = text.replace(' ', '\n', 2)
+        yield [rng.randrange(10**9), title_sampler.sample(), '', f'A{rng.randrange(10**12)}', 'Some Reader', '2/3',
+               f'{rng.randrange(1, 6)}.0', str(rng.randrange(10**9)), ' '.join(rng.choices(TEXT_WORDS, k=4)), text]
+
+
+def generate(output_dir, books, reviews, seed=0):
+    "Writes both files to `output_dir` and returns their paths."
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    books_path = os.path.join(output_dir, BOOKS_FILE)
+    reviews_path = os.path.join(output_dir, REVIEWS_FILE)
+    titles = []
+    with open(books_path, 'w', newline='') as f:
+        csv_writer = writer(f)
+        csv_writer.writerow(BOOK_HEADERS)
+        for row in book_rows(books, rng):
+            titles.append(row[0])
+            csv_writer.writerow(row)
+    # The popularity of a title doesn't depend on when it was published.
+    rng.shuffle(titles)
+    with open(reviews_path, 'w', newline='') as f:
+        csv_writer = writer(f)
+        csv_writer.writerow(REVIEW_HEADERS)
+        csv_writer.writerows(review_rows(reviews, titles, rng))
+    return books_path, reviews_path
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--reviews', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-dir', default='.data/synthetic')
+    args = parser.parse_args()
+
+    for path in generate(args.output_dir, args.books, args.reviews, args.seed):
+        print(f'{path}: {os.path.getsize(path)} bytes')
+
+
+if __name__ == '__main__':
+    main()
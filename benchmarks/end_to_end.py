@@ -0,0 +1,263 @@
+"""
+End-to-end benchmark: N clients upload the same books and reviews files through the gateway publishers,
+every worker of workers/ processes them and the results are saved and cut into the query files the gateway
+sends back to each client. Everything runs in this process on lib.memory_broker, so the numbers measure the
+CPU cost of the whole pipeline rather than the network or RabbitMQ.
+The clients are driven straight through the gateway's publishers and result receiver, not through Gateway or
+AsyncGateway: the socket, the framing and compression of lib.transfer, the credit window and the gateway's client
+loops are left out (benchmarks.gateway_parsing covers parsing the batches). The time to the first result is when
+the gateway saves it, not when a client would receive it.
+The report is JSON with sorted keys, meant to be saved and diffed between commits.
+
+    python -m benchmarks.end_to_end [--clients 2] [--books 10000 --reviews 100000 | --data-dir .data] [--output report.json]
+"""
+from argparse import ArgumentParser
+from csv import reader
+from statistics import median
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from time import perf_counter
+from uuid import UUID
+import json
+import logging
+import os
+import sys
+
+from benchmarks.stages import CAPTURE_SUFFIX, ROOT, WORKERS_DIR, current_commit, load_worker
+
+# The gateway and the client import their own modules as top-level ones, like in their images.
+sys.path[:0] = [os.path.join(ROOT, 'gateway'), os.path.join(ROOT, 'client')]
+
+from pika.exchange_type import ExchangeType
+from batches import column_indices, cut_batches, project_batch, read_header
+from data_storage import ALL_ROWS, DataSaver
+from gateway import ResultStream, save_result, source_mapping
+from lib.codec import decode
+from lib.gateway import BookPublisher, ResultReceiver, ReviewPublisher
+from lib.memory_broker import InMemoryBroker, MemoryServer
+from lib.schema import PROJECTIONS
+from lib.workers.records import BATCH_LAYOUT, COLUMNS, ROWS
+from lib.transfer.transfer_protocol import MESSAGE_FLAG
+from benchmarks.datasets import BOOKS_FILE, REVIEWS_FILE, generate
+
+BATCH_BYTES = 1024 * 1024
+WINDOW = 16
+EOF_BATCH = b'type\nEOF'
+
+
+class CapturingBroker(InMemoryBroker):
+    "Saves every message delivered to the worker using it, one per line, for benchmarks.stages --capture-dir."
+    def __init__(self, server, state_dir, capture_path):
+        self.capture = open(capture_path, 'wb')
+        super().__init__(server, state_dir)
+
+    def deliver(self, callback, exchange_name, routing_key, body, content_type=None):
+        # Saved as JSON whatever the codec, one message per line.
+        message = decode(body, SimpleNamespace(content_type=content_type))
+        self.capture.write(json.dumps(message).encode('utf-8') + b'\n')
+        super().deliver(callback, exchange_name, routing_key, body, content_type)
+
+    def close_connection(self):
+        self.capture.close()
+
+
+def build_pipeline(server, state_dir, capture_dir=None):
+    """
+    Builds every worker on its own connection to `server`, each one saving its state to a directory of its own.
+    With a `capture_dir` the messages each worker receives are saved there, to a file named after it.
+    """
+    if capture_dir:
+        os.makedirs(capture_dir, exist_ok=True)
+    workers = []
+    for name in sorted(os.listdir(WORKERS_DIR)):
+        if not os.path.isfile(os.path.join(WORKERS_DIR, name, 'main.py')):
+            continue
+        if capture_dir:
+            connection = CapturingBroker(server, os.path.join(state_dir, name), os.path.join(capture_dir, name + CAPTURE_SUFFIX))
+        else:
+            connection = InMemoryBroker(server, os.path.join(state_dir, name))
+        worker = load_worker(name).build_worker(connection)
+        if not hasattr(worker, 'peer_agora'):
+            # Workers with peers start consuming once they have announced themselves, the rest on start().
+            connection.set_consumer(worker.src_queue, worker.callback)
+        workers.append(worker)
+    return workers
+
+
+def file_batches(path, source, batch_bytes):
+    "Yields the batches of a file the way the client cuts and projects them, ending with the EOF."
+    with open(path, 'rb') as f:
+        data = f.read()
+    header = read_header(data)
+    indices = column_indices(header, PROJECTIONS[source])
+    projected_header = project_batch(header, indices)
+    for _offset, batch in cut_batches(data, len(header), batch_bytes):
+        yield source, projected_header + project_batch(batch, indices)
+    yield source, EOF_BATCH
+
+
+def count_rows(path):
+    with open(path, 'r', newline='') as f:
+        return sum(1 for _ in reader(f)) - 1
+
+
+class BenchmarkClient:
+    "Upload and download progress of a single client, with the time each result arrived."
+    def __init__(self, client_id, books_path, reviews_path, batch_bytes):
+        self.client_id = client_id
+        self.batches = self.__batches(books_path, reviews_path, batch_bytes)
+        self.message_id = 0
+        self.uploaded = False
+        self.first_result = None
+        self.finished_queries = {}
+
+    def __batches(self, books_path, reviews_path, batch_bytes):
+        # Books go first, the barriers release the reviews only once every book is in.
+        yield from file_batches(books_path, MESSAGE_FLAG['BOOK'], batch_bytes)
+        yield from file_batches(reviews_path, MESSAGE_FLAG['REVIEW'], batch_bytes)
+
+    def next_batch(self):
+        batch = next(self.batches, None)
+        if batch is None:
+            self.uploaded = True
+            return None
+        self.message_id += 1
+        source, message = batch
+        return source, self.message_id, message.decode('utf-8')
+
+    def result_received(self, queue_name, message, elapsed):
+        if self.first_result is None:
+            self.first_result = elapsed
+        if isinstance(message, dict) and message.get('type') == 'EOF':
+            self.finished_queries[queue_name] = elapsed
+
+
+def callback_result_benchmark(self, ch, method, properties, body, queue_name, callback_arg1, callback_arg2: DataSaver):
+    "Saves the result like the gateway does, and tells the client it belongs to when it arrived."
+    request_id = save_result(body, queue_name, callback_arg2, properties)
+    clients, start = callback_arg1
+    clients[request_id].result_received(queue_name, decode(body, properties), perf_counter() - start)
+    self.connection.acknowledge_message(method.delivery_tag)
+
+
+def query_results(data_saver, client_id):
+    "Builds the query files of a client from its saved results, returns the rows of each one and if all of them finished."
+    stream = ResultStream(data_saver, client_id, {})
+    rows = {query: -1 for query in source_mapping}
+    try:
+        for _flag, _message_id, message in stream.pending_messages():
+            chunk = json.loads(message)
+            # Every file starts with the header.
+            rows[chunk['file']] += chunk['body'].count('\n')
+        return rows, stream.is_complete()
+    finally:
+        stream.close()
+
+
+def run(work_dir, books_path, reviews_path, clients=1, batch_bytes=BATCH_BYTES, window=WINDOW, capture_dir=None, layout=BATCH_LAYOUT):
+    """
+    Runs the benchmark and returns the report. Clients take turns to publish up to `window` batches,
+    after which the pipeline processes everything pending before the next turn.
+    """
+    server = MemoryServer()
+    workers = build_pipeline(server, os.path.join(work_dir, 'workers'), capture_dir)
+    # Lets the workers with peers announce themselves before anything else arrives.
+    server.run()
+
+    connection = InMemoryBroker(server)
+    data_saver = DataSaver(os.path.join(work_dir, 'records'))
+    data_saver_results = DataSaver(os.path.join(work_dir, 'results'), mode=ALL_ROWS)
+    publishers = {
+        MESSAGE_FLAG['BOOK']: (BookPublisher(connection, 'books_exchange', ExchangeType.fanout, data_saver, layout), ''),
+        MESSAGE_FLAG['REVIEW']: (ReviewPublisher(connection, data_saver, layout), 'reviews_queue'),
+    }
+    benchmark_clients = {UUID(int=client + 1): BenchmarkClient(UUID(int=client + 1), books_path, reviews_path, batch_bytes)
+                         for client in range(clients)}
+    start = perf_counter()
+    ResultReceiver(connection, list(source_mapping), callback_result_benchmark, (benchmark_clients, start), data_saver_results)
+
+    uploading = list(benchmark_clients.values())
+    while uploading:
+        for client in uploading:
+            for _ in range(window):
+                batch = client.next_batch()
+                if batch is None:
+                    break
+                source, message_id, message = batch
+                publisher, routing_key = publishers[source]
+                publisher.publish(client.client_id, message_id, message, routing_key)
+        server.run()
+        uploading = [client for client in uploading if not client.uploaded]
+    elapsed = perf_counter() - start
+    for worker in workers:
+        worker.connection.close_connection()
+
+    for client_id in benchmark_clients:
+        data_saver.release(client_id)
+    input_rows = clients * (count_rows(books_path) + count_rows(reviews_path))
+    input_bytes = clients * (os.path.getsize(books_path) + os.path.getsize(reviews_path))
+    report_clients = []
+    for client in benchmark_clients.values():
+        rows, complete = query_results(data_saver_results, client.client_id)
+        report_clients.append({
+            'complete': complete,
+            'result_rows': rows,
+            'time_to_first_result': client.first_result,
+            'query_latency': client.finished_queries,
+        })
+    first_results = [client['time_to_first_result'] for client in report_clients if client['time_to_first_result'] is not None]
+    return {
+        'clients': report_clients,
+        'input': {'rows': input_rows, 'bytes': input_bytes, 'batch_bytes': batch_bytes, 'window': window, 'layout': layout},
+        'seconds': elapsed,
+        'rows_per_second': input_rows / elapsed,
+        'bytes_per_second': input_bytes / elapsed,
+        'time_to_first_result': summary(first_results),
+        'query_latency': {query: summary([client['query_latency'][query] for client in report_clients if query in client['query_latency']])
+                          for query in source_mapping},
+    }
+
+
+def summary(values):
+    if not values:
+        return None
+    return {'min': min(values), 'p50': median(values), 'max': max(values)}
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=1)
+    parser.add_argument('--data-dir', help=f'directory with the {BOOKS_FILE} and {REVIEWS_FILE} to upload, instead of generating them')
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--reviews', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-bytes', type=int, default=BATCH_BYTES)
+    parser.add_argument('--window', type=int, default=WINDOW, help='batches each client publishes before the pipeline runs')
+    parser.add_argument('--layout', choices=[ROWS, COLUMNS], default=BATCH_LAYOUT, help='layout of the batches the gateway publishes')
+    parser.add_argument('--capture-dir', help='directory to save the messages each worker receives, for benchmarks.stages')
+    parser.add_argument('--output', help='file to write the report to, instead of stdout')
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    with TemporaryDirectory() as work_dir:
+        if args.data_dir:
+            dataset = {'data_dir': args.data_dir}
+            books_path, reviews_path = os.path.join(args.data_dir, BOOKS_FILE), os.path.join(args.data_dir, REVIEWS_FILE)
+        else:
+            dataset = {'books': args.books, 'reviews': args.reviews, 'seed': args.seed}
+            books_path, reviews_path = generate(os.path.join(work_dir, 'data'), args.books, args.reviews, args.seed)
+        report = run(work_dir, books_path, reviews_path, args.clients, args.batch_bytes, args.window, args.capture_dir, args.layout)
+    report['dataset'] = dataset
+    report['commit'] = current_commit()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Micro-benchmark of the gateway publishers' CSV parsing: csv.DictReader + json.dumps against lib.projection.
+Batches have the shape of Books_rating.csv, generated or cut from a real file with --file.
+
+    python -m benchmarks.gateway_parsing [--file data/Books_rating.csv] [--batch-bytes 1048576]
+"""
+from argparse import ArgumentParser
+from csv import DictReader, writer
+from io import StringIO
+from time import perf_counter
+import json
+import random
+
+from lib.projection import encode_batch, project_rows
+from lib.schema import PROJECTIONS
+from lib.transfer.transfer_protocol import MESSAGE_FLAG
+
+REVIEW_HEADERS = ['Id', 'Title', 'Price', 'User_id', 'profileName', 'review/helpfulness', 'review/score', 'review/time', 'review/summary', 'review/text']
+WORDS = ['book', 'story', 'read', 'great', 'characters', 'author', '"really"', 'plot', 'pages', 'ending', 'good,', 'bad']
+REQUEST_ID = '00000000-0000-0000-0000-000000000000'
+
+
+def generated_batch(batch_bytes, seed=0):
+    "A batch of synthetic reviews, some of them with quotes, commas and line breaks in their text."
+    rng = random.Random(seed)
+    output = StringIO()
+    csv_writer = writer(output, lineterminator='\n')
+    csv_writer.writerow(REVIEW_HEADERS)
+    while output.tell() < batch_bytes:
+        text = ' '.join(rng.choice(WORDS) for _ in range(int(rng.lognormvariate(4, 1)) + 1))
+        if rng.random() < 0.1:
+            text = text.replace(' ', '\n', 2)
+        csv_writer.writerow([rng.randrange(10**9), f'Title {rng.randrange(10**4)}', '', f'A{rng.randrange(10**12)}', 'Some Reader',
+                             '2/3', '4.0', str(rng.randrange(10**9)), ' '.join(rng.choices(WORDS, k=4)), text])
+    return output.getvalue()
+
+
+def file_batch(path, batch_bytes):
+    "The first records of a real file, cut at a record boundary."
+    with open(path, 'r', newline='') as f:
+        reader = DictReader(f)
+        output = StringIO()
+        csv_writer = writer(output, lineterminator='\n')
+        csv_writer.writerow(reader.fieldnames)
+        for row in reader:
+            csv_writer.writerow(row.values())
+            if output.tell() >= batch_bytes:
+                break
+    return output.getvalue()
+
+
+def dict_reader_publish(message_csv, columns):
+    "What the publishers did before lib.projection."
+    rows = []
+    for row in DictReader(StringIO(message_csv)):
+        if row.get('type') == 'EOF':
+            row = {'type': 'EOF'}
+        else:
+            row = {column: row[column] for column in columns}
+        rows.append(row)
+    return json.dumps({'request_id': REQUEST_ID, 'message_id': 1, 'items': rows})
+
+
+def projection_publish(message_csv, columns):
+    items, _eof = project_rows(message_csv, columns)
+    return encode_batch(REQUEST_ID, 1, items)
+
+
+def measure(fn, message_csv, columns, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        fn(message_csv, columns)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--file', help='Books_rating.csv to take the batch from, instead of generating it')
+    parser.add_argument('--batch-bytes', type=int, default=1024 * 1024)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    message_csv = file_batch(args.file, args.batch_bytes) if args.file else generated_batch(args.batch_bytes)
+    columns = PROJECTIONS[MESSAGE_FLAG['REVIEW']]
+
+    rows = sum(1 for _ in DictReader(StringIO(message_csv)))
+    size = len(message_csv.encode('utf-8'))
+    print(f'batch: {rows} rows, {size} bytes')
+    baseline = None
+    for name, fn in [('csv.DictReader + json.dumps', dict_reader_publish), ('lib.projection', projection_publish)]:
+        elapsed = measure(fn, message_csv, columns, args.repeat)
+        baseline = baseline or elapsed
+        print(f'{name:>28}: {elapsed * 1e9 / rows:8.0f} ns/row {size / elapsed / 1e6:8.1f} MB/s  x{baseline / elapsed:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""
+Micro-benchmark of the functions of each stage in workers/, called the way their worker class calls them
+(e.g. a Filter gets the mask of each batch, an Aggregate adds the request_id to each item) on the same batches.
+Batches are made from the books and reviews files, generated or real ones with --data-dir, or are the ones each
+worker received during an end-to-end run with --capture-dir (see benchmarks.end_to_end).
+For each stage it reports ns/row (best of --repeat runs), and from a traced run the peak of memory allocated
+while it ran and the blocks still allocated once it finished (e.g. the accumulator of an aggregate).
+The report is JSON with sorted keys, meant to be saved and diffed between commits.
+
+    python -m benchmarks.stages [--stage count_90s_revs_by_title ...] [--data-dir .data | --capture-dir capture] [--output report.json]
+"""
+from argparse import ArgumentParser
+from collections import namedtuple
+from csv import DictReader
+from importlib.util import module_from_spec, spec_from_file_location
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import json
+import logging
+import os
+import random
+import subprocess
+import tracemalloc
+
+from lib.fault_tolerance import DeltaAccumulator
+from lib.schema import ID_COLUMNS, PROJECTIONS, TITLE_ID
+from lib.workers.records import COLUMNS, ROWS, as_layout, batch_records, is_eof, record_partition, select, to_columns, to_rows, with_records
+from lib.transfer.transfer_protocol import MESSAGE_FLAG
+from benchmarks.datasets import BOOKS_FILE, REVIEWS_FILE, generate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKERS_DIR = os.path.join(ROOT, 'workers')
+CAPTURE_SUFFIX = '.jsonl'
+REQUEST_ID = '00000000-0000-0000-0000-000000000001'
+INPUT_ROWS = 20000
+BATCH_ROWS = 1000
+REPEAT = 5
+SEED = 0
+
+# Inputs of the stages, generated from the books and reviews files when there's no capture.
+BOOKS = 'books'
+REVIEWS = 'reviews'
+SCORES = 'scores'
+AVERAGES = 'averages'
+COUNTS = 'counts'
+
+Stage = namedtuple('Stage', ['worker', 'function', 'driver', 'batches'])
+
+
+def load_worker(name):
+    "Imports workers/<name>/main.py, each one under its own module name since they are all called main."
+    spec = spec_from_file_location(f'workers_{name}', os.path.join(WORKERS_DIR, name, 'main.py'))
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def item_messages(batch):
+    "The items of a batch with the request_id and message_id of the batch, as the workers build them."
+    for item in to_rows(batch_records(batch)):
+        message = {'request_id': batch['request_id'], 'message_id': batch['message_id']}
+        message.update(item)
+        yield message
+
+
+# Drivers take the stage function, its worker module, the batches and the updates of the filter state
+# (only used by the dynamic filters), and return the function that runs the stage once over every batch.
+
+def filter_driver(fn, module, batches, updates):
+    def run():
+        for batch in batches:
+            records = batch_records(batch)
+            select(records, fn(records))
+    return run
+
+
+def dynamic_filter_driver(fn, module, batches, updates):
+    state = {}
+    for update in updates:
+        state = module.update_state(state, update)
+    def run():
+        for batch in batches:
+            [message for message in item_messages(batch) if fn(state, message)]
+    return run
+
+
+def router_driver(fn, module, batches, updates):
+    route_batch = record_partition(fn)
+    def run():
+        for batch in batches:
+            route_batch(batch_records(batch))
+    return run
+
+
+def dynamic_router_driver(fn, module, batches, updates):
+    def run():
+        for batch in batches:
+            for message in item_messages(batch):
+                fn(message)
+    return run
+
+
+def map_driver(fn, module, batches, updates):
+    def run():
+        for batch in batches:
+            records = batch_records(batch)
+            as_layout([fn(item) for item in to_rows(records)], records)
+    return run
+
+
+def aggregate_driver(fn, module, batches, updates):
+    "Aggregates every batch and gets the result of each request, like an Aggregate does on the EOF."
+    def run():
+        accumulator = DeltaAccumulator({})
+        for batch in batches:
+            for message in item_messages(batch):
+                fn(message, accumulator)
+        for request_id in list(accumulator):
+            module.result({'request_id': request_id, 'type': 'EOF'}, accumulator)
+        return accumulator
+    return run
+
+
+def dynamic_aggregate_driver(fn, module, batches, updates):
+    def run():
+        accumulator = DeltaAccumulator({})
+        for batch in batches:
+            fn(batch, accumulator)
+        for request_id in list(accumulator):
+            module.result({'request_id': request_id, 'type': 'EOF'}, accumulator)
+        return accumulator
+    return run
+
+
+# Aggregates include their result function, e.g. kth_smallest runs in the result of fiction_percentile_calculator.
+STAGES = {stage.worker: stage for stage in [
+    Stage('90s_category_filter', 'filter_batch', filter_driver, BOOKS),
+    Stage('fiction_category_filter', 'filter_batch', filter_driver, BOOKS),
+    Stage('computer_books_filter', 'filter_batch', filter_driver, BOOKS),
+    Stage('90s_title_sharder', 'routing_fn', router_driver, BOOKS),
+    Stage('fiction_title_sharder', 'routing_fn', router_driver, BOOKS),
+    Stage('author_sharder', 'routing_fn', router_driver, BOOKS),
+    Stage('title_sharder', 'routing_fn', dynamic_router_driver, REVIEWS),
+    Stage('90s_title_barrier', 'aggregate', aggregate_driver, BOOKS),
+    Stage('fiction_title_barrier', 'aggregate', aggregate_driver, BOOKS),
+    Stage('author_decades_filter', 'aggregate', aggregate_driver, BOOKS),
+    Stage('90s_reviews_filter', 'filter_condition', dynamic_filter_driver, REVIEWS),
+    Stage('fiction_reviews_filter', 'filter_condition', dynamic_filter_driver, REVIEWS),
+    Stage('count_90s_revs_by_title', 'aggregate', aggregate_driver, REVIEWS),
+    Stage('90s_top10_filter', 'aggregate', aggregate_driver, COUNTS),
+    Stage('fiction_review_nlp', 'sentiment', map_driver, REVIEWS),
+    Stage('fiction_avg_nlp_by_title', 'aggregate', dynamic_aggregate_driver, SCORES),
+    Stage('fiction_percentile_calculator', 'aggregate', aggregate_driver, AVERAGES),
+    Stage('fiction_percentile_filter', 'filter_condition', dynamic_filter_driver, AVERAGES),
+]}
+
+
+def read_items(path, columns, rows):
+    with open(path, 'r', newline='') as f:
+        items = []
+        for row in DictReader(f):
+            item = {column: row[column] for column in columns}
+            # The IDs the gateway adds.
+            item.update({column: fn(row[source]) for column, (source, fn) in ID_COLUMNS.items() if source in row})
+            items.append(item)
+            if len(items) == rows:
+                break
+    return items
+
+
+def to_batches(items, batch_rows, layout=ROWS):
+    batches = [{'request_id': REQUEST_ID, 'message_id': message_id, 'items': items[i:i + batch_rows]}
+               for message_id, i in enumerate(range(0, len(items), batch_rows), start=1)]
+    if layout == COLUMNS:
+        return [with_records(batch, to_columns(batch['items'])) for batch in batches]
+    return batches
+
+
+def batch_rows_count(batch):
+    records = batch_records(batch)
+    return len(next(iter(records.values()), [])) if isinstance(records, dict) else len(records)
+
+
+def generated_inputs(books_path, reviews_path, rows, batch_rows, seed, layout=ROWS):
+    """
+    Returns the batches of each input, in the given layout, and the updates of the filter state of each dynamic filter.
+    The inputs past the reviews are made up from them, with scores that don't depend on the NLP model.
+    """
+    rng = random.Random(seed)
+    books = read_items(books_path, PROJECTIONS[MESSAGE_FLAG['BOOK']], rows)
+    reviews = read_items(reviews_path, PROJECTIONS[MESSAGE_FLAG['REVIEW']], rows)
+    titles = list(dict.fromkeys((review[TITLE_ID], review['Title']) for review in reviews))
+    averages = [{'Title': title, 'average': round(rng.uniform(-1, 1), 5)} for _title_id, title in titles]
+    inputs = {
+        BOOKS: to_batches(books, batch_rows, layout),
+        REVIEWS: to_batches(reviews, batch_rows, layout),
+        SCORES: to_batches([{TITLE_ID: review[TITLE_ID], 'Title': review['Title'], 'score': rng.uniform(-1, 1)} for review in reviews], batch_rows, layout),
+        AVERAGES: to_batches(averages, batch_rows, layout),
+        COUNTS: to_batches([{'Title': title, 'count': rng.randrange(500, 5000)} for _title_id, title in titles], batch_rows, layout),
+    }
+    # Half of the reviewed titles pass the reviews filters, the way the barriers would announce them.
+    passing_title_ids = sorted(title_id for title_id, _title in titles[::2])
+    percentile = sorted(item['average'] for item in averages)[len(averages) // 10] if averages else 0
+    updates = {
+        '90s_reviews_filter': [{'request_id': REQUEST_ID, 'title_ids': passing_title_ids}],
+        'fiction_reviews_filter': [{'request_id': REQUEST_ID, 'title_ids': passing_title_ids}],
+        'fiction_percentile_filter': [{'request_id': REQUEST_ID, 'percentile': percentile}],
+    }
+    stage_batches = {name: inputs[stage.batches] for name, stage in STAGES.items()}
+    return stage_batches, updates
+
+
+def captured_inputs(capture_dir):
+    "Returns the batches and filter state updates each worker received, skipping EOFs and control messages."
+    stage_batches, updates = {}, {}
+    for name in STAGES:
+        stage_batches[name], updates[name] = [], []
+        path = os.path.join(capture_dir, name + CAPTURE_SUFFIX)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as f:
+            for line in f:
+                message = json.loads(line)
+                if not isinstance(message, dict) or 'sender_id' in message or message.get('type') == 'EOF':
+                    continue
+                if 'items' not in message and COLUMNS not in message:
+                    updates[name].append(message)
+                elif not is_eof(message):
+                    stage_batches[name].append(message)
+    return stage_batches, updates
+
+
+def measure(run, rows, repeat, seed):
+    best = float('inf')
+    for _ in range(repeat):
+        # Some stages pick random pivots.
+        random.seed(seed)
+        start = perf_counter()
+        run()
+        best = min(best, perf_counter() - start)
+
+    random.seed(seed)
+    tracemalloc.start()
+    try:
+        result = run()
+        _current, peak = tracemalloc.get_traced_memory()
+        retained = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    finally:
+        tracemalloc.stop()
+    del result
+    return {'rows': rows, 'ns_per_row': best * 1e9 / rows if rows else None, 'peak_bytes': peak, 'retained_blocks': retained}
+
+
+def run_stages(names, stage_batches, updates, repeat=REPEAT, seed=SEED):
+    report = {}
+    for name in names:
+        stage = STAGES[name]
+        batches = stage_batches[name]
+        module = load_worker(stage.worker)
+        run = stage.driver(getattr(module, stage.function), module, batches, updates.get(name, []))
+        report[name] = measure(run, sum(batch_rows_count(batch) for batch in batches), repeat, seed)
+    return report
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--stage', action='append', choices=list(STAGES), help='stage to run, all of them by default')
+    parser.add_argument('--data-dir', help=f'directory with the {BOOKS_FILE} and {REVIEWS_FILE} to take the rows from, instead of generating them')
+    parser.add_argument('--capture-dir', help='batches received by each worker, saved by benchmarks.end_to_end --capture-dir')
+    parser.add_argument('--rows', type=int, default=INPUT_ROWS, help='rows read from each file')
+    parser.add_argument('--batch-rows', type=int, default=BATCH_ROWS)
+    parser.add_argument('--layout', choices=[ROWS, COLUMNS], default=ROWS, help='layout of the generated batches')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--output', help='file to write the report to, instead of stdout')
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    names = args.stage or list(STAGES)
+
+    with TemporaryDirectory() as work_dir:
+        if args.capture_dir:
+            inputs = {'capture_dir': args.capture_dir}
+            stage_batches, updates = captured_inputs(args.capture_dir)
+        else:
+            if args.data_dir:
+                inputs = {'data_dir': args.data_dir}
+                books_path, reviews_path = os.path.join(args.data_dir, BOOKS_FILE), os.path.join(args.data_dir, REVIEWS_FILE)
+            else:
+                inputs = {'seed': args.seed}
+                books_path, reviews_path = generate(work_dir, args.rows, args.rows, args.seed)
+            inputs.update({'rows': args.rows, 'batch_rows': args.batch_rows, 'layout': args.layout})
+            stage_batches, updates = generated_inputs(books_path, reviews_path, args.rows, args.batch_rows, args.seed, args.layout)
+    report = {'stages': run_stages(names, stage_batches, updates, args.repeat, args.seed), 'inputs': inputs, 'commit': current_commit()}
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+from array import array
+from io import StringIO
+import csv
+import logging
+import os
+import struct
+
+NEWLINE = ord('\n')
+QUOTE = b'"'
+
+
+def cut_batches(data, start, batch_bytes):
+    """
+    Yields (offset, batch) for consecutive batches of whole CSV records starting at `start`.
+    Each batch is cut at the first record boundary after `batch_bytes` bytes. A newline is only
+    a record boundary if it is outside a quoted field, which holds when the amount of quotes
+    since the previous boundary is even (escaped quotes come in pairs).
+    `data` can be any buffer with slicing and find, such as a memory mapped file.
+    """
+    size = len(data)
+    while start < size:
+        end = min(start + batch_bytes, size)
+        parts = [data[start:end]]
+        quotes = parts[0].count(QUOTE)
+        while end < size and (quotes % 2 or data[end - 1] != NEWLINE):
+            newline = data.find(b'\n', end)
+            next_end = newline + 1 if newline != -1 else size
+            parts.append(data[end:next_end])
+            quotes += parts[-1].count(QUOTE)
+            end = next_end
+        yield start, b''.join(parts) if len(parts) > 1 else parts[0]
+        start = end
+
+
+def read_header(data):
+    "Returns the first record of the file, including its line terminator."
+    for _offset, header in cut_batches(data, 0, 1):
+        return header
+    return b''
+
+
+def column_indices(header, columns):
+    "Returns the position of each of the columns in the CSV header."
+    names = next(csv.reader(StringIO(header.decode('utf-8'), newline='')))
+    return [names.index(column) for column in columns]
+
+
+def project_batch(batch, indices):
+    "Keeps only the columns at the given positions of every record in the batch."
+    output = StringIO()
+    writer = csv.writer(output, lineterminator='\n')
+    last_index = max(indices)
+    for row in csv.reader(StringIO(batch.decode('utf-8'), newline='')):
+        if not row:
+            continue
+        if len(row) <= last_index:
+            row += [''] * (last_index + 1 - len(row))
+        writer.writerow([row[index] for index in indices])
+    return output.getvalue().encode('utf-8')
+
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'BATCHIDX'
+INDEX_HEADER = '=8sQQQ' # magic + batch size + file size + file mtime.
+
+
+class BatchIndex:
+    """
+    Sidecar file mapping each message_id to the offset where its batch starts, written while batching.
+    It only holds for the same file and batch size, otherwise it is discarded and rebuilt.
+    A partial index (e.g. after a crash) is still used up to its last complete entry.
+    """
+    def __init__(self, data_path, batch_bytes):
+        self.path = data_path + INDEX_SUFFIX
+        stat = os.stat(data_path)
+        self.header = struct.pack(INDEX_HEADER, INDEX_MAGIC, batch_bytes, stat.st_size, stat.st_mtime_ns)
+        self.offsets = array('Q')
+        self.file = None
+        try:
+            self.__open()
+        except OSError as e:
+            logging.warning(f'Batch index {self.path} not available: {e}')
+
+    def __open(self):
+        mode = 'r+b' if os.path.exists(self.path) else 'w+b'
+        self.file = open(self.path, mode)
+        if self.file.read(len(self.header)) == self.header:
+            content = self.file.read()
+            complete = len(content) - len(content) % self.offsets.itemsize
+            self.offsets.frombytes(content[:complete])
+        else:
+            self.file.seek(0)
+            self.file.write(self.header)
+        self.file.seek(len(self.header) + len(self.offsets) * self.offsets.itemsize)
+        self.file.truncate()
+
+    def closest(self, message_id):
+        """
+        Returns the last indexed message_id before the given one and the offset right after it,
+        which is where the given message_id starts if it is indexed. Returns (0, None) if none is.
+        """
+        known = min(message_id, len(self.offsets))
+        if not known:
+            return 0, None
+        return known - 1, self.offsets[known - 1]
+
+    def add(self, message_id, offset):
+        if message_id != len(self.offsets) + 1:
+            return
+        self.offsets.append(offset)
+        if self.file:
+            self.file.write(struct.pack('=Q', offset))
+
+    def close(self):
+        if self.file:
+            self.file.close()
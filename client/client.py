@@ -1,16 +1,23 @@
+import mmap
 import os
-from multiprocessing import Process, Queue, Value
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
 from socket import SOCK_STREAM, socket, AF_INET
 from uuid import UUID
-from json import loads
+from json import dumps, loads
 import logging
 from signal import SIGTERM, signal, SIGALRM, alarm
-from lib.transfer.transfer_protocol import MESSAGE_FLAG, MessageTransferProtocol
+from batches import BatchIndex, column_indices, cut_batches, project_batch, read_header
+from lib.schema import PROJECTIONS
+from lib.transfer.transfer_protocol import MESSAGE_FLAG, CreditWindow, MessageTransferProtocol
 
-READ_MODE = 'r'
+READ_MODE = 'rb'
 RESULT_FILES_AMOUNT = 5
+RESULT_EXTENSION = '.csv'
 SERVER_TIMEOUT = 250
 RESULT_TIMEOUT = 40
+BOOKS_FIRST = 'books_first'
+ROUND_ROBIN = 'round_robin'
 
 def signal_handler(sig, frame):
     raise TimeoutError("System timeout.")
@@ -18,11 +25,26 @@ def signal_handler(sig, frame):
 def signal_handler_exit(sig, frame):
     raise SystemExit("System shutdown.")
 
+def choose_source(pending, ready, policy, last_flag):
+    """
+    Picks the source to send from among the ready ones.
+    Books first follows the order of `pending`, since books must be complete before the barriers release reviews.
+    Round robin avoids the source used last if there's another one ready.
+    """
+    candidates = [flag for flag, reader in pending.items() if reader in ready]
+    if policy == ROUND_ROBIN and len(candidates) > 1 and last_flag in candidates:
+        candidates.remove(last_flag)
+    return candidates[0]
+
 class Client:
     def __init__(self, config):
         self.port = config['port']
-        self.batch_amount = config['batch_amount']
+        self.batch_bytes = config['batch_bytes']
+        self.projection = config['projection']
         self.checkpoint = None
+        self.compression_codecs = config['compression']
+        self.compression = None
+        self.send_policy = config['send_policy']
 
         self.books_path = config['books_path']
         self.reviews_path = config['reviews_path']
@@ -30,14 +52,17 @@ class Client:
         self.output_dir = config['output_dir']
         self.uuid = UUID(config['client_id'])
 
-        books_queue = Queue()
-        reviews_queue = Queue()
-        self.finished = Value('i', 0)
+        # Pipe buffers bound how far ahead of the sender each file is read.
+        books_reader, books_writer = Pipe(duplex=False)
+        reviews_reader, reviews_writer = Pipe(duplex=False)
+        sources = {MESSAGE_FLAG['BOOK']: books_reader, MESSAGE_FLAG['REVIEW']: reviews_reader}
+        # Results are received while uploading, the receiver reads the socket and passes the credits to the sender.
+        credits_reader, credits_writer = Pipe(duplex=False)
         self.senders = []
-        self.senders.append(Process(target=self.__enqueue_file, args=(self.books_path, books_queue, MESSAGE_FLAG['BOOK'])))
-        self.senders.append(Process(target=self.__enqueue_file, args=(self.reviews_path, reviews_queue, MESSAGE_FLAG['REVIEW'])))
-        self.senders.append(Process(target=self.__send_from_queue, args=(books_queue, reviews_queue, self.finished)))
-        self.results_receiver = Process(target=self.__request_results)
+        self.senders.append(Process(target=self.__enqueue_file, args=(self.books_path, books_writer, MESSAGE_FLAG['BOOK'])))
+        self.senders.append(Process(target=self.__enqueue_file, args=(self.reviews_path, reviews_writer, MESSAGE_FLAG['REVIEW'])))
+        self.senders.append(Process(target=self.__send_from_sources, args=(sources, credits_reader)))
+        self.results_receiver = Process(target=self.__receive_results, args=(credits_writer,))
         signal(SIGALRM, signal_handler)
         signal(SIGTERM, signal_handler_exit)
         #logging.warning(f'Client initialized with UUID: {self.uuid}')
@@ -47,10 +72,11 @@ class Client:
         try:
             cliend_error = False
             self.conn = self.__try_connect('gateway', self.port)
+            self.compression = self.__negotiate_compression()
             self.checkpoint = self.__request_checkpoint()
             #logging.warning(f'Checkpoint received: {self.checkpoint}')
-            self.__try_run_processes(self.senders)
-            self.__try_run_processes([self.results_receiver], RESULT_TIMEOUT)
+            self.__request_results()
+            self.__try_run_processes(self.senders + [self.results_receiver], SERVER_TIMEOUT + RESULT_TIMEOUT)
         except TimeoutError:
             cliend_error = True
         except Exception as e:
@@ -71,7 +97,6 @@ class Client:
 
             for process in processes:
                 process.join(timeout)
-                self.finished.value += 1
             alarm(0)
 
     def __try_connect(self, host, port):
@@ -83,8 +108,14 @@ class Client:
             except:
                 pass
 
-    def __request_checkpoint(self):
+    def __negotiate_compression(self):
+        if not self.compression_codecs:
+            return None
         protocol = MessageTransferProtocol(self.conn)
+        return protocol.request_compression(self.uuid, self.compression_codecs)
+
+    def __request_checkpoint(self):
+        protocol = MessageTransferProtocol(self.conn, self.compression)
         protocol.send_message(MESSAGE_FLAG['CHECKPOINT'], self.uuid, 1, '')
         flag, _gateway_id, message_id, message = protocol.receive_message()
 
@@ -93,10 +124,17 @@ class Client:
         else:
             raise SystemError('Invalid response from the server')    # not handled at the moment
 
-    def __enqueue_file(self, path, queue, source):
+    def __enqueue_file(self, path, pipe, source):
         # Batch message format:
         # field1,field2,...
-        source = str(source)
+        try:
+            self.__enqueue_file_batches(path, pipe, str(source))
+        finally:
+            # Tells the sender there is nothing else to send from this file.
+            pipe.send(None)
+            pipe.close()
+
+    def __enqueue_file_batches(self, path, pipe, source):
         start_id = 1
         eof = None
 
@@ -108,75 +146,115 @@ class Client:
             return
 
         with open(path, READ_MODE) as file:
-            headers = file.readline()
-            self.__queue_file_rows(file, queue, source, start_id, headers)
-
-
-    def __queue_file_rows(self, file, queue, source, start_id, headers):
-        message_id = 0
-        batch = [headers]
-        for line in file:
-            batch.append(line)
-            if len(batch) - 1 >= self.batch_amount:
-                message_id += 1
-                if message_id < start_id:
-                    logging.warning(f'Skipping message {message_id}')
-                    batch = [headers]
-                    continue
-                batch[-1] = batch[-1].rstrip()
-                queue.put((message_id, ''.join(batch)))
-                batch = [headers]
-
-        if len(batch) > 1:
-            batch[-1] = batch[-1].rstrip()
-            message_id += 1
-            queue.put((message_id, ''.join(batch)))
+            if os.fstat(file.fileno()).st_size == 0:
+                # mmap can't map empty files, there is nothing to send but the EOF.
+                pipe.send((1, b'type\nEOF'))
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    data.madvise(mmap.MADV_SEQUENTIAL)
+                index = BatchIndex(path, self.batch_bytes)
+                try:
+                    columns = PROJECTIONS[int(source)] if self.projection else None
+                    self.__queue_file_batches(data, pipe, start_id, index, columns)
+                finally:
+                    index.close()
 
-        batch = ['type', 'EOF']
-        queue.put((message_id + 1, '\n'.join(batch)))
-    
-    def __sending_completed(self, books_queue: Queue, reviews_queue: Queue, senders_finished):
-        if senders_finished.value == 2 and books_queue.empty() and reviews_queue.empty():
-            #logging.warning('All senders finished')
-            return True
 
-    def __send_from_queue(self, books_queue: Queue, reviews_queue: Queue, senders_finished):
-        protocol = MessageTransferProtocol(self.conn)
+    def __queue_file_batches(self, data, pipe, start_id, index, columns=None):
+        # Every batch carries the CSV header so the gateway can parse it on its own.
+        headers = read_header(data)
+        indices = None
+        if columns:
+            # Columns the system doesn't use are dropped before sending.
+            indices = column_indices(headers, columns)
+            projected_headers = project_batch(headers, indices)
+        # Seek straight to the checkpointed message if the index already knows where it starts.
+        message_id, offset = index.closest(start_id)
+        if offset is None:
+            offset = len(headers)
+        if start_id > 1:
+            logging.warning(f'Resuming from message {message_id + 1} at byte {offset}, skipping messages before {start_id}')
+        for offset, batch in cut_batches(data, offset, self.batch_bytes):
+            message_id += 1
+            index.add(message_id, offset)
+            if message_id < start_id:
+                continue
+            if indices:
+                pipe.send((message_id, projected_headers + project_batch(batch, indices)))
+            else:
+                pipe.send((message_id, headers + batch))
 
-        while True:
-            if not books_queue.empty():
-                message_id, message = books_queue.get()
-                protocol.send_message(MESSAGE_FLAG['BOOK'], self.uuid, message_id, message)
-            if not reviews_queue.empty():
-                message_id, message = reviews_queue.get()
-                protocol.send_message(MESSAGE_FLAG['REVIEW'], self.uuid, message_id, message)
+        pipe.send((message_id + 1, b'type\nEOF'))
+    
+    def __send_from_sources(self, sources, credits):
+        """
+        Sends batches as soon as any of the files has one ready, blocking while none has.
+        When more than one is ready the send policy picks which one goes first.
+        """
+        protocol = MessageTransferProtocol(self.conn, self.compression)
+        window = CreditWindow(protocol, credits)
+        pending = dict(sources)
+        last_flag = None
 
-            if self.__sending_completed(books_queue, reviews_queue, senders_finished):
-                break
+        while pending:
+            ready = wait(list(pending.values()))
+            flag = choose_source(pending, ready, self.send_policy, last_flag)
+            batch = pending[flag].recv()
+            if batch is None:
+                del pending[flag]
+                continue
+            message_id, message = batch
+            window.acquire()
+            protocol.send_message(flag, self.uuid, message_id, message)
+            last_flag = flag
 
     def __request_results(self):
+        "Asks for the results before uploading, the gateway sends each query's as soon as they are ready."
+        protocol = MessageTransferProtocol(self.conn, self.compression)
+        # Results already saved by a previous attempt are not downloaded again.
+        protocol.send_message(MESSAGE_FLAG['RESULT'], self.uuid, 1, dumps(self.__result_offsets()))
+
+    def __receive_results(self, credits):
+        "Reads everything the gateway sends until every query finished, passing the credits on to the sender."
+        protocol = MessageTransferProtocol(self.conn, self.compression)
         eof_count = 0
         while eof_count < RESULT_FILES_AMOUNT:
             #logging.warning(f"Requesting result: {eof_count + 1}")
-            flag = self.__handle_result()
+            flag = self.__handle_result(protocol, credits)
             if flag == MESSAGE_FLAG['EOF']:
                 eof_count += 1
         return True
 
-    def __handle_result(self):
-        protocol = MessageTransferProtocol(self.conn)
+    def __result_offsets(self):
+        "Returns how many bytes of each result file are already saved."
+        offsets = {}
+        for file_name in os.listdir(self.output_dir):
+            name, extension = os.path.splitext(file_name)
+            if extension == RESULT_EXTENSION:
+                offsets[name] = os.path.getsize(os.path.join(self.output_dir, file_name))
+        return offsets
+
+    def __handle_result(self, protocol, credits):
         flag, _gateway_id, message_id, message = protocol.receive_message()
-        if flag == MESSAGE_FLAG['RESULT']:
+        if flag == MESSAGE_FLAG['CREDIT']:
+            try:
+                credits.send(int(message))
+            except BrokenPipeError:
+                # The sender is done, the last batches are granted after it sent them.
+                pass
+        elif flag == MESSAGE_FLAG['RESULT']:
             body = loads(message)
             #logging.warning(f"Received message with ID '{message_id}' from Gateway'")
-            self.__save_in_file(body['file'], body['body'])
+            self.__save_in_file(body['file'], body['offset'], body['body'])
 
         return flag
         
 
-    def __save_in_file(self, filename, body: dict):
-        filepath = os.path.join(self.output_dir, f'{filename}.csv')
-        file_exists = os.path.isfile(filepath)
-        if body:
-            with open(filepath, 'a+', newline='') as file:
-                file.write(body)
\ No newline at end of file
+    def __save_in_file(self, filename, offset, body: str):
+        filepath = os.path.join(self.output_dir, filename + RESULT_EXTENSION)
+        with open(filepath, 'ab') as file:
+            if file.tell() != offset:
+                # The gateway sends each chunk from the offset it belongs to, anything past it is stale.
+                file.truncate(offset)
+            file.write(body.encode('utf-8'))
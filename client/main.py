@@ -12,10 +12,13 @@ def get_config_params():
             'books_path': os.getenv('BOOKS_PATH', default=config['DEFAULT'].get('BOOKS_PATH')),
             'reviews_path': os.getenv('REVIEWS_PATH', default=config['DEFAULT'].get('REVIEWS_PATH')),
             'output_dir': os.getenv('OUTPUT_DIR', default=config['DEFAULT'].get('OUTPUT_DIR')),
-            'batch_amount': int(os.getenv('BATCH_AMOUNT', default=config['DEFAULT'].get('BATCH_AMOUNT'))),
+            'batch_bytes': int(os.getenv('BATCH_BYTES', default=config['DEFAULT'].get('BATCH_BYTES'))),
             'port': int(os.getenv('PORT', default=config['DEFAULT'].get('PORT'))),
             'log_level': os.getenv('LOG_LEVEL', default=config['DEFAULT'].get('LOG_LEVEL')),
             'client_id': os.getenv('CLIENT_ID'),
+            'send_policy': os.getenv('SEND_POLICY', default=config['DEFAULT'].get('SEND_POLICY', 'books_first')),
+            'projection': os.getenv('PROJECT_COLUMNS', default=config['DEFAULT'].get('PROJECT_COLUMNS', 'true')).lower() == 'true',
+            'compression': [codec for codec in os.getenv('COMPRESSION', default=config['DEFAULT'].get('COMPRESSION', '')).split(',') if codec],
         }
         print(config_params)
     except KeyError as e:
@@ -41,9 +44,10 @@ def main():
     config_params = get_config_params()
     initialize_log(config_params['log_level'])
 
+    # Retries resume from the upload checkpoint and the results already saved, so the output is kept between them.
+    initialize_dir(config_params['output_dir'])
     client_timeout = True
     while client_timeout:
-        initialize_dir(config_params['output_dir'])
         client = Client(config_params)
         client_timeout = client.start()
 
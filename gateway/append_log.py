@@ -0,0 +1,128 @@
+import json
+import os
+from threading import Lock, Timer
+from time import monotonic
+
+SNAPSHOT_SUFFIX = '.snapshot'
+GROUP_COMMIT_SIZE = 64
+GROUP_COMMIT_INTERVAL = 0.05
+COMPACTION_SIZE = 64 * 1024 * 1024
+
+
+class AppendLog:
+    """
+    Append-only log of newline delimited JSON records, plus a snapshot of the state they build.
+    -Appends are a single write to a file opened with O_APPEND, so the log is shared between forked processes.
+    -fsync is group committed: it runs once every `group_size` appends or `group_interval` seconds. A timer commits
+     the last group once appends stop, so it isn't left unsynced until the next append.
+    -Once the log outgrows `compaction_size` the state is written to the snapshot and the log starts over.
+    Recovery only reads the snapshot and the records appended after it.
+    """
+    def __init__(self, path, group_size=GROUP_COMMIT_SIZE, group_interval=GROUP_COMMIT_INTERVAL, compaction_size=COMPACTION_SIZE):
+        self.path = path
+        self.snapshot_path = path + SNAPSHOT_SUFFIX
+        self.group_size = group_size
+        self.group_interval = group_interval
+        self.compaction_size = compaction_size
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.uncommitted = 0
+        self.last_commit = monotonic()
+        # Guards the fd against the timer.
+        self.lock = Lock()
+        self.timer = None
+
+    def append(self, line: bytes):
+        "Appends a record encoded with encode_record. The caller must hold the lock that guards compaction."
+        os.write(self.fd, line)
+        self.uncommitted += 1
+
+    def commit(self, force=False):
+        "Flushes the appended records to disk if the current group is complete (or if forced)."
+        with self.lock:
+            if not self.uncommitted:
+                return
+            elapsed = monotonic() - self.last_commit
+            if force or self.uncommitted >= self.group_size or elapsed >= self.group_interval:
+                self.__sync()
+            elif not self.timer:
+                self.timer = Timer(self.group_interval - elapsed, self.__commit_idle)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def __commit_idle(self):
+        with self.lock:
+            self.timer = None
+            if self.uncommitted and self.fd is not None:
+                self.__sync()
+
+    def __sync(self):
+        os.fsync(self.fd)
+        self.uncommitted = 0
+        self.last_commit = monotonic()
+
+    def needs_compaction(self):
+        return os.fstat(self.fd).st_size >= self.compaction_size
+
+    def compact(self, snapshot: dict):
+        """
+        Replaces the snapshot and empties the log. The caller must hold the lock that guards writes,
+        and `snapshot` must include every record appended so far.
+        """
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        with self.lock:
+            os.ftruncate(self.fd, 0)
+            os.fsync(self.fd)
+            self.uncommitted = 0
+
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def read_records(self):
+        "Yields the records appended since the last snapshot."
+        return read_records(self.path)
+
+    def close(self):
+        self.commit(force=True)
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            os.close(self.fd)
+            self.fd = None
+
+
+def encode_record(record: dict) -> bytes:
+    return (json.dumps(record) + '\n').encode('utf-8')
+
+
+def read_records(path):
+    """
+    Yields the records of a log file.
+    A torn record at the end of the log (e.g. after a crash) is skipped.
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                pass
+
+
+def append_line(path, line: bytes, sync=False):
+    "Appends a single record to a log without keeping it open, for writers that don't own the log."
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+        if sync:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
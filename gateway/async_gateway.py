@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process
+from pika.exchange_type import ExchangeType
+from data_storage import ALL_ROWS, DataSaver
+from gateway import ResultStream, get_checkpoint, save_result
+from lib.broker import MessageBroker
+from lib.gateway import BookPublisher, ResultReceiver, ReviewPublisher
+from lib.transfer.transfer_protocol import MESSAGE_FLAG, AsyncMessageTransferProtocol
+from lib.workers.workers import wait_rabbitmq
+from lib.healthcheck import Healthcheck, HEALTH
+
+CLIENTS_BACKLOG = 1024
+RESULT_POLL_INTERVAL = 1
+
+
+class AsyncGateway:
+    """
+    Gateway that multiplexes every client on asyncio event loops instead of forking a process per client.
+    Each loop runs in its own process and listens on the same port with SO_REUSEPORT.
+    Publishing runs on a few single-thread executors, each one owning its broker connection. The batches of a client
+    are always published by the same one, so its checkpoints can be flushed before the client is released.
+    Every disk read and fsync runs on a single storage thread of each loop, so clients don't wait for each other's
+    fsyncs and the client records only have one writer. Checkpoints are handed to it once their batches are confirmed.
+    The result queues are consumed by a background thread of each loop.
+    """
+    def __init__(self, config):
+        self.result_queues = config['result_queues']
+        self.port = config['port']
+        self.compression = config['compression']
+        self.credit_window = config['credit_window']
+        self.confirm_window = config['confirm_window']
+        self.batch_layout = config['batch_layout']
+        self.loops = config['async_loops']
+        self.publisher_threads = config['publisher_threads']
+        self.data_saver = DataSaver(config['records_path'])
+        self.data_saver_results = DataSaver(config['results_path'], mode=ALL_ROWS)
+        self.healthcheck = Process(target=Healthcheck().listen_healthchecks)
+        self.health = HEALTH
+        self.local = threading.local()
+        self.results_ready = {}
+        self.loop = None
+        self.publishers = []
+        self.storage = None
+
+    def start(self):
+        self.healthcheck.start()
+        wait_rabbitmq()
+        processes = [Process(target=self.__run_loop) for _ in range(self.loops)]
+
+        try:
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+        except:
+            self.health.set_broken()
+        finally:
+            self.healthcheck.join()
+
+    def __run_loop(self):
+        asyncio.run(self.__serve())
+
+    async def __serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.storage = ThreadPoolExecutor(1)
+        self.publishers = [ThreadPoolExecutor(1, initializer=self.__init_publisher) for _ in range(self.publisher_threads)]
+        threading.Thread(target=self.__consume_results, daemon=True).start()
+        server = await asyncio.start_server(self.__handle_client, port=self.port, reuse_port=True, backlog=CLIENTS_BACKLOG)
+        async with server:
+            await server.serve_forever()
+
+    async def __handle_client(self, reader, writer):
+        protocol = AsyncMessageTransferProtocol(reader, writer)
+        client_id = None
+        results = None
+        try:
+            flag, client_id, message_id, message = await protocol.receive_message()
+            logging.warning(f'Client connection established: {client_id}')
+
+            # The results are streamed while the client goes on uploading, until it has all of them.
+            while True:
+                if flag == MESSAGE_FLAG['RESULT'] and results is None:
+                    results = asyncio.ensure_future(self.__stream_results(protocol, client_id, json.loads(message)))
+                else:
+                    await self.__handle_message(protocol, flag, client_id, message_id, message)
+                receive = asyncio.ensure_future(protocol.receive_message())
+                await asyncio.wait([receive] + ([results] if results else []), return_when=asyncio.FIRST_COMPLETED)
+                if results and results.done():
+                    receive.cancel()
+                    break
+                flag, client_id, message_id, message = receive.result()
+
+            await results
+            logging.warning(f'Client connection closed: {client_id} all eof received.')
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.warning(f'Client connection lost: {client_id} ({e})')
+        finally:
+            if results and not results.done():
+                results.cancel()
+            if client_id:
+                # Checkpoints still waiting for their batches to be confirmed are saved before releasing the client.
+                await self.loop.run_in_executor(self.__publisher(client_id), self.__flush)
+                await self.loop.run_in_executor(self.storage, self.data_saver.release, client_id)
+            protocol.close()
+
+    async def __handle_message(self, protocol, flag, client_id, message_id, message):
+        if flag in (MESSAGE_FLAG['BOOK'], MESSAGE_FLAG['REVIEW']):
+            eof_received = await self.loop.run_in_executor(self.__publisher(client_id), self.__publish, flag, client_id, message_id, message)
+            await protocol.grant_credits(client_id, message_id, 1)
+            return eof_received
+        elif flag == MESSAGE_FLAG['CHECKPOINT']:
+            _, client_checkpoint = await self.loop.run_in_executor(self.storage, get_checkpoint, self.data_saver, client_id)
+            await protocol.send_message(MESSAGE_FLAG['CHECKPOINT'], client_id, message_id, json.dumps(client_checkpoint))
+            await protocol.grant_credits(client_id, message_id, self.credit_window)
+            return 0
+        elif flag == MESSAGE_FLAG['HANDSHAKE']:
+            await protocol.accept_compression(client_id, message_id, message, self.compression)
+            return 0
+        else:
+            logging.error(f'Unsupported message flag {repr(flag)}')
+            return 0
+
+    def __publisher(self, client_id):
+        return self.publishers[client_id.int % len(self.publishers)]
+
+    def __init_publisher(self):
+        "Runs once in every publisher thread, pika connections must not be shared between threads."
+        connection = MessageBroker("rabbitmq", self.confirm_window)
+        data_saver = ExecutorDataSaver(self.data_saver, self.storage)
+        self.local.connection = connection
+        self.local.book_publisher = BookPublisher(connection, 'books_exchange', ExchangeType.fanout, data_saver, self.batch_layout)
+        self.local.review_publisher = ReviewPublisher(connection, data_saver, self.batch_layout)
+
+    def __flush(self):
+        self.local.connection.flush()
+
+    def __publish(self, flag, client_id, message_id, message):
+        if flag == MESSAGE_FLAG['BOOK']:
+            eof_received = self.local.book_publisher.publish(client_id, message_id, message, '')
+        else:
+            eof_received = self.local.review_publisher.publish(client_id, message_id, message, 'reviews_queue')
+        if eof_received:
+            # Checkpoints are saved as batches are confirmed, the last ones can't wait for another publish.
+            self.local.connection.flush()
+        return eof_received
+
+    def __consume_results(self):
+        connection = MessageBroker("rabbitmq")
+        result_receiver = ResultReceiver(connection, self.result_queues, callback_result_async, self.__notify_results, self.data_saver_results)
+        result_receiver.start()
+
+    def __notify_results(self, request_id):
+        self.loop.call_soon_threadsafe(self.__set_results_ready, request_id)
+
+    def __set_results_ready(self, request_id):
+        event = self.results_ready.get(request_id)
+        if event:
+            event.set()
+
+    async def __stream_results(self, protocol, client_id, offsets):
+        "Sends the results of the client as soon as they are saved, one query at a time finishing with its EOF."
+        stream = await self.loop.run_in_executor(self.storage, ResultStream, self.data_saver_results, client_id, offsets)
+        event = self.results_ready.setdefault(str(client_id), asyncio.Event())
+        try:
+            while True:
+                # Cleared before reading, so results saved while sending wake up the next wait.
+                event.clear()
+                pending = await self.loop.run_in_executor(self.storage, list, stream.pending_messages())
+                for flag, message_id, message in pending:
+                    await protocol.send_message(flag, client_id, message_id, message)
+                if stream.is_complete():
+                    return
+                try:
+                    await asyncio.wait_for(event.wait(), RESULT_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    # The results may have been consumed by the loop of another process.
+                    pass
+        finally:
+            self.results_ready.pop(str(client_id), None)
+            await self.loop.run_in_executor(self.storage, stream.close)
+
+
+class ExecutorDataSaver:
+    "Saves the checkpoints confirmed in a publisher thread from the executor that owns the client records."
+    def __init__(self, data_saver: DataSaver, executor: ThreadPoolExecutor):
+        self.data_saver = data_saver
+        self.executor = executor
+
+    def save_message_to_json(self, message):
+        self.executor.submit(self.__save, message)
+
+    def __save(self, message):
+        try:
+            self.data_saver.save_message_to_json(message)
+        except Exception:
+            logging.exception(f'Could not save the checkpoint of {message["request_id"]}')
+
+
+def callback_result_async(self, ch, method, properties, body, queue_name, callback_arg1, callback_arg2: DataSaver):
+    request_id = save_result(body, queue_name, callback_arg2, properties)
+    self.connection.acknowledge_message(method.delivery_tag)
+    callback_arg1(str(request_id))
@@ -2,102 +2,282 @@ import csv
 import io
 import json
 import logging
-from multiprocessing import Manager, Lock
-from lib.fault_tolerance import is_duplicate
+import os
+from append_log import AppendLog, append_line, encode_record, read_records
+from lib.fault_tolerance import finish_request, is_duplicate
 
-FILE_LOCK = Lock()
 LATEST_ROW = 0
 ALL_ROWS = 1
+LOG_SUFFIX = '.log'
+CLIENT_COMPACTION_SIZE = 1024 * 1024
+QUERY_SUFFIX = '.csv'
+PROGRESS_FILE = 'progress.json'
+LEGACY_SUFFIX = '.json'
+MIGRATED_SUFFIX = '.migrated'
+
+class ClientRecords:
+    """
+    Latest message of each source of a single client.
+    It's only used by the process or task serving that client, so it's made of plain dicts
+    and only needs to be kept in sync with its own log.
+    """
+    def __init__(self, path):
+        self.rows = {}
+        self.states = {}
+        self.log = AppendLog(path, compaction_size=CLIENT_COMPACTION_SIZE)
+        snapshot = self.log.load_snapshot()
+        if snapshot:
+            # Stored as lists, JSON would turn the int sources used as keys into strings.
+            self.rows = {row['source']: row for row in snapshot['rows']}
+            self.states = {source: state for source, state in snapshot['states']}
+        for message in self.log.read_records():
+            self.__save_in_memory(message)
+
+    def save(self, message):
+        if not self.__save_in_memory(message):
+            return
+        self.log.append(encode_record(message))
+        self.log.commit(force=message.get('eof', False))
+        if self.log.needs_compaction():
+            self.log.compact(self.__snapshot())
+
+    def __save_in_memory(self, message):
+        state = self.states.setdefault(message['source'], {})
+        if is_duplicate(message['request_id'], message['message_id'], state):
+            return False
+        if message.get('eof', False):
+            logging.warning(f'EOF message received from {message["source"]} with request_id {message["request_id"]}')
+            finish_request(message['request_id'], state)
+        row = self.rows.get(message['source'])
+        # Checkpoints saved by different publisher threads may arrive out of order.
+        if row is None or row['message_id'] < message['message_id']:
+            self.rows[message['source']] = message
+        return True
+
+    def __snapshot(self):
+        return {'rows': list(self.rows.values()), 'states': [[source, state] for source, state in self.states.items()]}
+
+    def close(self):
+        self.log.close()
+
+
+class QueryResults:
+    """
+    Results of each query of a single client as append-only CSV files, built from its result log
+    by the process or task serving the client. Offsets in these files never change once written,
+    so a client resumes a download by telling which offset of each query it already has.
+    A progress file records how much of the log the files hold and how long each one was at that point.
+    Anything appended after it (e.g. before a crash) is truncated and built again from the log.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        progress = self.__load_progress()
+        self.log_offset = progress['log_offset']
+        self.states = progress['states']
+        self.sizes = progress['sizes']
+        self.finished = set(progress['finished'])
+        self.files = {}
+        for file_name in os.listdir(path):
+            if file_name.endswith(QUERY_SUFFIX):
+                query = file_name[:-len(QUERY_SUFFIX)]
+                os.truncate(self.query_path(query), self.size(query))
+
+    def __load_progress(self):
+        try:
+            with open(os.path.join(self.path, PROGRESS_FILE), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {'log_offset': 0, 'states': {}, 'sizes': {}, 'finished': []}
+
+    def query_path(self, query):
+        return os.path.join(self.path, query + QUERY_SUFFIX)
+
+    def size(self, query):
+        return self.sizes.get(query, 0)
+
+    def append(self, query, data: bytes):
+        if query not in self.files:
+            self.files[query] = open(self.query_path(query), 'ab')
+        self.files[query].write(data)
+        self.sizes[query] = self.size(query) + len(data)
+
+    def finish(self, query):
+        self.finished.add(query)
+
+    def commit(self, log_offset):
+        "Makes the appends durable, recording that they hold the result log up to `log_offset`."
+        for file in self.files.values():
+            file.flush()
+            os.fsync(file.fileno())
+        self.log_offset = log_offset
+        progress = {'log_offset': log_offset, 'states': self.states, 'sizes': self.sizes, 'finished': list(self.finished)}
+        progress_path = os.path.join(self.path, PROGRESS_FILE)
+        with open(progress_path + '.tmp', 'w') as f:
+            json.dump(progress, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(progress_path + '.tmp', progress_path)
+
+    def read(self, query, offset, max_bytes):
+        """
+        Returns the bytes of a query from `offset`, up to `max_bytes` unless a single row is longer.
+        Chunks end at a newline so they are always valid UTF-8.
+        """
+        with open(self.query_path(query), 'rb') as f:
+            f.seek(offset)
+            data = f.read(max_bytes)
+            if offset + len(data) < self.size(query):
+                end = data.rfind(b'\n') + 1
+                data = data[:end] if end else data + f.readline()
+        return data
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
 
 class DataSaver:
     """
-    Class responsible for saving messages to a file and loading them from it.
-    -path: path to the file where the messages are saved (persistent storage)
-    -mode: mode in which messages are stored in memory to use in the program (can be shared between processes)
-           if no mode is specified, only the last message is stored in memory
+    Class responsible for saving messages to disk and loading them from it, partitioned by client.
+    -path: directory where the messages of each client are saved in their own append-only log (see AppendLog)
+    -mode: LATEST_ROW keeps the last message of each source in memory, only in the process or task serving the client.
+           ALL_ROWS appends every message to the client's log from whichever process receives it, and the process
+           serving the client reads them back as they arrive (see read_from). Nothing is shared in memory.
     """
     def __init__(self, path, mode=LATEST_ROW):
-        self.manager = Manager()
-        self.shared_rows = self.manager.dict()
-        self.eof_data = self.manager.dict()
-        self.states = self.manager.dict()
         self.path = path
         self.mode = mode
-        self.__load_from_file()
-    
-    def message_duplicate(self, message):
-        request_id = message['request_id']
-        message_id = message['message_id']
-        source = message['source']
-        if not self.states.get(source):
-            #logging.warning(f'No state found for source {source} creating new state')
-            self.states[source] = {}
-        return is_duplicate(request_id, message_id, self.states[source])
+        self.clients = {}
+        migrate_legacy_file(path)
+        os.makedirs(path, exist_ok=True)
+
+    def client_path(self, uid):
+        return os.path.join(self.path, str(uid) + LOG_SUFFIX)
+
+    def query_results(self, uid):
+        "Returns the query files built from the log of a client, only its owner should use them."
+        return QueryResults(os.path.join(self.path, str(uid)))
 
     def save_message_to_json(self, message):
-        if self.message_duplicate(message):
-            return
-        self.save_message_in_memory(message)
-        with FILE_LOCK:
-            with open(self.path, 'a') as f:
-                json.dump(message, f, indent=4)
-                f.write('\n')
-    
-    def save_eof(self, uid, source):
+        message['request_id'] = str(message['request_id'])
+        if self.mode == LATEST_ROW:
+            self.__client(message['request_id']).save(message)
+        else:
+            self.__append_message(message)
+
+    def release(self, uid):
+        "Drops the state of a client that is no longer served here, it's loaded again from disk if it comes back."
+        client = self.clients.pop(str(uid), None)
+        if client:
+            client.close()
+
+    def __client(self, uid):
         uid = str(uid)
-        if not self.eof_data.get(uid):
-            self.eof_data[uid] = 0
-        
-        self.eof_data[uid] += 1
+        if uid not in self.clients:
+            self.clients[uid] = ClientRecords(self.client_path(uid))
+        return self.clients[uid]
 
-    def save_message_in_memory(self, message):
-        if self.message_duplicate(message):
-            return
-        message['request_id'] = str(message['request_id'])
+    def __append_message(self, message):
         uid = message['request_id']
-        source = message['source']
-        self.__create_if_not_exists(uid)
-        if message.get('eof', False):
-            logging.warning(f'EOF message received from {source} with request_id {uid}')
-            self.save_eof(uid, source)
-
-        if self.mode == ALL_ROWS:
-            self.shared_rows[uid].append(message)
-        elif self.mode == LATEST_ROW:
-            self.shared_rows[uid][source] = message
-    
-    def __create_if_not_exists(self, uid):
-        if self.mode == ALL_ROWS and uid not in self.shared_rows:
-            self.shared_rows[uid] = self.manager.list()
-        elif self.mode == LATEST_ROW and uid not in self.shared_rows:
-            self.shared_rows[uid] = self.manager.dict()
-        
-    def __load_from_file(self):
-        with FILE_LOCK:
-
-            with open(self.path, 'r') as f:
-                content = f.read()
-                messages = content.split('\n}\n{')
-                if len(messages) > 1:
-                    messages[0] += '}'
-                    messages[-1] = '{' + messages[-1]
-                    for i in range(1, len(messages) - 1):
-                        messages[i] = '{' + messages[i] + '}'
-                for msg in messages:
-                    try:
-                        message = json.loads(msg)
-                        if 'request_id' not in message:
-                            continue
-                        self.save_message_in_memory(message)
-                    except json.JSONDecodeError as e:
-                        pass
+        eof = message.get('eof', False)
+        if eof:
+            logging.warning(f'EOF message received from {message["source"]} with request_id {uid}')
+        append_line(self.client_path(uid), encode_record(message), sync=eof)
+
+    def truncate(self, uid):
+        "Empties the log of a client once every record in it is kept somewhere else (see ResultStream)."
+        try:
+            os.truncate(self.client_path(uid), 0)
+        except FileNotFoundError:
+            pass
+
+    def read_from(self, uid, offset, states):
+        """
+        Reads the messages of a client appended to its log after `offset`, skipping the duplicates
+        (which may come from broker redeliveries) with the filter `states` kept by the caller between reads.
+        Returns the messages and the offset to read from next. Only whole records are read, a record
+        still being appended is left for the next read.
+        """
+        try:
+            with open(self.client_path(uid), 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return [], offset
+        complete = data.rfind(b'\n') + 1
+        messages = []
+        for line in data[:complete].splitlines():
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            state = states.setdefault(message['source'], {})
+            if is_duplicate(message['request_id'], message['message_id'], state):
+                continue
+            if message.get('eof', False):
+                finish_request(message['request_id'], state)
+            messages.append(message)
+        return messages, offset + complete
 
     def get(self, uid):
-        uid = str(uid)
-        return self.shared_rows.get(uid, {})
-    
+        if self.mode == LATEST_ROW:
+            return self.__client(uid).rows
+        messages, _offset = self.read_from(str(uid), 0, {})
+        return messages
+
     def get_eof_count(self, uid):
-        return self.eof_data.get(str(uid), 0)
+        uid = str(uid)
+        if self.mode == LATEST_ROW:
+            return sum(1 for row in self.__client(uid).rows.values() if row.get('eof', False))
+        return len({message['source'] for message in self.get(uid) if message.get('eof', False)})
+
+def migrate_legacy_file(path):
+    """
+    Moves the messages of the single file every client used to be saved to into the log of each client, once.
+    The file is the one at `path` if it's still configured, or next to it as `path` + LEGACY_SUFFIX (e.g. records.json).
+    It's renamed with MIGRATED_SUFFIX when done. Running it again after a crash only appends duplicates,
+    which are skipped when the logs are read.
+    """
+    if os.path.isfile(path):
+        # The directory of logs takes the place of the file.
+        os.replace(path, path + LEGACY_SUFFIX)
+    legacy_path = path + LEGACY_SUFFIX
+    if not os.path.isfile(legacy_path):
+        return
+    os.makedirs(path, exist_ok=True)
+    lines = {}
+    for message in legacy_messages(legacy_path):
+        message['request_id'] = str(message['request_id'])
+        lines.setdefault(message['request_id'], []).append(encode_record(message))
+    for uid, client_lines in lines.items():
+        append_line(os.path.join(path, uid + LOG_SUFFIX), b''.join(client_lines), sync=True)
+    os.replace(legacy_path, legacy_path + MIGRATED_SUFFIX)
+    logging.warning(f'Migrated {sum(map(len, lines.values()))} messages of {len(lines)} clients from {legacy_path}')
+
+
+def legacy_messages(path):
+    "Yields the messages of a file of indented JSON objects one after the other, or of JSON lines."
+    with open(path, 'r') as f:
+        content = f.read()
+    if not content.startswith('{\n'):
+        yield from (message for message in read_records(path) if 'request_id' in message)
+        return
+    messages = content.split('\n}\n{')
+    if len(messages) > 1:
+        messages[0] += '}'
+        messages[-1] = '{' + messages[-1]
+        for i in range(1, len(messages) - 1):
+            messages[i] = '{' + messages[i] + '}'
+    for msg in messages:
+        try:
+            message = json.loads(msg)
+        except json.JSONDecodeError:
+            continue
+        if 'request_id' in message:
+            yield message
+
 
 def write_csv_to_string(headers, rows):
     output = io.StringIO()
@@ -106,4 +286,4 @@ def write_csv_to_string(headers, rows):
         writer.writerow(headers)
     if rows:
         writer.writerows(rows)
-    return output.getvalue()
\ No newline at end of file
+    return output.getvalue()
@@ -1,5 +1,6 @@
 import json
 import logging
+import threading
 from multiprocessing import Process
 from socket import SOCK_STREAM, socket, AF_INET
 from time import sleep
@@ -8,13 +9,17 @@ from uuid import UUID
 from pika.exchange_type import ExchangeType
 from data_storage import ALL_ROWS, DataSaver, write_csv_to_string
 from lib.broker import MessageBroker
+from lib.codec import decode
 from lib.gateway import BookPublisher, ResultReceiver, ReviewPublisher, MAX_KEY_LENGTH
-from lib.transfer.transfer_protocol import MESSAGE_FLAG, MessageTransferProtocol, RouterProtocol
+from lib.transfer.transfer_protocol import MESSAGE_FLAG, MessageTransferProtocol
+from lib.workers.records import COLUMNS, to_rows
 from lib.workers.workers import wait_rabbitmq
 from lib.healthcheck import Healthcheck, HEALTH
 
 CLIENTS_BACKLOG = 5
 RESULTS_BACKLOG = 5
+RESULT_POLL_INTERVAL = 0.5
+RESULT_CHUNK_BYTES = 1024 * 1024
 source_mapping = {
     "author_decades": {"headers": ["author"], "key": "authors"},
     "popular_90s_books": {"headers": ["Title", "count"], "key": "items"},
@@ -28,7 +33,10 @@ class Gateway:
     def __init__(self, config):
         self.result_queues = config['result_queues']
         self.port = config['port']
-        self.router = RouterProtocol()
+        self.compression = config['compression']
+        self.credit_window = config['credit_window']
+        self.confirm_window = config['confirm_window']
+        self.batch_layout = config['batch_layout']
         self.data_saver = DataSaver(config['records_path'])
         self.data_saver_results = DataSaver(config['results_path'], mode=ALL_ROWS)
         self.healthcheck = Process(target=Healthcheck().listen_healthchecks)
@@ -51,101 +59,103 @@ class Gateway:
             self.healthcheck.join()
             for process in self.processes:
                 process.join()
-            self.router.close()
 
     def __handle_clients(self):
         while True:
                 self.conn.listen(CLIENTS_BACKLOG)
                 client, addr = self.conn.accept()
                 logging.warning(f'Client connection established: {addr}')
-                process = Process(target=self.__handle_client, args=(client, self.router)).start()
+                process = Process(target=self.__handle_client, args=(client,)).start()
                 self.processes.append(process)
 
-    def __handle_client(self, client:socket, router: RouterProtocol):
+    def __handle_client(self, client:socket):
         protocol = MessageTransferProtocol(client)
+        connection = MessageBroker("rabbitmq", self.confirm_window)
+        book_publisher = BookPublisher(connection, 'books_exchange', ExchangeType.fanout, self.data_saver, self.batch_layout)
+        review_publisher = ReviewPublisher(connection, self.data_saver, self.batch_layout)
+        # Frames are sent by this process and by the thread streaming the results.
+        send_lock = threading.Lock()
+        stopped = threading.Event()
+        results = None
+        client_id = None
+        try:
+            for flag, client_id, message_id, message in self.__main_loop_client(protocol):
+                if flag == MESSAGE_FLAG['RESULT'] and results is None:
+                    results = threading.Thread(target=self.__stream_results, args=(protocol, send_lock, stopped, str(client_id), json.loads(message)))
+                    results.start()
+                else:
+                    self.__handle_message(flag, client_id, message_id, message, book_publisher, review_publisher, protocol, send_lock)
+        except ConnectionError as e:
+            # The client closes the connection once it has every result.
+            logging.warning(f'Client connection closed: {client_id} ({e})')
+        finally:
+            # Saves the checkpoints still waiting for their batches to be confirmed.
+            connection.flush()
+            stopped.set()
+            if results:
+                results.join()
+            if client_id:
+                self.data_saver.release(client_id)
+            connection.close_connection()
+
+    def __stream_results(self, protocol, send_lock, stopped, client_id, offsets):
+        """
+        Sends the results of the client as soon as they are saved, one query at a time finishing with its EOF,
+        while the client is still uploading. It runs in a thread of the process serving the client with a broker
+        connection of its own. Results consumed here for other clients are saved to their logs, where the processes
+        serving them read them.
+        """
         connection = MessageBroker("rabbitmq")
         result_receiver = ResultReceiver(connection, self.result_queues, callback_result_client, protocol, self.data_saver_results)
-        book_publisher = BookPublisher(connection, 'books_exchange', ExchangeType.fanout, self.data_saver)
-        review_publisher = ReviewPublisher(connection, self.data_saver)
-        client_id = self.__main_loop_client(protocol, router, book_publisher, review_publisher)
-        
-        if self.data_saver_results.get_eof_count(client_id) != RESULTS_BACKLOG:
-            result_receiver.start()
-
-        self.__send_results(protocol, client_id)
-        logging.warning(f'Client connection closed: {client_id} all eof received.')
-        connection.close_connection()
-
-    def __send_results(self, protocol, client_id):
-        results = self.data_saver_results.get(client_id)
-        result_data = {source: "" for source in source_mapping}
-        eof_data = {}
-        client_id = UUID(client_id)
-        for source in source_mapping:
-            result_data[source] = write_csv_to_string(source_mapping[source]["headers"], [])
-
-        
-        for result in results:
-            source = result['source']
-            body = result['body']
-            
-            headers = source_mapping[source]["headers"]
-            key = source_mapping[source]["key"]
-
-            if body.get("type") == "EOF":
-                eof_data[source] = write_csv_to_string([], [])
-                continue
-
-            if source == "author_decades":
-                rows = [[author.strip("'")] for author in body.get("authors", [])]
-            else:
-                rows = [[item[header] for header in headers] for item in body.get(key, [])]
-            
-            result_data[source] += write_csv_to_string([], rows)  
-
-        for source, csv_string in result_data.items():
-            if not csv_string:
-                continue
-            protocol.send_message(MESSAGE_FLAG['RESULT'], client_id, 1, 
-                                  json.dumps({'file': source, 'body': csv_string}))
-        
-        # Send EOF messages
-        for source, csv_string in eof_data.items():
-            protocol.send_message(MESSAGE_FLAG['EOF'], client_id, 2, 
-                                  json.dumps({'file': source, 'body': csv_string}))
-    
+        stream = ResultStream(self.data_saver_results, client_id, offsets)
+        try:
+            while not stopped.is_set():
+                for flag, message_id, message in stream.pending_messages():
+                    with send_lock:
+                        protocol.send_message(flag, UUID(client_id), message_id, message)
+                if stream.is_complete():
+                    logging.warning(f'Client {client_id} all eof received.')
+                    return
+                result_receiver.poll(RESULT_POLL_INTERVAL)
+        finally:
+            stream.close()
+            connection.close_connection()
 
     def __get_checkpoint(self, client_id) -> Tuple[int, dict]:
-        client_checkpoint = self.data_saver.get(client_id)
-        eof_count = 0
-        if MESSAGE_FLAG['BOOK'] in client_checkpoint and client_checkpoint[MESSAGE_FLAG['BOOK']].get('eof'):
-            eof_count += 1
-        if MESSAGE_FLAG['REVIEW'] in client_checkpoint and client_checkpoint[MESSAGE_FLAG['REVIEW']].get('eof'):
-            eof_count += 1
+        return get_checkpoint(self.data_saver, client_id)
 
-        return eof_count, dict(client_checkpoint)
-
-    def __main_loop_client(self, protocol: MessageTransferProtocol, router, book_publisher, review_publisher):
+    def __main_loop_client(self, protocol: MessageTransferProtocol):
+        "Yields the messages of the client until it closes the connection."
         flag, client_id, message_id, message = protocol.receive_message()
-        eof_count, _ = self.__get_checkpoint(client_id)
-        self.router.add_connection(protocol, client_id)
-        eof_count += self.__handle_message(flag, client_id, message_id, message, book_publisher, review_publisher, protocol)
 
-        while eof_count < 2:
+        while True:
+            yield flag, client_id, message_id, message
             flag, client_id, message_id, message = protocol.receive_message()
-            eof_count += self.__handle_message(flag, client_id, message_id, message, book_publisher, review_publisher, protocol)
-        
-        return str(client_id)
 
 
-    def __handle_message(self, flag, client_id, message_id, message, book_publisher, review_publisher, protocol):
-        if flag == MESSAGE_FLAG['BOOK']:
-            return book_publisher.publish(client_id, message_id, message, '')
-        elif flag == MESSAGE_FLAG['REVIEW']:
-            return review_publisher.publish(client_id, message_id, message, 'reviews_queue')
+    def __handle_message(self, flag, client_id, message_id, message, book_publisher, review_publisher, protocol, send_lock):
+        if flag in (MESSAGE_FLAG['BOOK'], MESSAGE_FLAG['REVIEW']):
+            if flag == MESSAGE_FLAG['BOOK']:
+                eof_received = book_publisher.publish(client_id, message_id, message, '')
+            else:
+                eof_received = review_publisher.publish(client_id, message_id, message, 'reviews_queue')
+            if eof_received:
+                # Checkpoints are saved as batches are confirmed, the last ones can't wait for another publish.
+                book_publisher.connection.flush()
+            # The message was handed to the broker, the client may send another one. Its confirm may still be pending,
+            # the checkpoint that lets the client skip it on a retry is only saved once it's confirmed (see after_confirm).
+            with send_lock:
+                protocol.grant_credits(client_id, message_id, 1)
+            return eof_received
         elif flag == MESSAGE_FLAG['CHECKPOINT']:
             _, client_checkpoint = self.__get_checkpoint(client_id)
-            protocol.send_message(MESSAGE_FLAG['CHECKPOINT'], client_id, message_id, json.dumps(client_checkpoint))
+            with send_lock:
+                protocol.send_message(MESSAGE_FLAG['CHECKPOINT'], client_id, message_id, json.dumps(client_checkpoint))
+                protocol.grant_credits(client_id, message_id, self.credit_window)
+            return 0
+        elif flag == MESSAGE_FLAG['HANDSHAKE']:
+            with send_lock:
+                protocol.accept_compression(client_id, message_id, message, self.compression)
             return 0
         else:
             logging.error(f'Unsupported message flag {repr(flag)}')
@@ -168,22 +178,109 @@ class Gateway:
         result_receiver.close()
 
 
-def callback_result_client(self, ch, method, properties, body, queue_name, callback_arg1: RouterProtocol, callback_arg2: DataSaver):
-    body = json.loads(body)
+def callback_result_client(self, ch, method, properties, body, queue_name, callback_arg1: MessageTransferProtocol, callback_arg2: DataSaver):
+    save_result(body, queue_name, callback_arg2, properties)
+    self.connection.acknowledge_message(method.delivery_tag)
+
+
+def save_result(body, queue_name, data_saver: DataSaver, properties=None):
+    "Stores a message read from a result queue and returns the request_id it belongs to."
+    body = decode(body, properties)
     # PENDING: propagate message_id all they way back to the client.
     message_id = body.get('message_id', 1) if isinstance(body, dict) else 1
     request_id = UUID(get_uid(body))
     #logging.warning(f'Received message of length {len(body)} from {queue_name}:\n {body}')
     is_eof = body.get('type') == 'EOF'
     saved_body = {'request_id': request_id, 'message_id': message_id, 'source': queue_name, 'body': body, 'eof': is_eof}
-    callback_arg2.save_message_to_json(saved_body)
-    self.connection.acknowledge_message(method.delivery_tag)
-    if callback_arg2.get_eof_count(request_id) == RESULTS_BACKLOG:
-        ch.stop_consuming()
+    data_saver.save_message_to_json(saved_body)
+    return request_id
+
+
+def get_checkpoint(data_saver: DataSaver, client_id) -> Tuple[int, dict]:
+    "Returns how many files the client already finished uploading and the last message saved for each one."
+    client_checkpoint = data_saver.get(client_id)
+    eof_count = 0
+    if MESSAGE_FLAG['BOOK'] in client_checkpoint and client_checkpoint[MESSAGE_FLAG['BOOK']].get('eof'):
+        eof_count += 1
+    if MESSAGE_FLAG['REVIEW'] in client_checkpoint and client_checkpoint[MESSAGE_FLAG['REVIEW']].get('eof'):
+        eof_count += 1
+
+    return eof_count, dict(client_checkpoint)
+
+
+class ResultStream:
+    """
+    Turns the results saved for a client into the (flag, message_id, message) tuples to send it, as they arrive.
+    Results are first appended to the query files of the client (see QueryResults), starting with the CSV header,
+    and are sent from the offset of each query the client already has in chunks of whole rows.
+    An EOF message follows the last chunk of a finished query.
+    """
+    def __init__(self, data_saver: DataSaver, client_id, offsets):
+        self.data_saver = data_saver
+        self.client_id = str(client_id)
+        self.results = data_saver.query_results(client_id)
+        self.offsets = {source: int(offsets.get(source, 0)) for source in source_mapping}
+        self.finished = set()
+
+    def pending_messages(self):
+        "Yields the messages of the results saved since the last call."
+        self.__update_results()
+        for source, offset in self.offsets.items():
+            if source in self.finished:
+                continue
+            while offset < self.results.size(source):
+                chunk = self.results.read(source, offset, RESULT_CHUNK_BYTES)
+                message = json.dumps({'file': source, 'offset': offset, 'body': chunk.decode('utf-8')})
+                offset += len(chunk)
+                self.offsets[source] = offset
+                yield MESSAGE_FLAG['RESULT'], 1, message
+            if source in self.results.finished:
+                self.finished.add(source)
+                yield MESSAGE_FLAG['EOF'], 2, json.dumps({'file': source, 'body': ''})
+
+    def is_complete(self):
+        return len(self.finished) == RESULTS_BACKLOG
+
+    def __update_results(self):
+        results, log_offset = self.data_saver.read_from(self.client_id, self.results.log_offset, self.results.states)
+        if log_offset == self.results.log_offset:
+            return
+        for result in results:
+            source = result['source']
+            body = result['body']
+            if source in self.results.finished:
+                continue
+            csv_string = '' if self.results.size(source) else write_csv_to_string(source_mapping[source]["headers"], [])
+            if body.get("type") == "EOF":
+                self.results.finish(source)
+            else:
+                csv_string += write_csv_to_string([], result_rows(source, body))
+            if csv_string:
+                self.results.append(source, csv_string.encode('utf-8'))
+        # Once every query is in its file the log is emptied, after recording it, so it doesn't outlive the results.
+        # Records appended afterwards can only be duplicates of finished queries.
+        complete = len(self.results.finished) == RESULTS_BACKLOG
+        self.results.commit(0 if complete else log_offset)
+        if complete:
+            self.data_saver.truncate(self.client_id)
+
+    def close(self):
+        self.results.close()
+
+
+def result_rows(source, body):
+    "Returns the CSV rows of a message read from a result queue."
+    if source == "author_decades":
+        return [[author.strip("'")] for author in body.get("authors", [])]
+    headers = source_mapping[source]["headers"]
+    key = source_mapping[source]["key"]
+    # Results filtered straight from the books keep the layout the books were published in.
+    items = to_rows(body[COLUMNS]) if key == 'items' and COLUMNS in body else body.get(key, [])
+    return [[item[header] for header in headers] for item in items]
 
 
 def callback_result(ch, method, properties, body, queue_name, callback_arg):
-    message = json.loads(body)
+    message = decode(body, properties)
     logging.warning(f'Received message of length {len(body)} from {queue_name}: {message}')
 
     if message.get('type') == 'EOF':
@@ -1,4 +1,5 @@
 from configparser import ConfigParser
+from async_gateway import AsyncGateway
 from gateway import Gateway
 import logging
 import os 
@@ -14,6 +15,13 @@ def get_config_params():
             'log_level': os.getenv('LOG_LEVEL', default=config['DEFAULT'].get('LOG_LEVEL')),
             'records_path': os.getenv('RECORDS_PATH', default=config['DEFAULT'].get('RECORDS_PATH')),
             'results_path': os.getenv('RESULTS_PATH', default=config['DEFAULT'].get('RESULTS_PATH')),
+            'mode': os.getenv('GATEWAY_MODE', default=config['DEFAULT'].get('GATEWAY_MODE', 'process')),
+            'async_loops': int(os.getenv('ASYNC_LOOPS', default=config['DEFAULT'].get('ASYNC_LOOPS', '1'))),
+            'publisher_threads': int(os.getenv('PUBLISHER_THREADS', default=config['DEFAULT'].get('PUBLISHER_THREADS', '4'))),
+            'credit_window': int(os.getenv('CREDIT_WINDOW', default=config['DEFAULT'].get('CREDIT_WINDOW'))),
+            'confirm_window': int(os.getenv('CONFIRM_WINDOW', default=config['DEFAULT'].get('CONFIRM_WINDOW', '0'))),
+            'batch_layout': os.getenv('BATCH_LAYOUT', default=config['DEFAULT'].get('BATCH_LAYOUT', 'rows')),
+            'compression': [codec for codec in os.getenv('COMPRESSION', default=config['DEFAULT'].get('COMPRESSION', '')).split(',') if codec],
         }
         print(config_params)
     except KeyError as e:
@@ -26,21 +34,14 @@ def get_config_params():
 def initialize_log(level=logging.WARNING):
     logging.basicConfig(level=level, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
-def initialize_files(records_path, results_path):
-    if not os.path.exists(records_path):
-        with open(records_path, 'w') as _:
-            pass
-
-    if not os.path.exists(results_path):
-        with open(results_path, 'w') as _:
-            pass
-
 def main():
     config_params = get_config_params()
-    initialize_files(config_params['records_path'], config_params['results_path'])
     initialize_log(config_params['log_level'])
 
-    gateway = Gateway(config_params)
+    if config_params['mode'] == 'asyncio':
+        gateway = AsyncGateway(config_params)
+    else:
+        gateway = Gateway(config_params)
     gateway.start()
 
 if __name__== "__main__":
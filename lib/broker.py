@@ -1,17 +1,82 @@
 from abc import ABC, abstractmethod
+from collections import deque
 from time import sleep, time
 import json
+import os
 import pika
 import signal
+from lib.codec import WireCodecs, encode, reject_undecodable
 from lib.fault_tolerance import save_state
 
 PEER_ANNOUNCEMENT_TIMEOUT = 5
+CONFIRM_WINDOW = 0
 
 class MessageBroker():
-    def __init__(self, hostname):
+    """
+    -confirm_window: if set, the broker confirms every message sent and at most this many can be unconfirmed at once.
+                     Confirms are received asynchronously, flush() waits for all of them. Defaults to the
+                     CONFIRM_WINDOW environment variable, confirms are off if it's 0.
+    -codecs: codec of the batches sent to each exchange (see lib.codec.WireCodecs), from the environment by default.
+    """
+    def __init__(self, hostname, confirm_window=None, codecs=None):
         self.wait_connection()
         self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=hostname))
         self.channel = self.connection.channel()
+        if confirm_window is None:
+            confirm_window = int(os.getenv('CONFIRM_WINDOW', CONFIRM_WINDOW))
+        self.confirm_window = confirm_window
+        self.codecs = codecs or WireCodecs()
+        self.unconfirmed = {}
+        self.rejected = []
+        self.after_confirms = deque()
+        self.delivery_tag = 0
+        self.prefetch_count = 0
+        if self.confirm_window:
+            self.__select_confirms()
+
+    def __select_confirms(self):
+        # BlockingChannel.confirm_delivery waits for the confirm of every message it publishes.
+        # Enabling it on the underlying channel instead delivers the confirms to on_confirm as they arrive.
+        # _impl and _flush_output are pika internals, the version is pinned in base-image/Dockerfile.
+        self.channel._impl.confirm_delivery(ack_nack_callback=self.__on_confirm)
+        self.delivery_tag = 0
+
+    def __on_confirm(self, frame):
+        tag = frame.method.delivery_tag
+        tags = [t for t in self.unconfirmed if t <= tag] if frame.method.multiple else [tag]
+        messages = [self.unconfirmed.pop(t) for t in tags if t in self.unconfirmed]
+        if isinstance(frame.method, pika.spec.Basic.Nack):
+            # The broker could not take them, they are sent again outside of the I/O loop.
+            self.rejected.extend(messages)
+        self.__run_after_confirms()
+
+    def __run_after_confirms(self):
+        if self.rejected:
+            return
+        oldest = min(self.unconfirmed, default=self.delivery_tag + 1)
+        while self.after_confirms and self.after_confirms[0][0] < oldest:
+            _tag, callback = self.after_confirms.popleft()
+            callback()
+
+    def __resend_rejected(self):
+        if not self.rejected:
+            return
+        while self.rejected:
+            self.__publish(*self.rejected.pop(0))
+        # Whatever was waiting for the rejected messages now waits for them to be confirmed again.
+        self.after_confirms = deque((self.delivery_tag, callback) for _tag, callback in self.after_confirms)
+
+    def __publish(self, router_name, routing_key, message, properties=None):
+        # Tracked before publishing, the confirm may be received while the message is being written.
+        self.delivery_tag += 1
+        self.unconfirmed[self.delivery_tag] = (router_name, routing_key, message, properties)
+        self.channel.basic_publish(exchange=router_name, routing_key=routing_key, body=message, properties=properties)
+
+    def __wait_confirms(self, done):
+        # Processes I/O without dispatching deliveries to the consumers, unlike process_data_events,
+        # so it's safe to call from inside a consumer callback.
+        self.connection._flush_output(lambda: done() or self.rejected)
+        self.__resend_rejected()
 
     def create_queue(self, queue_name, persistent, exclusive=False):
         return self.channel.queue_declare(queue=queue_name, durable=persistent, exclusive=exclusive)
@@ -20,7 +85,12 @@ class MessageBroker():
         save_state(id=worker_id)
         queue_name = queue_prefix + '_' + worker_id
         # open a new channel.
+        self.flush()
         self.channel = self.connection.channel()
+        if self.confirm_window:
+            self.__select_confirms()
+        if self.prefetch_count:
+            self.set_prefetch(self.prefetch_count)
         self.channel.queue_declare(queue=queue_name, durable=True)
         self.channel.basic_consume(queue=queue_name, on_message_callback=control_callback)
         # Announce itself to the peers.
@@ -32,10 +102,15 @@ class MessageBroker():
         # Wait for peers to announce themselves before starting the worker.
         channel = self.channel
         def sigalarm_handler(*args):
-            channel.basic_consume(queue=src_queue, on_message_callback=callback)
+            channel.basic_consume(queue=src_queue, on_message_callback=reject_undecodable(callback, self.reject_message))
         signal.signal(signal.SIGALRM, sigalarm_handler)
         signal.alarm(PEER_ANNOUNCEMENT_TIMEOUT)
 
+    def set_prefetch(self, prefetch_count):
+        "Limits the unacked deliveries of the channel, the channel opened by create_control_queue keeps the limit."
+        self.prefetch_count = prefetch_count
+        self.channel.basic_qos(prefetch_count=prefetch_count, global_qos=True)
+
     def create_router(self, router_name, router_type):
         self.channel.exchange_declare(exchange=router_name, exchange_type=router_type)
 
@@ -43,16 +118,60 @@ class MessageBroker():
         self.channel.queue_bind(queue=queue_name, exchange=router_name, routing_key=routing_key)
 
     def set_consumer(self, queue_name, callback):
-        self.channel.basic_consume(queue=queue_name, on_message_callback=callback)
+        "Consumes the queue, messages the callback can't decode are rejected (see lib.codec.reject_undecodable)."
+        self.channel.basic_consume(queue=queue_name, on_message_callback=reject_undecodable(callback, self.reject_message))
+
+    def send_message(self, router_name, routing_key, message="", content_type=None):
+        properties = pika.BasicProperties(content_type=content_type) if content_type else None
+        if not self.confirm_window:
+            self.channel.basic_publish(exchange=router_name, routing_key=routing_key, body=message, properties=properties)
+            return
+        while len(self.unconfirmed) >= self.confirm_window:
+            self.__wait_confirms(lambda: len(self.unconfirmed) < self.confirm_window)
+        self.__publish(router_name, routing_key, message, properties)
 
-    def send_message(self, router_name, routing_key, message=""):
-        self.channel.basic_publish(exchange=router_name, routing_key=routing_key, body=message)
+    def send_batch(self, router_name, routing_key, batch):
+        "Sends a batch encoded with the codec of the exchange, decode it with lib.codec.decode."
+        content_type = self.codecs.content_type(router_name or routing_key)
+        self.send_message(router_name, routing_key, encode(batch, content_type), content_type)
+
+    def flush(self):
+        "Waits until every message sent so far is confirmed. Call it before acking their source or saving a checkpoint."
+        while self.unconfirmed or self.rejected:
+            self.__wait_confirms(lambda: not self.unconfirmed)
+        self.__run_after_confirms()
+
+    def after_confirm(self, callback):
+        """
+        Runs the callback once every message sent so far is confirmed, right away if there are none pending.
+        It may run while processing the connection's I/O, so it must not use the broker.
+        """
+        if not self.unconfirmed and not self.rejected:
+            callback()
+            return
+        self.after_confirms.append((self.delivery_tag, callback))
 
     def begin_consuming(self):
         self.channel.start_consuming()
 
-    def acknowledge_message(self, message_id):
-        self.channel.basic_ack(delivery_tag=message_id)
+    def process_events(self, time_limit):
+        "Runs the callbacks of the deliveries received within `time_limit` seconds, then returns."
+        self.connection.process_data_events(time_limit=time_limit)
+
+    def acknowledge_message(self, message_id, multiple=False):
+        "Doesn't wait for confirms, call flush() first if the delivery sent messages (see Worker.flush_group)."
+        self.channel.basic_ack(delivery_tag=message_id, multiple=multiple)
+
+    def reject_message(self, message_id):
+        "Drops a delivery without requeueing it, it goes to the dead letter exchange of its queue if it has one."
+        self.channel.basic_nack(delivery_tag=message_id, requeue=False)
+
+    def call_later(self, delay, callback):
+        "Runs the callback after `delay` seconds, from the consuming loop. Returns an id to cancel it."
+        return self.connection.call_later(delay, callback)
+
+    def cancel_call(self, call_id):
+        self.connection.remove_timeout(call_id)
     
     def close_connection(self):
         try:
@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+WIRE_CODEC = 'json'
+CODEC_NAMES = {'json': JSON, 'msgpack': MSGPACK}
+
+# Content type -> (encode, decode). Codecs whose library isn't installed are left out.
+CODECS = {JSON: (json.dumps, json.loads)}
+if msgpack:
+    CODECS[MSGPACK] = (msgpack.packb, lambda body: msgpack.unpackb(body, raw=False))
+
+
+class DecodeError(ValueError):
+    "A message whose content type isn't supported or whose body isn't valid for its codec."
+
+
+class WireCodecs:
+    """
+    Codec of the batches sent to each exchange, recorded in the content type of every message so that
+    consumers decode each one with the codec it was encoded with.
+    -WIRE_CODEC: codec of every exchange, json by default.
+    -WIRE_CODECS: codec of specific exchanges, e.g. 'nlp_revs_exchange=msgpack,reviews_queue=msgpack'.
+                  Messages sent through the default exchange are configured by their routing key (the queue).
+    A codec that isn't installed falls back to JSON, which every version decodes. Messages without a content type
+    (e.g. from a producer older than this) are JSON too. To switch an exchange to another codec, deploy its consumers
+    with that codec installed first and then the producers with the new configuration.
+    This rollout order stands in for a negotiation: producers don't ask their consumers which codecs they take.
+    A message a consumer can't decode anyway is rejected without requeueing it (see reject_undecodable).
+    """
+    def __init__(self, default=None, codecs=None):
+        default = default or os.getenv('WIRE_CODEC', WIRE_CODEC)
+        if codecs is None:
+            codecs = dict(entry.split('=', 1) for entry in os.getenv('WIRE_CODECS', '').split(',') if entry)
+        self.default = self.__content_type(default)
+        self.codecs = {exchange: self.__content_type(name) for exchange, name in codecs.items()}
+
+    def __content_type(self, name):
+        content_type = CODEC_NAMES.get(name.strip())
+        if content_type is None:
+            raise ValueError(f"Unknown wire codec '{name}', expected one of {list(CODEC_NAMES)}")
+        if content_type not in CODECS:
+            logging.warning(f"Wire codec '{name}' is not installed, sending JSON instead")
+            return JSON
+        return content_type
+
+    def content_type(self, exchange):
+        return self.codecs.get(exchange, self.default)
+
+
+def encode(message, content_type=JSON):
+    return CODECS[content_type][0](message)
+
+
+def decode(body, properties=None):
+    "Decodes a message with the codec named by its content type, JSON if it has none."
+    content_type = getattr(properties, 'content_type', None) or JSON
+    if content_type not in CODECS:
+        raise DecodeError(f"Unsupported content type '{content_type}', its codec is not installed")
+    try:
+        return CODECS[content_type][1](body)
+    except (ValueError, TypeError) as e:
+        raise DecodeError(f"Invalid '{content_type}' message: {e}") from e
+
+
+def reject_undecodable(callback, reject):
+    """
+    Wraps a consumer callback so a message it can't decode is logged and handed to `reject` with its delivery tag,
+    instead of failing on every redelivery. Callbacks decode their message before doing anything else.
+    """
+    def consume(ch, method, properties, body):
+        try:
+            callback(ch, method, properties, body)
+        except DecodeError as e:
+            logging.error(f"Rejecting message {method.delivery_tag} from '{method.routing_key}': {e}")
+            reject(method.delivery_tag)
+    return consume
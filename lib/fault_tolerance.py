@@ -1,26 +1,106 @@
 import logging
 import json
 import os
+from bisect import bisect_right
+
+STATE_DIR = '/var'
+STATE_FILE = 'worker_state'
+TEMP_STATE_FILE = 'temp_worker_state'
+DELTA_LOG_FILE = 'worker_state.log'
+DELTA_COMPACTION_SIZE = 16 * 1024 * 1024
+FINISHED_REQUESTS_KEPT = 1000
+# Key of the duplicate filter state holding the request of each finished mark, see finish_request.
+FINISHED_MARKS = '__finished__'
 
 def is_duplicate(request_id, message_id, duplicate_filter_state):
     """
     Checks if a message with the same message ID has arrived in the past for that request_id.
-    It also updates the state to reflect that the ID has arrived. It does not save the state, thus it needs to be saved outside of this function.    
+    It also updates the state to reflect that the ID has arrived. It does not save the state, thus it needs to be saved outside of this function.
+    The IDs received are kept as a sorted list of intervals, see received_ids.
     """
-    client_specific_state = duplicate_filter_state.get(request_id, {'pending': [], 'max_id': 0})
+    client_specific_state = duplicate_filter_state.get(request_id)
+    if client_specific_state and 'finished' in client_specific_state:
+        logging.warning(f"Found message with ID '{message_id}' of finished request")
+        return True
+    if client_specific_state is None or 'ids' not in client_specific_state:
+        client_specific_state = {'ids': received_ids(client_specific_state)}
     duplicate_filter_state[request_id] = client_specific_state
-    if message_id > client_specific_state['max_id']:
-        client_specific_state['pending'].extend(pending_id for pending_id in range(client_specific_state['max_id'] + 1, message_id))
-        client_specific_state['max_id'] = message_id
-        return False
+    ids = client_specific_state['ids']
+    position = bisect_right(ids, message_id)
+    if position % 2:
+        # ID is inside an interval, message is a duplicate.
+        logging.warning(f"Found duplicate message with ID '{message_id}'")
+        return True
+    extends_left = position > 0 and ids[position - 1] == message_id
+    extends_right = position < len(ids) and ids[position] == message_id + 1
+    if extends_left and extends_right:
+        del ids[position - 1:position + 1]
+    elif extends_left:
+        ids[position - 1] = message_id + 1
+    elif extends_right:
+        ids[position] = message_id
     else:
-        try:
-            client_specific_state['pending'].remove(message_id)
-            return False
-        except ValueError:
-            # ID is not pending, message is a duplicate.
-            logging.warning(f"Found duplicate message with ID '{message_id}'")
-            return True
+        ids[position:position] = [message_id, message_id + 1]
+    return False
+
+
+def received_ids(client_specific_state=None):
+    """
+    Returns the IDs received as a flat sorted list of half-open intervals: [start, end, start, end, ...].
+    Converts the state saved by previous versions, which listed the pending IDs below the max ID received.
+    """
+    if not client_specific_state:
+        return []
+    ids = []
+    start = 1
+    for pending_id in sorted(client_specific_state['pending']):
+        if pending_id > start:
+            ids += [start, pending_id]
+        start = pending_id + 1
+    if client_specific_state['max_id'] >= start:
+        ids += [start, client_specific_state['max_id'] + 1]
+    return ids
+
+
+def finish_request(request_id, duplicate_filter_state):
+    """
+    Drops the IDs received for a request once its EOF is processed, keeping only a mark
+    so any message of it that arrives afterwards is still a duplicate.
+    Marks are numbered in the order requests finish and only the last FINISHED_REQUESTS_KEPT are kept,
+    a redelivery of a request that finished that many requests ago is no longer expected.
+    The request of each number is kept under FINISHED_MARKS, so the oldest mark is found without scanning them.
+    """
+    marks = duplicate_filter_state.get(FINISHED_MARKS)
+    if marks is None:
+        marks = numbered_marks(duplicate_filter_state)
+        duplicate_filter_state[FINISHED_MARKS] = marks
+    number = marks['next']
+    marks[str(number)] = request_id
+    marks['next'] = number + 1
+    duplicate_filter_state[request_id] = {'finished': number}
+    while marks['next'] - marks['first'] > FINISHED_REQUESTS_KEPT:
+        oldest = marks.pop(str(marks['first']))
+        # Unless it finished again later, under a newer number.
+        if duplicate_filter_state.get(oldest, {}).get('finished') == marks['first']:
+            duplicate_filter_state.pop(oldest)
+        marks['first'] += 1
+
+
+def numbered_marks(duplicate_filter_state):
+    """
+    Numbers the marks of a state saved before FINISHED_MARKS, oldest first. Marks that were never numbered
+    (saved as True) count as the oldest ones.
+    """
+    # dict.items() so a TrackedDict only records the marks renumbered here.
+    finished = sorted(
+        ((int(state['finished']), key) for key, state in dict.items(duplicate_filter_state) if isinstance(state, dict) and 'finished' in state),
+        key=lambda mark: mark[0],
+    )
+    marks = {'first': 1, 'next': len(finished) + 1}
+    for number, (_order, key) in enumerate(finished, 1):
+        marks[str(number)] = key
+        duplicate_filter_state[key] = {'finished': number}
+    return marks
 
 
 def is_repeated(request_id, message_id, duplicate_filter_state):
@@ -34,17 +114,254 @@ def is_repeated(request_id, message_id, duplicate_filter_state):
     return message_id == last_message_id
 
 
+state_dir = os.getenv('WORKER_STATE_DIR', STATE_DIR)
+
+
+def set_state_dir(path):
+    "Changes where the state is saved, for several workers running in the same process (see lib.memory_broker)."
+    global state_dir
+    state_dir = path
+
+
+def state_path(file_name):
+    return os.path.join(state_dir, file_name)
+
+
 def save_state(**kwargs):
     "Saves whatever data the worker needs to be atomically saved."
     state = json.dumps(kwargs)
-    with open('/var/temp_worker_state', 'w') as statefile:
+    with open(state_path(TEMP_STATE_FILE), 'w') as statefile:
         statefile.write(state)
-    os.replace('/var/temp_worker_state', '/var/worker_state')
+        statefile.flush()
+        os.fsync(statefile.fileno())
+    os.replace(state_path(TEMP_STATE_FILE), state_path(STATE_FILE))
 
 
 def load_state():
     try:
-        with open('/var/worker_state', 'r') as statefile:
+        with open(state_path(STATE_FILE), 'r') as statefile:
             return json.load(statefile)
     except:
         return {}
+
+
+class TrackedDict(dict):
+    """
+    Dict that records which keys were read or written since the last delta, since values read may be mutated in place.
+    Iterating its values() or items() counts as reading every key. A value must be mutated before the next delta
+    after it was read, a reference kept across deltas and mutated later is not saved.
+    """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.touched = set()
+        self.rewritten = False
+
+    def __getitem__(self, key):
+        self.touched.add(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.touched.add(key)
+        return super().get(key, default)
+
+    def __setitem__(self, key, value):
+        self.touched.add(key)
+        super().__setitem__(key, value)
+
+    def setdefault(self, key, default=None):
+        self.touched.add(key)
+        return super().setdefault(key, default)
+
+    def values(self):
+        self.touched.update(self)
+        return super().values()
+
+    def items(self):
+        self.touched.update(self)
+        return super().items()
+
+    def __delitem__(self, key):
+        self.touched.add(key)
+        super().__delitem__(key)
+
+    def pop(self, key, *default):
+        self.touched.add(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        self.rewritten = True
+        return super().popitem()
+
+    def clear(self):
+        self.rewritten = True
+        super().clear()
+
+    def update(self, *args, **kwargs):
+        self.rewritten = True
+        super().update(*args, **kwargs)
+
+    def delta(self):
+        "Returns the changes since the last delta as ('set', value) or ('update', {'set': ..., 'deleted': ...})."
+        if self.rewritten:
+            change = ('set', dict(self))
+        else:
+            change = ('update', {
+                'set': {key: super(TrackedDict, self).__getitem__(key) for key in self.touched if key in self},
+                'deleted': [key for key in self.touched if key not in self],
+            })
+        self.touched = set()
+        self.rewritten = False
+        return change
+
+
+class TrackedList(list):
+    "List that records what was appended since the last delta. Any other change rewrites it whole."
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.saved = len(self)
+        self.rewritten = False
+
+    def __rewrite(method):
+        def rewriting(self, *args, **kwargs):
+            self.rewritten = True
+            return method(self, *args, **kwargs)
+        return rewriting
+
+    __setitem__ = __rewrite(list.__setitem__)
+    __delitem__ = __rewrite(list.__delitem__)
+    __imul__ = __rewrite(list.__imul__)
+    insert = __rewrite(list.insert)
+    remove = __rewrite(list.remove)
+    pop = __rewrite(list.pop)
+    clear = __rewrite(list.clear)
+    sort = __rewrite(list.sort)
+    reverse = __rewrite(list.reverse)
+    del __rewrite
+
+    def delta(self):
+        "Returns the changes since the last delta as ('set', value) or ('extend', items)."
+        change = ('set', list(self)) if self.rewritten or len(self) < self.saved else ('extend', self[self.saved:])
+        self.saved = len(self)
+        self.rewritten = False
+        return change
+
+
+class DeltaAccumulator(dict):
+    """
+    State keyed by request_id that can be saved as the changes made to it since it was last saved (see DeltaState).
+    The value of each request is tracked once it's been saved. Until then (e.g. right after being assigned)
+    it's left as the caller set it, since the caller may still hold it, and it's saved whole.
+    """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.replaced = set(self)
+        self.dropped = set()
+
+    def __setitem__(self, key, value):
+        if super().get(key) is not value:
+            self.replaced.add(key)
+            self.dropped.discard(key)
+        super().__setitem__(key, value)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return super().__getitem__(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.replaced.discard(key)
+        self.dropped.add(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.replaced.discard(key)
+            self.dropped.add(key)
+        return super().pop(key, *default)
+
+    def delta(self):
+        "Returns the changes made since the last delta, and starts tracking the values saved whole."
+        changes = {'drop': list(self.dropped), 'set': {}, 'update': {}, 'extend': {}}
+        for key, value in self.items():
+            if key in self.replaced:
+                changes['set'][key] = value
+                super().__setitem__(key, tracked(value))
+            elif isinstance(value, (TrackedDict, TrackedList)):
+                change, content = value.delta()
+                # Values emptied in place are set to empty, only empty updates and extensions are skipped.
+                if change == 'set' or content:
+                    changes[change][key] = content
+        self.replaced = set()
+        self.dropped = set()
+        return changes
+
+
+def tracked(value):
+    if isinstance(value, dict):
+        return TrackedDict(value)
+    if isinstance(value, list):
+        return TrackedList(value)
+    return value
+
+
+def apply_delta(state: dict, changes):
+    "Applies the changes returned by DeltaAccumulator.delta to a plain dict."
+    for key in changes['drop']:
+        state.pop(key, None)
+    state.update(changes['set'])
+    for key, content in changes['update'].items():
+        value = state.setdefault(key, {})
+        value.update(content['set'])
+        for deleted in content['deleted']:
+            value.pop(deleted, None)
+    for key, items in changes['extend'].items():
+        state.setdefault(key, []).extend(items)
+
+
+class DeltaState:
+    """
+    Saves DeltaAccumulators as an append-only log of their changes, on top of the last snapshot saved with save_state.
+    Every record carries a sequence number and the snapshot the last one it includes, so records that made it into
+    the snapshot are skipped if the log couldn't be truncated after it. Once the log outgrows `compaction_size`
+    a new snapshot is saved and the log starts over.
+    """
+    def __init__(self, path=None, compaction_size=DELTA_COMPACTION_SIZE):
+        self.path = path or state_path(DELTA_LOG_FILE)
+        self.compaction_size = compaction_size
+        self.seq = 0
+
+    def load(self):
+        "Returns the last snapshot with the changes logged after it applied, as plain dicts."
+        state = load_state()
+        self.seq = state.get('delta_seq', 0)
+        try:
+            with open(self.path, 'r') as log:
+                for line in log:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn record at the end of the log, it was never acknowledged.
+                        continue
+                    if record['seq'] <= self.seq:
+                        continue
+                    for name, changes in record['changes'].items():
+                        apply_delta(state.setdefault(name, {}), changes)
+                    self.seq = record['seq']
+        except FileNotFoundError:
+            pass
+        return state
+
+    def save(self, **accumulators):
+        self.seq += 1
+        record = {'seq': self.seq, 'changes': {name: accumulator.delta() for name, accumulator in accumulators.items()}}
+        with open(self.path, 'a') as log:
+            log.write(json.dumps(record) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+            size = log.tell()
+        if size >= self.compaction_size:
+            save_state(delta_seq=self.seq, **accumulators)
+            os.truncate(self.path, 0)
+            # Encoding the snapshot iterated the items of every value, which isn't a change to log.
+            for accumulator in accumulators.values():
+                accumulator.delta()
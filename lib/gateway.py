@@ -1,37 +1,38 @@
-from io import StringIO
-from csv import DictReader
 import logging
-import json
 
+from lib.projection import ITEMS_KEY, encode_batch, project_columns, project_rows
+from lib.schema import ID_COLUMNS, PROJECTIONS
 from lib.transfer.transfer_protocol import MESSAGE_FLAG
+from lib.workers.records import BATCH_LAYOUT, COLUMNS
 
 MAX_KEY_LENGTH = 255
 
+
+def project_batch(message_csv, columns, layout):
+    "Returns the key and JSON of the items of a batch in the given layout, with their IDs, and whether it held the EOF."
+    if layout == COLUMNS:
+        return project_columns(message_csv, columns, ID_COLUMNS)
+    items, eof_received = project_rows(message_csv, columns, ID_COLUMNS)
+    return ITEMS_KEY, items, eof_received
+
+
 class BookPublisher():
-    def __init__(self, connection, dst_exchange, dst_exchange_type, data_saver):
+    def __init__(self, connection, dst_exchange, dst_exchange_type, data_saver, layout=BATCH_LAYOUT):
         self.data_saver = data_saver
         self.connection = connection
+        self.layout = layout
         self.exchange = dst_exchange
         self.connection.create_router(dst_exchange, dst_exchange_type)
 
     def publish(self, client_id, message_id, message_csv, routing_key):
-        eof_received = False
-        reader = DictReader(StringIO(message_csv))
-        rows = []
-        for row in reader:
-            if row.get('type') == 'EOF':
-                logging.warning(f'{client_id} EOF received')
-                row = {'type': 'EOF'}
-                eof_received = True
-            else:
-                row = {'Title': row['Title'], 'publishedDate': row['publishedDate'], 'categories': row['categories'], 'authors': row['authors']}
-            rows.append(row)
-
-        batch_message = {'request_id': str(client_id), 'message_id': message_id, 'items': rows}
-        self.connection.send_message(self.exchange, routing_key, json.dumps(batch_message))
+        key, items, eof_received = project_batch(message_csv, PROJECTIONS[MESSAGE_FLAG['BOOK']], self.layout)
+        if eof_received:
+            logging.warning(f'{client_id} EOF received')
+        self.connection.send_message(self.exchange, routing_key, encode_batch(client_id, message_id, items, key))
 
         message = {'request_id': str(client_id), 'message_id': message_id, 'source': MESSAGE_FLAG['BOOK'], 'eof': eof_received}
-        self.data_saver.save_message_to_json(message)
+        # The checkpoint must not get ahead of the broker, or an unconfirmed batch would never be sent again.
+        self.connection.after_confirm(lambda: self.data_saver.save_message_to_json(message))
         return eof_received
 
     def close(self):
@@ -39,27 +40,19 @@ class BookPublisher():
         self.connection.connection.close()
 
 class ReviewPublisher():
-    def __init__(self, connection, data_saver):
+    def __init__(self, connection, data_saver, layout=BATCH_LAYOUT):
         self.data_saver = data_saver
         self.connection = connection
+        self.layout = layout
 
     def publish(self, client_id, message_id, message_csv, routing_key):
-        eof_received = False
-        reader = DictReader(StringIO(message_csv))
-        rows = []
-        for row in reader:
-            if row.get('type') == 'EOF':
-                logging.warning(f'{client_id} EOF received')
-                row = {'type': 'EOF'}
-                eof_received = True
-            else:
-                row = {'Title': row['Title'], 'review/text': row['review/text']}
-            rows.append(row)
-        batch_message = {'request_id': str(client_id), 'message_id': message_id, 'items': rows}
-        self.connection.send_message('', routing_key, json.dumps(batch_message))
+        key, items, eof_received = project_batch(message_csv, PROJECTIONS[MESSAGE_FLAG['REVIEW']], self.layout)
+        if eof_received:
+            logging.warning(f'{client_id} EOF received')
+        self.connection.send_message('', routing_key, encode_batch(client_id, message_id, items, key))
         
         message = {'request_id': str(client_id), 'message_id': message_id, 'source': MESSAGE_FLAG['REVIEW'], 'eof': eof_received}
-        self.data_saver.save_message_to_json(message)
+        self.connection.after_confirm(lambda: self.data_saver.save_message_to_json(message))
         return eof_received
 
     def close(self):
@@ -84,6 +77,9 @@ class ResultReceiver():
     
     def start(self):
         self.connection.begin_consuming()
+
+    def poll(self, time_limit):
+        self.connection.process_events(time_limit)
     
     def close(self):
         self.connection.channel.close()
@@ -0,0 +1,279 @@
+from collections import deque
+from heapq import heappop, heappush
+from types import SimpleNamespace
+import json
+import os
+from lib.broker import PEER_ANNOUNCEMENT_TIMEOUT
+from lib.codec import WireCodecs, encode, reject_undecodable
+from lib.fault_tolerance import save_state, set_state_dir
+
+DEFAULT_EXCHANGE = ''
+
+
+def topic_matches(pattern, routing_key):
+    "Topic exchange matching: words are separated by dots, * matches one word and # zero or more."
+    def matches(pattern_words, words):
+        if not pattern_words:
+            return not words
+        if pattern_words[0] == '#':
+            return any(matches(pattern_words[1:], words[i:]) for i in range(len(words) + 1))
+        if not words:
+            return False
+        return pattern_words[0] in ('*', words[0]) and matches(pattern_words[1:], words[1:])
+    return matches(pattern.split('.'), routing_key.split('.'))
+
+
+class MemoryServer:
+    """
+    Exchanges and queues shared by every InMemoryBroker connected to it, standing in for RabbitMQ.
+    Everything runs in the calling thread: run() dispatches one delivery at a time, taking turns between
+    the queues with messages ready, and only fires timers once there is nothing left to deliver.
+    Timers run on a virtual clock, so a run doesn't depend on how long the callbacks take.
+    """
+    def __init__(self):
+        self.exchanges = {DEFAULT_EXCHANGE: ('direct', [])}
+        self.queues = {}
+        self.consumers = {}
+        self.ready = deque()
+        self.timers = []
+        self.timer_count = 0
+        self.clock = 0.0
+        self.running = False
+        self.stopped = False
+
+    def declare_queue(self, queue_name):
+        if not queue_name:
+            # Server named queue, like RabbitMQ does for an empty name.
+            queue_name = f'amq.gen-{len(self.queues)}'
+        self.queues.setdefault(queue_name, deque())
+        return queue_name
+
+    def delete_queue(self, queue_name):
+        self.queues.pop(queue_name, None)
+        self.consumers.pop(queue_name, None)
+        for _type, bindings in self.exchanges.values():
+            bindings[:] = [binding for binding in bindings if binding[0] != queue_name]
+
+    def declare_exchange(self, exchange_name, exchange_type):
+        self.exchanges.setdefault(exchange_name, (getattr(exchange_type, 'value', exchange_type), []))
+
+    def bind(self, queue_name, exchange_name, routing_key):
+        _type, bindings = self.exchanges[exchange_name]
+        if (queue_name, routing_key) not in bindings:
+            bindings.append((queue_name, routing_key))
+
+    def consume(self, queue_name, connection, callback):
+        self.consumers.setdefault(queue_name, deque()).append((connection, callback))
+        self.__mark_ready(queue_name)
+
+    def publish(self, exchange_name, routing_key, body, content_type=None):
+        if exchange_name not in self.exchanges:
+            raise ValueError(f"no exchange '{exchange_name}'")
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        for queue_name in self.__route(exchange_name, routing_key):
+            self.queues[queue_name].append((exchange_name, routing_key, body, content_type))
+            self.__mark_ready(queue_name)
+
+    def __route(self, exchange_name, routing_key):
+        if exchange_name == DEFAULT_EXCHANGE:
+            return [routing_key] if routing_key in self.queues else []
+        exchange_type, bindings = self.exchanges[exchange_name]
+        if exchange_type == 'fanout':
+            matching = [queue for queue, _key in bindings]
+        elif exchange_type == 'topic':
+            matching = [queue for queue, key in bindings if topic_matches(key, routing_key)]
+        else:
+            matching = [queue for queue, key in bindings if key == routing_key]
+        # A queue gets a single copy even if more than one of its bindings match.
+        return list(dict.fromkeys(matching))
+
+    def __mark_ready(self, queue_name):
+        if queue_name not in self.ready:
+            self.ready.append(queue_name)
+
+    def call_later(self, delay, connection, callback):
+        self.timer_count += 1
+        timer = [self.clock + delay, self.timer_count, connection, callback]
+        heappush(self.timers, timer)
+        return timer
+
+    def cancel_call(self, timer):
+        # Cancelled timers stay in the heap until their turn, without a callback.
+        timer[3] = None
+
+    def run(self):
+        "Dispatches deliveries and timers until there's nothing left to do or a consumer stops consuming."
+        if self.running:
+            # Called from inside a callback, the outer run goes on once it returns.
+            return
+        self.running = True
+        self.stopped = False
+        try:
+            while not self.stopped and (self.__deliver_one() or self.__fire_timer()):
+                pass
+        finally:
+            self.running = False
+
+    def stop(self):
+        self.stopped = True
+
+    def __deliver_one(self):
+        for _ in range(len(self.ready)):
+            queue_name = self.ready.popleft()
+            messages = self.queues.get(queue_name)
+            if not messages:
+                continue
+            consumer = self.__available_consumer(queue_name)
+            self.ready.append(queue_name)
+            if consumer:
+                connection, callback = consumer
+                connection.deliver(callback, *messages.popleft())
+                return True
+        return False
+
+    def __available_consumer(self, queue_name):
+        consumers = self.consumers.get(queue_name, ())
+        for _ in range(len(consumers)):
+            consumers.rotate(-1)
+            connection, callback = consumers[-1]
+            if connection.can_receive():
+                return connection, callback
+        return None
+
+    def __fire_timer(self):
+        while self.timers:
+            when, _count, connection, callback = heappop(self.timers)
+            if callback is None:
+                continue
+            self.clock = max(self.clock, when)
+            connection.run_callback(callback)
+            return True
+        return False
+
+
+class MemoryChannel:
+    "The few channel operations the workers and the gateway use directly."
+    def __init__(self, broker):
+        self.broker = broker
+
+    def basic_qos(self, prefetch_count=0, global_qos=False):
+        self.broker.prefetch_count = prefetch_count
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.broker.acknowledge_message(delivery_tag, multiple)
+
+    def queue_delete(self, queue):
+        self.broker.server.delete_queue(queue)
+
+    def stop_consuming(self):
+        self.broker.server.stop()
+
+    def close(self):
+        pass
+
+
+class InMemoryBroker:
+    """
+    Drop-in replacement of MessageBroker backed by a MemoryServer, to run the workers and the gateway
+    publishers in a single process without RabbitMQ. Publishing is confirmed right away.
+    -state_dir: where the worker using this connection saves its state. Workers load their state when
+                they are built, so each worker must be built right after its connection.
+    """
+    def __init__(self, server, state_dir=None, codecs=None):
+        self.server = server
+        self.state_dir = state_dir
+        self.codecs = codecs or WireCodecs()
+        self.channel = MemoryChannel(self)
+        self.connection = self.channel
+        self.prefetch_count = 0
+        self.delivery_tag = 0
+        self.unacked = set()
+        self.__use_state_dir()
+
+    def __use_state_dir(self):
+        if self.state_dir:
+            os.makedirs(self.state_dir, exist_ok=True)
+            set_state_dir(self.state_dir)
+
+    def can_receive(self):
+        return not self.prefetch_count or len(self.unacked) < self.prefetch_count
+
+    def deliver(self, callback, exchange_name, routing_key, body, content_type=None):
+        self.delivery_tag += 1
+        self.unacked.add(self.delivery_tag)
+        method = SimpleNamespace(delivery_tag=self.delivery_tag, exchange=exchange_name, routing_key=routing_key, redelivered=False)
+        properties = SimpleNamespace(content_type=content_type, headers=None)
+        self.run_callback(lambda: callback(self.channel, method, properties, body))
+
+    def run_callback(self, callback):
+        self.__use_state_dir()
+        callback()
+
+    def create_queue(self, queue_name, persistent, exclusive=False):
+        queue_name = self.server.declare_queue(queue_name)
+        return SimpleNamespace(method=SimpleNamespace(queue=queue_name, message_count=len(self.server.queues[queue_name])))
+
+    def create_control_queue(self, queue_prefix, control_callback, src_queue, callback, worker_id):
+        self.__use_state_dir()
+        save_state(id=worker_id)
+        queue_name = queue_prefix + '_' + worker_id
+        self.create_queue(queue_name, True)
+        self.set_consumer(queue_name, control_callback)
+        # Announce itself to the peers.
+        router_name = queue_prefix
+        self.create_router(router_name, 'fanout')
+        self.link_queue(queue_name, router_name, router_name)
+        message = {'type': 'NEW_PEER', 'sender_id': worker_id}
+        self.send_message(router_name, router_name, json.dumps(message))
+        # Timers only fire once every delivery is done, so the peers have announced themselves by then.
+        self.call_later(PEER_ANNOUNCEMENT_TIMEOUT, lambda: self.set_consumer(src_queue, callback))
+
+    def set_prefetch(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+    def create_router(self, router_name, router_type):
+        self.server.declare_exchange(router_name, router_type)
+
+    def link_queue(self, queue_name, router_name, routing_key=None):
+        self.server.bind(queue_name, router_name, routing_key)
+
+    def set_consumer(self, queue_name, callback):
+        self.server.consume(queue_name, self, reject_undecodable(callback, self.reject_message))
+
+    def send_message(self, router_name, routing_key, message="", content_type=None):
+        self.server.publish(router_name, routing_key, message, content_type)
+
+    def send_batch(self, router_name, routing_key, batch):
+        content_type = self.codecs.content_type(router_name or routing_key)
+        self.send_message(router_name, routing_key, encode(batch, content_type), content_type)
+
+    def flush(self):
+        pass
+
+    def after_confirm(self, callback):
+        callback()
+
+    def begin_consuming(self):
+        self.server.run()
+
+    def process_events(self, time_limit):
+        self.server.run()
+
+    def acknowledge_message(self, message_id, multiple=False):
+        if multiple:
+            self.unacked = {tag for tag in self.unacked if tag > message_id}
+        else:
+            self.unacked.discard(message_id)
+
+    def reject_message(self, message_id):
+        self.unacked.discard(message_id)
+
+    def call_later(self, delay, callback):
+        return self.server.call_later(delay, self, callback)
+
+    def cancel_call(self, call_id):
+        self.server.cancel_call(call_id)
+
+    def close_connection(self):
+        pass
@@ -0,0 +1,105 @@
+from csv import reader
+from io import StringIO
+from itertools import chain
+from json.encoder import encode_basestring_ascii as encode_string
+from operator import itemgetter
+
+EOF_ITEM = '{"type": "EOF"}'
+ITEMS_KEY = 'items'
+COLUMNS_KEY = 'columns'
+
+
+def project_rows(message_csv, columns, ids=None):
+    """
+    Parses a CSV batch keeping only `columns` and returns the JSON array of its rows and whether it held the EOF.
+    The JSON is written directly from the CSV fields, but it's the same json.dumps gives for the list of dicts.
+    Quoted fields spanning several lines are supported, and as with csv.DictReader empty lines are skipped
+    and missing fields become null.
+    `ids` adds integer columns computed from a field of each row, as {column: (source column, function)}.
+    """
+    rows = reader(StringIO(message_csv, newline=''))
+    header = next(rows, None)
+    if header is None:
+        return '[]', False
+    columns = [column for column in columns if column in header]
+    indices = [header.index(column) for column in columns]
+    id_columns = id_sources(header, ids)
+
+    if 'type' not in header and indices:
+        try:
+            return project_regular_rows(rows, columns, indices, id_columns), False
+        except IndexError:
+            # There are empty or incomplete rows, parse it again row by row.
+            rows = reader(StringIO(message_csv, newline=''))
+            next(rows)
+    return project_any_rows(rows, header, columns, indices, id_columns)
+
+
+def project_columns(message_csv, columns, ids=None):
+    """
+    Like project_rows, but returns the batch in the columnar layout of lib.workers.records: a JSON object with
+    the array of values of each column. Returns the key of the batch it goes under, the JSON and whether it held the EOF.
+    Batches holding the EOF, or with empty or incomplete rows, are returned as rows.
+    """
+    rows = list(reader(StringIO(message_csv, newline='')))
+    header = rows[0] if rows else []
+    columns = [column for column in columns if column in header]
+    indices = [header.index(column) for column in columns]
+    if 'type' not in header and indices:
+        try:
+            id_columns = id_sources(header, ids)
+            values = [', '.join(map(encode_string, map(itemgetter(index), rows[1:]))) for index in indices]
+            values += [', '.join(map(str, map(fn, map(itemgetter(index), rows[1:])))) for _column, (index, fn) in id_columns]
+            keys = columns + [column for column, _source in id_columns]
+            return COLUMNS_KEY, '{' + ', '.join(f'{encode_string(key)}: [{key_json}]' for key, key_json in zip(keys, values)) + '}', False
+        except IndexError:
+            pass
+    items_json, eof_received = project_rows(message_csv, columns, ids)
+    return ITEMS_KEY, items_json, eof_received
+
+
+def id_sources(header, ids):
+    "Returns the ID columns whose source column is in the header, with its index."
+    return [(column, (header.index(source), fn)) for column, (source, fn) in (ids or {}).items() if source in header]
+
+
+def project_regular_rows(rows, columns, indices, id_columns=()):
+    """
+    Fast path for batches where every row has all the columns. The work per row is done by chained
+    C iterators: pick the fields, escape them and fill a template with the keys already in place.
+    """
+    keys = columns + [column for column, _source in id_columns]
+    template = '{' + ', '.join(encode_string(key) + ': %s' for key in keys) + '}'
+    pick = itemgetter(*indices) if len(indices) > 1 else lambda row: (row[indices[0]],)
+    if id_columns:
+        # The ID of each row is appended to its escaped fields.
+        rows = list(rows)
+        ids = [map(str, map(fn, map(itemgetter(index), rows))) for _column, (index, fn) in id_columns]
+        fields = chain.from_iterable(map(chain, map(lambda row: map(encode_string, pick(row)), rows), zip(*ids)))
+    else:
+        fields = map(encode_string, chain.from_iterable(map(pick, rows)))
+    return '[' + ', '.join(map(template.__mod__, zip(*[fields] * len(keys)))) + ']'
+
+
+def project_any_rows(rows, header, columns, indices, id_columns=()):
+    fields = [(encode_string(column) + ': ', index) for column, index in zip(columns, indices)]
+    id_fields = [(encode_string(column) + ': ', index, fn) for column, (index, fn) in id_columns]
+    type_index = header.index('type') if 'type' in header else None
+    items = []
+    eof_received = False
+    for row in rows:
+        if not row:
+            continue
+        if type_index is not None and type_index < len(row) and row[type_index] == 'EOF':
+            items.append(EOF_ITEM)
+            eof_received = True
+            continue
+        values = [key + (encode_string(row[index]) if index < len(row) else 'null') for key, index in fields]
+        values += [key + (str(fn(row[index])) if index < len(row) else 'null') for key, index, fn in id_fields]
+        items.append('{' + ', '.join(values) + '}')
+    return '[' + ', '.join(items) + ']', eof_received
+
+
+def encode_batch(request_id, message_id, items_json, key=ITEMS_KEY):
+    "Wraps the JSON returned by project_rows or project_columns the same way json.dumps encodes a batch."
+    return f'{{"request_id": {encode_string(str(request_id))}, "message_id": {int(message_id)}, {encode_string(key)}: {items_json}}}'
@@ -0,0 +1,63 @@
+from lib.sharding import stable_hash
+from lib.transfer.transfer_protocol import MESSAGE_FLAG
+
+# Columns of each uploaded file that the system uses, the client may drop any other column before sending.
+PROJECTIONS = {
+    MESSAGE_FLAG['BOOK']: ['Title', 'publishedDate', 'categories', 'authors'],
+    MESSAGE_FLAG['REVIEW']: ['Title', 'review/text'],
+}
+
+TITLE_ID = 'title_id'
+
+
+def title_id(title):
+    "64-bit ID of a title. Unlike hash() it's the same in every process, so books and reviews get the same one."
+    return stable_hash(title)
+
+
+# Columns the gateway adds to every batch, as {column: (column it's computed from, function)}.
+# Stages join and group by title on its ID, the title itself is only read to build the results.
+ID_COLUMNS = {TITLE_ID: ('Title', title_id)}
+
+
+def row_title_id(row):
+    "Title ID of an item. Items queued by versions before title IDs only have the title."
+    return row[TITLE_ID] if TITLE_ID in row else title_id(row['Title'])
+
+
+def title_id_values(records):
+    "Title IDs of the items of a batch in either layout (see lib.workers.records), like row_title_id."
+    if isinstance(records, dict):
+        return records[TITLE_ID] if TITLE_ID in records else [title_id(title) for title in records.get('Title', [])]
+    return [row_title_id(row) for row in records]
+
+
+def title_id_keys(accumulator, legacy_value):
+    """
+    State is saved as JSON, which turns the title IDs used as keys into strings. Turns them back once it's loaded.
+    State saved by versions before title IDs is keyed by the title itself: `legacy_value(title, value)` returns
+    the value to keep under its ID, or None if the value already is in the current shape.
+    """
+    for request_id, values in list(accumulator.items()):
+        converted = {}
+        for key, value in values.items():
+            new_value = legacy_value(key, value)
+            if new_value is None:
+                converted[int(key)] = value
+            else:
+                converted[title_id(key)] = new_value
+        accumulator[request_id] = converted
+    return accumulator
+
+
+def title_ids(values):
+    "IDs of a list of titles, which holds the titles themselves if it was saved or sent by a version before title IDs."
+    return [title_id(value) if isinstance(value, str) else value for value in values]
+
+
+def title_id_lists(state):
+    "Turns the lists of titles of each request saved by versions before title IDs into sorted lists of their IDs."
+    for request_id, values in state.items():
+        if any(isinstance(value, str) for value in values):
+            state[request_id] = sorted(set(title_ids(values)))
+    return state
@@ -0,0 +1,28 @@
+from hashlib import blake2b
+
+# The stages after the shards number their results from 1 and finish a request on its first EOF,
+# so a single shard is used until the results of several shards are merged.
+SHARD_COUNT = 1
+SHARD_ID = 0
+
+
+def stable_hash(key):
+    """
+    64-bit hash of a string, the same in every process and every run unlike hash(), which is salted per process.
+    Integer keys (e.g. title IDs, see lib.schema) are already hashes and are returned as they are.
+    """
+    if isinstance(key, int):
+        return key
+    return int.from_bytes(blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class Sharder:
+    "Picks the shard of each key from its stable hash, the same one in every replica of a sharder."
+    def __init__(self, shard_count=SHARD_COUNT):
+        self.shard_count = shard_count
+
+    def shards(self):
+        return range(self.shard_count)
+
+    def shard(self, key):
+        return stable_hash(key) % self.shard_count
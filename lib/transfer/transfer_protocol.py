@@ -1,9 +1,11 @@
-from multiprocessing import Manager
 from socket import socket
 from typing import Tuple
+import asyncio
 import logging
+import lzma
 import struct # for encoding
 import uuid
+import zlib
 
 MESSAGE_FLAG = {
     'BOOK': 1,
@@ -12,82 +14,252 @@ MESSAGE_FLAG = {
     'EOF': 4,
     'CHECKPOINT': 5,
     'END_RESULT': 6,
-    'ERROR': 7
+    'ERROR': 7,
+    'HANDSHAKE': 8,
+    'CREDIT': 9
+}
+
+# Set on the flag byte when the message body was compressed with the negotiated codec.
+COMPRESSED_FLAG = 0x80
+COMPRESSION_THRESHOLD = 1024
+COMPRESSORS = {
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
 }
 
 BYTES_HEADER_SIZE = 4
 MESSAGE_HEADER_SIZE = 1 + 16 + 4 # flag + client_uuid + message_id.
+INITIAL_BUFFER_SIZE = 64 * 1024
 
 class ByteTransferProtocol:
     def __init__(self, conn: socket):
         self.conn = conn
+        # Frames are received into this buffer, which only grows when a bigger frame arrives.
+        self.buffer = bytearray(INITIAL_BUFFER_SIZE)
+        self.header = bytearray(BYTES_HEADER_SIZE)
 
     def send_bytes(self, payload: bytes):
         """
         Sends bytes given a socket connection avoiding short writes
         """
+        return self.send_frame(payload)
+
+    def send_frame(self, *chunks):
+        """
+        Sends the chunks as a single frame using scatter-gather IO, so the
+        length header and the payload are never concatenated in memory.
+        """
+        views = [memoryview(chunk).cast('B') for chunk in chunks]
+        length = sum(len(view) for view in views)
+        views.insert(0, memoryview(struct.pack('!L', length)))
+        total = length + BYTES_HEADER_SIZE
         total_sent = 0
-        length = struct.pack('!L', len(payload))
-        full_message = length + payload
 
         try:
-            while total_sent < len(full_message):
-                sent = self.conn.send(full_message[total_sent:])
+            while views:
+                sent = self.conn.sendmsg(views)
                 total_sent += sent
+                while views and sent >= len(views[0]):
+                    sent -= len(views[0])
+                    views.pop(0)
+                if views and sent:
+                    views[0] = views[0][sent:]
         except OSError as e:
             logging.error(f"Error while sending message: {e}")
             return None
-        return total_sent
+        return total_sent if total_sent == total else None
 
-    def read_header(self) -> Tuple[int,bytes]:
+    def receive_into(self, view: memoryview):
+        """
+        Fills the given view from the socket avoiding short reads.
+        """
+        received = 0
+        while received < len(view):
+            chunk_size = self.conn.recv_into(view[received:])
+            if not chunk_size:
+                raise ConnectionError("Connection closed by peer")
+            received += chunk_size
+
+    def read_header(self) -> int:
         """
         Reads the header indicating the amount of bytes that follow.
         """
-        buffer = b''
-        while len(buffer) < BYTES_HEADER_SIZE:
-            chunk = self.conn.recv(BYTES_HEADER_SIZE - len(buffer))
-            buffer += chunk
-        
-        length, payload = buffer[:4], buffer[4:]
-        return struct.unpack('!L', length)[0], payload
+        self.receive_into(memoryview(self.header))
+        return struct.unpack('!L', self.header)[0]
 
-    def receive_bytes(self) -> bytes:
+    def receive_bytes(self) -> memoryview:
         """
-        Receives bytes from a socket avoiding short reads
+        Receives bytes from a socket avoiding short reads.
+        The returned view is only valid until the next call, copy it if it must be kept.
         """
-        length, buffer = self.read_header()
-        while len(buffer) < length:
-            buffer += self.conn.recv(length - len(buffer))
-        return buffer
+        length = self.read_header()
+        if length > len(self.buffer):
+            self.buffer = bytearray(max(length, 2 * len(self.buffer)))
+        view = memoryview(self.buffer)[:length]
+        self.receive_into(view)
+        return view
+
+
+class ProtocolError(ConnectionError):
+    "A frame that doesn't follow the protocol. The connection is dropped, like one the peer closed."
+
+
+def register_compressor(name, compress, decompress):
+    """
+    Makes a new codec available for negotiation. Both peers must register it under the same name.
+    """
+    COMPRESSORS[name] = (compress, decompress)
+
+
+def choose_compression(offered, supported):
+    """
+    Returns the first offered codec that is also supported, or None if there is none.
+    """
+    for name in offered:
+        if name in supported and name in COMPRESSORS:
+            return name
+    return None
+
+
+def encode_message(flag: int, client_id: uuid.UUID, message_id: int, message, compression=None, threshold=COMPRESSION_THRESHOLD) -> Tuple[bytes,bytes]:
+    """
+    Returns the message header and body as they are sent through the wire.
+    The message may be a str or its already UTF-8 encoded bytes.
+    """
+    body = message.encode('utf-8') if isinstance(message, str) else message
+    if compression and len(body) >= threshold:
+        compressed = COMPRESSORS[compression][0](body)
+        if len(compressed) < len(body):
+            flag |= COMPRESSED_FLAG
+            body = compressed
+    return struct.pack('!B16sL', flag, client_id.bytes, message_id), body
+
+
+def decode_message(payload, compression=None) -> Tuple[int,uuid.UUID,int,str]:
+    """
+    Parses a frame payload (without its length header) into its message fields.
+    """
+    if len(payload) < MESSAGE_HEADER_SIZE:
+        raise ProtocolError(f'Frame of {len(payload)} bytes is shorter than a message header')
+    flag, client_id, message_id = struct.unpack_from('!B16sL', payload)
+    body = payload[MESSAGE_HEADER_SIZE:]
+    if flag & COMPRESSED_FLAG:
+        flag &= ~COMPRESSED_FLAG
+        if compression not in COMPRESSORS:
+            raise ProtocolError(f'Compressed message {message_id} but no compression was negotiated')
+        try:
+            body = COMPRESSORS[compression][1](body)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ProtocolError(f'Message {message_id} could not be decompressed with {compression}: {e}') from e
+    try:
+        return flag, uuid.UUID(bytes=client_id), message_id, str(body, 'utf-8')
+    except UnicodeDecodeError as e:
+        raise ProtocolError(f'Message {message_id} is not valid UTF-8: {e}') from e
 
 
 class MessageTransferProtocol(ByteTransferProtocol):
+    def __init__(self, conn: socket, compression=None, threshold=COMPRESSION_THRESHOLD):
+        super().__init__(conn)
+        self.compression = compression
+        self.threshold = threshold
+
     def send_message(self, flag: int, client_id: uuid.UUID, message_id: int, message: str):
         """
         Sends a message given a socket connection.
+        Bodies of at least `threshold` bytes are compressed if a codec was negotiated.
         """
-        payload = struct.pack('!B', flag) + client_id.bytes + struct.pack('!L', message_id) + message.encode('utf-8')
-        return super().send_bytes(payload)
+        header, body = encode_message(flag, client_id, message_id, message, self.compression, self.threshold)
+        return super().send_frame(header, body)
 
-    def receive_message(self) -> Tuple[bytes,uuid.UUID,int,str]:
+    def receive_message(self) -> Tuple[int,uuid.UUID,int,str]:
         """
         Receives a message from a socket.
         """
-        payload = super().receive_bytes()
-        flag, client_id, message_id, message = payload[0], payload[1:17], payload[17:21], payload[21:]
-        return flag, uuid.UUID(bytes=client_id), struct.unpack('!L', message_id)[0], message.decode('utf-8')
+        return decode_message(super().receive_bytes(), self.compression)
 
+    def request_compression(self, client_id: uuid.UUID, codecs):
+        """
+        Offers the codecs (in order of preference) to the peer and uses the one it picks.
+        """
+        self.send_message(MESSAGE_FLAG['HANDSHAKE'], client_id, 0, ','.join(codecs))
+        flag, _peer_id, _message_id, message = self.receive_message()
+        if flag != MESSAGE_FLAG['HANDSHAKE']:
+            raise SystemError('Invalid response from the server')
+        self.compression = message if message in COMPRESSORS else None
+        return self.compression
 
-class RouterProtocol:
-    def __init__(self) -> None:
-        manager = Manager()
-        self.router = manager.dict()
+    def accept_compression(self, client_id: uuid.UUID, message_id: int, offered: str, supported):
+        """
+        Answers a compression handshake choosing one of the offered codecs.
+        The answer is sent uncompressed, so the codec only applies to later messages.
+        """
+        self.compression = None
+        compression = choose_compression(offered.split(','), supported)
+        self.send_message(MESSAGE_FLAG['HANDSHAKE'], client_id, message_id, compression or '')
+        self.compression = compression
+        return compression
 
-    def add_connection(self, connection:MessageTransferProtocol, uid: uuid.UUID) -> None:
-        self.router[uid] = connection
-    
-    def send_message(self, flag: int, client_id: uuid.UUID, message_id: int, message: str):
-        self.router[client_id].send_message(flag, client_id, message_id, message)
-    
-    def is_client_routed(self, client_id: uuid.UUID) -> bool:
-        return client_id in self.router
+    def grant_credits(self, client_id: uuid.UUID, message_id: int, amount: int):
+        """
+        Allows the peer to send `amount` more messages.
+        """
+        return self.send_message(MESSAGE_FLAG['CREDIT'], client_id, message_id, str(amount))
+
+
+class CreditWindow:
+    """
+    Sender side of the credit based flow control.
+    Each message sent consumes a credit, when there are none left it blocks until the peer grants more.
+    -grants: connection the amounts granted arrive through when another process reads the socket,
+             otherwise they are read from the socket itself.
+    """
+    def __init__(self, protocol: MessageTransferProtocol, grants=None):
+        self.protocol = protocol
+        self.grants = grants
+        self.credits = 0
+
+    def acquire(self):
+        while self.credits <= 0:
+            if self.grants:
+                self.credits += self.grants.recv()
+                continue
+            flag, _peer_id, _message_id, message = self.protocol.receive_message()
+            if flag == MESSAGE_FLAG['CREDIT']:
+                self.credits += int(message)
+            else:
+                logging.warning(f'Unexpected message flag {flag} while waiting for credits')
+        self.credits -= 1
+
+
+class AsyncMessageTransferProtocol:
+    """
+    asyncio counterpart of MessageTransferProtocol, it speaks the same wire format over a stream pair.
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, compression=None, threshold=COMPRESSION_THRESHOLD):
+        self.reader = reader
+        self.writer = writer
+        self.compression = compression
+        self.threshold = threshold
+
+    async def send_message(self, flag: int, client_id: uuid.UUID, message_id: int, message: str):
+        header, body = encode_message(flag, client_id, message_id, message, self.compression, self.threshold)
+        self.writer.writelines((struct.pack('!L', len(header) + len(body)), header, body))
+        await self.writer.drain()
+
+    async def receive_message(self) -> Tuple[int,uuid.UUID,int,str]:
+        length = struct.unpack('!L', await self.reader.readexactly(BYTES_HEADER_SIZE))[0]
+        payload = await self.reader.readexactly(length)
+        return decode_message(memoryview(payload), self.compression)
+
+    async def accept_compression(self, client_id: uuid.UUID, message_id: int, offered: str, supported):
+        self.compression = None
+        compression = choose_compression(offered.split(','), supported)
+        await self.send_message(MESSAGE_FLAG['HANDSHAKE'], client_id, message_id, compression or '')
+        self.compression = compression
+        return compression
+
+    async def grant_credits(self, client_id: uuid.UUID, message_id: int, amount: int):
+        await self.send_message(MESSAGE_FLAG['CREDIT'], client_id, message_id, str(amount))
+
+    def close(self):
+        self.writer.close()
@@ -1,2 +1,3 @@
 from .workers import Aggregate, Filter, Map, Router, wait_rabbitmq
 from .dynamic_workers import DynamicAggregate, DynamicFilter, DynamicRouter
+from .records import batch_records, column_mask, column_values, json_record, record_mask, record_partition
@@ -3,7 +3,9 @@ import logging
 from uuid import uuid4
 from abc import abstractmethod
 from .workers import Worker, ParallelWorker
-from lib.fault_tolerance import save_state, load_state, is_duplicate, is_repeated
+from lib.codec import decode
+from lib.workers.records import batch_records, is_eof, select, take, to_rows, with_records
+from lib.fault_tolerance import DeltaAccumulator, DeltaState, save_state, load_state, finish_request, is_duplicate, is_repeated
 
 class DynamicWorker(Worker):
     """
@@ -26,12 +28,12 @@ class DynamicWorker(Worker):
         Wrapper to create tmp_queues before invoking the actual callback.
         This is to ensure that the callback fn will always publish to an existing queue.
         """
-        message = json.loads(body)
+        message = decode(body, properties)
         if message['request_id'] not in self.ongoing_requests:
             self.create_queues(message['request_id'])
         self.inner_callback(ch, method, properties, message)
-        if message['items'] and message['items'][0].get('type') == 'EOF':
-            logging.warning(json.loads(body))
+        if is_eof(message):
+            logging.warning(message)
             self.ongoing_requests.discard(message['request_id'])
             # DON'T delete queues yet! messages need to be consumed.
             # queues should be deleted by consumer after reading the EOF.
@@ -64,31 +66,34 @@ class DynamicRouter(DynamicWorker):
         Wrapper to create tmp_queues before invoking the actual callback.
         This is to ensure that the callback fn will always publish to an existing queue.
         """
-        message = json.loads(body)
+        message = decode(body, properties)
         if message['request_id'] not in self.ongoing_requests:
             self.create_queues(message['request_id'])
-        if message['items'] and message['items'][0].get('type') == 'EOF':
-            logging.warning(body)
+        if is_eof(message):
+            logging.warning(message)
+            # The deliveries before it are acked first, so it's acked as soon as its state is saved.
+            self.flush_group()
             message = {'request_id': message['request_id'], 'message_id': message['message_id'], 'items': message['items'], 'type': 'EOF', 'sender_id': self.id, 'intended_recipient': 'BROADCAST'}
             self.connection.send_message(self.peer_agora, self.peer_agora, json.dumps(message))
             self.finished_peers[message['request_id']] = [self.id]
+            self.connection.flush()
             save_state(id=self.id, peers=self.peers, finished_peers=self.finished_peers)
+            self.connection.acknowledge_message(method.delivery_tag)
         else:
             self.inner_callback(ch, method, properties, message)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+            self.commit(method.delivery_tag)
 
     def inner_callback(self, ch, method, properties, batch):
         'Callback given to a RabbitMQ queue to invoke for each message in the queue'
-        messages_per_target = {}
-        for msg in batch['items']:
+        records = batch_records(batch)
+        indices_per_target = {}
+        for index, msg in enumerate(to_rows(records)):
             message = {'request_id': batch['request_id'], 'message_id': batch['message_id']}
             message.update(msg)
             for routing_key in self.routing_fn(message):
-                messages_per_target[routing_key] = messages_per_target.get(routing_key, [])
-                messages_per_target[routing_key].append(msg)
-        for routing_key, messages in messages_per_target.items():
-            batch['items'] = messages
-            ch.basic_publish(exchange=self.dst_exchange, routing_key=routing_key, body=json.dumps(batch))
+                indices_per_target.setdefault(routing_key, []).append(index)
+        for routing_key, indices in indices_per_target.items():
+            self.connection.send_batch(self.dst_exchange, routing_key, with_records(batch, take(records, indices)))
 
     def end(self, ch, method, properties, body):
         'Send EOF to next layer'
@@ -97,7 +102,7 @@ class DynamicRouter(DynamicWorker):
         del eof_message['intended_recipient']
         del eof_message['sender_id']
         for routing_key in self.routing_fn(eof_message):
-            ch.basic_publish(exchange=self.dst_exchange, routing_key=routing_key, body=json.dumps(eof_message))
+            self.connection.send_batch(self.dst_exchange, routing_key, eof_message)
         self.ongoing_requests.discard(eof_message['request_id'])
         # DON'T delete queues yet! messages need to be consumed.
         # queues should be deleted by consumer after reading the EOF.
@@ -107,24 +112,28 @@ class DynamicAggregate(DynamicWorker):
     def __init__(self, aggregate_fn, result_fn, accumulator, *args, **kwargs):
         self.aggregate_fn = aggregate_fn
         self.result_fn = result_fn
-        state = load_state()
-        self.accumulator = state.get("accumulator", accumulator)
-        self.duplicate_filter = state.get("duplicate_filter", {})
+        self.state = DeltaState()
+        state = self.state.load()
+        self.accumulator = DeltaAccumulator(state.get("accumulator", accumulator))
+        self.duplicate_filter = DeltaAccumulator(state.get("duplicate_filter", {}))
         super().new(*args, **kwargs)
 
     def inner_callback(self, ch, method, properties, batch):
         'Callback given to a RabbitMQ queue to invoke for each message in the queue'
         if is_duplicate(batch['request_id'], batch['message_id'], self.duplicate_filter):
             # There's no need to update state for duplicate messages.
-            self.connection.acknowledge_message(method.delivery_tag)
+            self.commit(method.delivery_tag)
             return
-        if batch['items'] and batch['items'][0].get('type') == 'EOF':
+        if is_eof(batch):
             batch['type'] = batch['items'][0]['type']
             self.end(batch)
+            finish_request(batch['request_id'], self.duplicate_filter)
         else:
             self.aggregate_fn(batch, self.accumulator)
-        save_state(accumulator=self.accumulator, duplicate_filter=self.duplicate_filter)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        self.commit(method.delivery_tag)
+
+    def checkpoint(self):
+        self.state.save(accumulator=self.accumulator, duplicate_filter=self.duplicate_filter)
 
     def end(self, eof_message):
         message_id = 1
@@ -133,10 +142,10 @@ class DynamicAggregate(DynamicWorker):
             msg['message_id'] = message_id
             message_id += 1
             routing_key = f"{self.routing_key}_{msg['request_id']}"
-            self.connection.send_message(self.dst_exchange, routing_key, json.dumps(msg))
+            self.connection.send_batch(self.dst_exchange, routing_key, msg)
         eof_message['message_id'] = message_id
         routing_key = f"{self.routing_key}_{eof_message['request_id']}"
-        self.connection.send_message(self.dst_exchange, routing_key, json.dumps(eof_message))
+        self.connection.send_batch(self.dst_exchange, routing_key, eof_message)
 
 
 class DynamicFilter(ParallelWorker):
@@ -162,10 +171,10 @@ class DynamicFilter(ParallelWorker):
 
     def callback(self, ch, method, properties, body):
         'Callback used to update the internal state, to change how future messages are filtered'
-        msg = json.loads(body)
+        msg = decode(body, properties)
         if is_repeated(msg['request_id'], msg['message_id'], self.duplicates_state):
             # There's no need to update state for duplicate messages.
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            self.connection.acknowledge_message(method.delivery_tag)
             return
         # Ignore EOFs through this queue. Each client will send their EOF through the tmp queue.
         if msg.get('type') != 'EOF':
@@ -175,7 +184,7 @@ class DynamicFilter(ParallelWorker):
             self.connection.create_queue(new_tmp_queue, persistent=True)
             self.connection.set_consumer(new_tmp_queue, self.filter_callback)
             save_state(filter_state=self.filter_state, duplicates_state=self.duplicates_state)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        self.connection.acknowledge_message(method.delivery_tag)
 
     def end(self, ch, method, properties, body):
         'Send EOF to next layer'
@@ -187,27 +196,30 @@ class DynamicFilter(ParallelWorker):
         tmp_queue = f"{self.tmp_queues_prefix}_{msg['request_id']}_queue"
         self.connection.channel.queue_delete(queue=tmp_queue)
         save_state(filter_state=self.filter_state, duplicates_state=self.duplicates_state)
-        self.connection.send_message(self.dst_exchange, self.routing_key, json.dumps(msg))
+        self.connection.send_batch(self.dst_exchange, self.routing_key, msg)
 
     def filter_callback(self, ch, method, properties, body):
         'Callback used to filter messages in a queue'
-        batch = json.loads(body)
-        if batch['items'] and batch['items'][0].get('type') == 'EOF':
+        batch = decode(body, properties)
+        if is_eof(batch):
             logging.warning(batch)
+            # The deliveries before it are acked first, so it's acked as soon as its state is saved.
+            self.flush_group()
             message = {'request_id': batch['request_id'], 'message_id': batch['message_id'], 'type': 'EOF', 'items': batch['items'], 'sender_id': self.id, 'intended_recipient': 'BROADCAST'}
             self.connection.send_message(self.peer_agora, self.peer_agora, json.dumps(message))
             self.finished_peers[message['request_id']] = [self.id]
+            self.connection.flush()
             save_state(id=self.id, peers=self.peers, finished_peers=self.finished_peers, filter_state=self.filter_state, duplicates_state=self.duplicates_state)
+            self.connection.acknowledge_message(method.delivery_tag)
         else:
-            filtered_messages = []
-            for item in batch['items']:
+            records = batch_records(batch)
+            mask = []
+            for item in to_rows(records):
                 message = {'request_id': batch['request_id'], 'message_id': batch['message_id']}
                 message.update(item)
-                if self.filter_condition(self.filter_state, message):
-                    filtered_messages.append(item)
-            batch['items'] = filtered_messages
-            self.connection.send_message(self.dst_exchange, self.routing_key, json.dumps(batch))
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+                mask.append(self.filter_condition(self.filter_state, message))
+            self.connection.send_batch(self.dst_exchange, self.routing_key, with_records(batch, select(records, mask)))
+            self.commit(method.delivery_tag)
 
     def recover_from_state(self, state):
         self.id = state.get('id', str(uuid4()))
@@ -0,0 +1,111 @@
+import json
+from itertools import compress
+
+# Items of a batch come in one of two layouts:
+# -ROWS: a list of dicts, {'request_id': ..., 'message_id': ..., 'items': [{'Title': ..., 'review/text': ...}, ...]}
+# -COLUMNS: a dict with a list of values per column, {'request_id': ..., 'message_id': ..., 'columns': {'Title': [...], ...}}
+#  Keys are not repeated on every row and stages don't build a dict per row unless they need one.
+# Producers pick the layout (see lib.gateway), every stage keeps the layout of the batches it gets, and EOFs are always rows.
+ROWS = 'rows'
+COLUMNS = 'columns'
+BATCH_LAYOUT = ROWS
+
+
+def batch_records(batch):
+    "Returns the items of a batch in their own layout."
+    return batch[COLUMNS] if COLUMNS in batch else batch['items']
+
+
+def with_records(batch, records):
+    "Returns a batch with the same request_id and message_id holding `records`."
+    key = COLUMNS if isinstance(records, dict) else 'items'
+    return {'request_id': batch['request_id'], 'message_id': batch['message_id'], key: records}
+
+
+def is_eof(batch):
+    items = batch.get('items')
+    return bool(items) and items[0].get('type') == 'EOF'
+
+
+def to_rows(records):
+    if not isinstance(records, dict):
+        return records
+    names = list(records)
+    return [dict(zip(names, values)) for values in zip(*records.values())]
+
+
+def to_columns(rows):
+    "Without rows there are no column names, the batch has no columns (see column_values)."
+    names = list(rows[0]) if rows else []
+    return {name: [row.get(name) for row in rows] for name in names}
+
+
+def as_layout(rows, layout_of):
+    "Returns the rows in the same layout as `layout_of`."
+    return to_columns(rows) if isinstance(layout_of, dict) else rows
+
+
+def column_values(records, *names):
+    "Returns the values of each of the columns, in either layout."
+    if isinstance(records, dict):
+        if not any(records.values()):
+            # A batch without items may not have its columns, e.g. one mapped from an empty batch.
+            return [[] for _name in names]
+        return [records[name] for name in names]
+    return [[row[name] for row in records] for name in names]
+
+
+def select(records, mask):
+    """
+    Keeps the items where the mask is true. Batches where every item is kept are returned as they are,
+    otherwise the kept items are copied since they are encoded on their own for the next stage anyway.
+    """
+    if all(mask):
+        return records
+    if isinstance(records, dict):
+        return {name: list(compress(values, mask)) for name, values in records.items()}
+    return list(compress(records, mask))
+
+
+def take(records, indices):
+    "Keeps the items at the given positions."
+    if isinstance(records, dict):
+        return {name: [values[index] for index in indices] for name, values in records.items()}
+    return [records[index] for index in indices]
+
+
+# Filter and Router work on whole batches of items in either layout: a Filter takes a function returning the mask
+# of the items to keep, and a Router one returning the items to send with each routing key. These turn the functions
+# of a single item into them.
+
+
+def record_mask(condition):
+    "Turns a predicate of a single item into the mask of a batch."
+    def mask(records):
+        return [condition(record) for record in to_rows(records)]
+    return mask
+
+
+def column_mask(condition, *names):
+    "Turns a predicate of some fields of an item into the mask of a batch, without building the items of columnar batches."
+    def mask(records):
+        return list(map(condition, *column_values(records, *names)))
+    return mask
+
+
+def record_partition(routing_fn):
+    "Turns a function returning the routing keys of a single item into the partition of a batch by routing key."
+    def partition(records):
+        indices = {}
+        for index, record in enumerate(to_rows(records)):
+            for routing_key in routing_fn(record):
+                indices.setdefault(routing_key, []).append(index)
+        return {routing_key: take(records, positions) for routing_key, positions in indices.items()}
+    return partition
+
+
+def json_record(fn):
+    "Adapter for functions that still take each item encoded as JSON, until they take the item itself."
+    def decoded(record):
+        return fn(json.dumps(record))
+    return decoded
@@ -6,16 +6,32 @@ import logging
 from multiprocessing import Process
 from pika.exchange_type import ExchangeType
 from lib.healthcheck import Healthcheck, HEALTH
+import os
 import pika
 from pika.exchange_type import ExchangeType
-from lib.fault_tolerance import save_state, load_state, is_duplicate
+from lib.codec import decode
+from lib.workers.records import as_layout, batch_records, is_eof, select, to_rows, with_records
+from lib.fault_tolerance import DeltaAccumulator, DeltaState, save_state, load_state, finish_request, is_duplicate
 
 WAIT_TIME_PIKA=5
+PREFETCH_COUNT = 1
+FLUSH_INTERVAL = 0.05
 
 class Worker(ABC):
-    def new(self, connection, src_queue='', src_exchange='', src_routing_key=[''], src_exchange_type=ExchangeType.direct, dst_exchange='', dst_routing_key='', dst_exchange_type=ExchangeType.direct):
+    def new(self, connection, src_queue='', src_exchange='', src_routing_key=[''], src_exchange_type=ExchangeType.direct, dst_exchange='', dst_routing_key='', dst_exchange_type=ExchangeType.direct, prefetch_count=None, flush_interval=None):
+        """
+        -prefetch_count: deliveries processed before saving a checkpoint and acking them all at once.
+                         Defaults to the PREFETCH_COUNT environment variable.
+        -flush_interval: max seconds a processed delivery waits for the rest of its group.
+                         Defaults to the FLUSH_INTERVAL environment variable.
+        """
         self.connection = connection
-        self.connection.channel.basic_qos(prefetch_count=1, global_qos=True)
+        self.prefetch_count = prefetch_count or int(os.getenv('PREFETCH_COUNT', PREFETCH_COUNT))
+        self.flush_interval = flush_interval or float(os.getenv('FLUSH_INTERVAL', FLUSH_INTERVAL))
+        self.uncommitted = 0
+        self.uncommitted_tag = None
+        self.flush_call = None
+        self.connection.set_prefetch(self.prefetch_count)
 
         # init source queue and bind to exchange
         self.connection.create_queue(src_queue, persistent=True)
@@ -49,6 +65,33 @@ class Worker(ABC):
         self.connection.set_consumer(self.src_queue, self.callback)
         self.connection.begin_consuming()
 
+    def commit(self, delivery_tag):
+        """
+        Marks a delivery as processed. Deliveries are acked in groups of `prefetch_count`, or `flush_interval`
+        seconds after the first one of the group, with a single checkpoint saved right before.
+        """
+        self.uncommitted += 1
+        self.uncommitted_tag = delivery_tag
+        if self.uncommitted >= self.prefetch_count:
+            self.flush_group()
+        elif not self.flush_call:
+            self.flush_call = self.connection.call_later(self.flush_interval, self.flush_group)
+
+    def flush_group(self):
+        if self.flush_call:
+            self.connection.cancel_call(self.flush_call)
+            self.flush_call = None
+        if not self.uncommitted:
+            return
+        self.connection.flush()
+        self.checkpoint()
+        self.connection.acknowledge_message(self.uncommitted_tag, multiple=True)
+        self.uncommitted = 0
+
+    def checkpoint(self):
+        # nothing to save - MAY be overriden by subclasses.
+        pass
+
     def end(self, ch, method, properties, body):
         # nothing to do - MAY be overriden by subclasses.
         pass
@@ -91,6 +134,7 @@ class ParallelWorker(Worker):
                 if set(self.finished_peers[message['request_id']]) == set(self.peers):
                     del self.finished_peers[message['request_id']]
                     self.end(ch, method, properties, body)
+        self.connection.flush()
         save_state(id=self.id, peers=self.peers, finished_peers=self.finished_peers)
         self.connection.acknowledge_message(method.delivery_tag)
 
@@ -99,27 +143,35 @@ class ParallelWorker(Worker):
         eof_message = json.loads(body)
         del eof_message['intended_recipient']
         del eof_message['sender_id']
-        self.connection.send_message(self.dst_exchange, self.routing_key, json.dumps(eof_message))
+        self.connection.send_batch(self.dst_exchange, self.routing_key, eof_message)
 
 
 class Filter(ParallelWorker):
-    def __init__(self, filter_condition, *args, **kwargs):
-        self.filter_condition = filter_condition
+    def __init__(self, filter_batch, *args, **kwargs):
+        """
+        -filter_batch: takes the items of a batch, in its layout, and returns a mask with the ones to keep.
+                       record_mask and column_mask build it from a predicate of a single item.
+        """
+        self.filter_batch = filter_batch
         super().new(*args, **kwargs)
 
     def callback(self, ch, method, properties, body):
         'Callback given to a queue to invoke for each message in the queue'
-        batch = json.loads(body)
-        if batch['items'] and batch['items'][0].get('type') == 'EOF':
+        batch = decode(body, properties)
+        if is_eof(batch):
             logging.warning(batch)
+            # The deliveries before it are acked first, so it's acked as soon as its state is saved.
+            self.flush_group()
             message = {'request_id': batch['request_id'], 'message_id': batch['message_id'], 'type': 'EOF', 'items': batch['items'], 'sender_id': self.id, 'intended_recipient': 'BROADCAST'}
             self.connection.send_message(self.peer_agora, self.peer_agora, json.dumps(message))
             self.finished_peers[message['request_id']] = [self.id]
+            self.connection.flush()
             save_state(id=self.id, peers=self.peers, finished_peers=self.finished_peers)
+            self.connection.acknowledge_message(method.delivery_tag)
         else:
-            batch['items'] = [msg for msg in batch['items'] if self.filter_condition(json.dumps(msg))]
-            self.connection.send_message(self.dst_exchange, self.routing_key, json.dumps(batch))
-        self.connection.acknowledge_message(method.delivery_tag)
+            records = batch_records(batch)
+            self.connection.send_batch(self.dst_exchange, self.routing_key, with_records(batch, select(records, self.filter_batch(records))))
+            self.commit(method.delivery_tag)
 
 
 class Map(ParallelWorker):
@@ -129,92 +181,102 @@ class Map(ParallelWorker):
 
     def callback(self, ch, method, properties, body):
         'Callback given to a queue to invoke for each message in the queue'
-        batch = json.loads(body)
-        if batch['items'] and batch['items'][0].get('type') == 'EOF':
+        batch = decode(body, properties)
+        if is_eof(batch):
             logging.warning(batch)
+            # The deliveries before it are acked first, so it's acked as soon as its state is saved.
+            self.flush_group()
             message = {'request_id': batch['request_id'], 'message_id': batch['message_id'], 'type': 'EOF', 'items': batch['items'], 'sender_id': self.id, 'intended_recipient': 'BROADCAST'}
             self.connection.send_message(self.peer_agora, self.peer_agora, json.dumps(message))
             self.finished_peers[message['request_id']] = [self.id]
+            self.connection.flush()
             save_state(id=self.id, peers=self.peers, finished_peers=self.finished_peers)
+            self.connection.acknowledge_message(method.delivery_tag)
         else:
-            mapped_messages = [self.map_fn(item) for item in batch['items']]
-            message = {'request_id': batch['request_id'], 'message_id': batch['message_id'], 'items': mapped_messages}
-            self.connection.send_message(self.dst_exchange, self.routing_key, json.dumps(message))
-        self.connection.acknowledge_message(method.delivery_tag)
+            records = batch_records(batch)
+            mapped_messages = [self.map_fn(item) for item in to_rows(records)]
+            self.connection.send_batch(self.dst_exchange, self.routing_key, with_records(batch, as_layout(mapped_messages, records)))
+            self.commit(method.delivery_tag)
 
 
 class Router(ParallelWorker):
-    def __init__(self, routing_fn, *args, **kwargs):
-        self.routing_fn = routing_fn
+    def __init__(self, route_batch, *args, **kwargs):
+        """
+        -route_batch: takes the items of a batch, in its layout, and returns the ones to send with each routing key.
+                      record_partition builds it from the routing keys of a single item.
+        """
+        self.route_batch = route_batch
         super().new(*args, **kwargs)
 
     def callback(self, ch, method, properties, body):
         'Callback given to a queue to invoke for each message in the queue'
-        batch = json.loads(body)
-        if batch['items'] and batch['items'][0].get('type') == 'EOF':
+        batch = decode(body, properties)
+        if is_eof(batch):
             logging.warning(batch)
+            # The deliveries before it are acked first, so it's acked as soon as its state is saved.
+            self.flush_group()
             message = {'request_id': batch['request_id'], 'message_id': batch['message_id'], 'type': 'EOF', 'items': batch['items'], 'sender_id': self.id, 'intended_recipient': 'BROADCAST'}
             self.connection.send_message(self.peer_agora, self.peer_agora, json.dumps(message))
             self.finished_peers[message['request_id']] = [self.id]
+            self.connection.flush()
             save_state(id=self.id, peers=self.peers, finished_peers=self.finished_peers)
+            self.connection.acknowledge_message(method.delivery_tag)
         else:
-            messages_per_target = {}
-            for msg in batch['items']:
-                for routing_key in self.routing_fn(json.dumps(msg)):
-                    messages_per_target[routing_key] = messages_per_target.get(routing_key, [])
-                    messages_per_target[routing_key].append(msg)
-            for routing_key, messages in messages_per_target.items():
-                batch['items'] = messages
-                self.connection.send_message(self.dst_exchange, routing_key, json.dumps(batch))
-        self.connection.acknowledge_message(method.delivery_tag)
+            for routing_key, records in self.route_batch(batch_records(batch)).items():
+                self.connection.send_batch(self.dst_exchange, routing_key, with_records(batch, records))
+            self.commit(method.delivery_tag)
 
     def end(self, ch, method, properties, body):
         'Send EOF to next layer'
         eof_message = json.loads(body)
         del eof_message['intended_recipient']
-        routing_keys = self.routing_fn(body)
-        for routing_key in routing_keys:
-            self.connection.send_message(self.dst_exchange, routing_key, json.dumps(eof_message))
+        # Routed as a batch of its own, the routing functions give every routing key for an EOF.
+        for routing_key in self.route_batch([eof_message]):
+            self.connection.send_batch(self.dst_exchange, routing_key, eof_message)
 
 
 class Aggregate(Worker):
     def __init__(self, aggregate_fn, result_fn, accumulator, *args, **kwargs):
         self.aggregate_fn = aggregate_fn
         self.result_fn = result_fn
-        state = load_state()
-        self.accumulator = state.get("accumulator", accumulator)
-        self.duplicate_filter = state.get("duplicate_filter", {})
+        self.state = DeltaState()
+        state = self.state.load()
+        self.accumulator = DeltaAccumulator(state.get("accumulator", accumulator))
+        self.duplicate_filter = DeltaAccumulator(state.get("duplicate_filter", {}))
         super().new(*args, **kwargs)
 
     def callback(self, ch, method, properties, body):
         'Callback given to a queue to invoke for each message in the queue'
-        batch = json.loads(body)
+        batch = decode(body, properties)
         if is_duplicate(batch['request_id'], batch['message_id'], self.duplicate_filter):
             # There's no need to update state for duplicate messages.
-            self.connection.acknowledge_message(method.delivery_tag)
+            self.commit(method.delivery_tag)
             return
-        for item in batch['items']:
+        for item in to_rows(batch_records(batch)):
             message = {'request_id': batch['request_id'], 'message_id': batch['message_id']}
             message.update(item)
             if message.get('type') == 'EOF':
                 logging.warning(message)
                 self.end(ch, method, properties, body)
+                finish_request(batch['request_id'], self.duplicate_filter)
             else:
                 self.aggregate_fn(message, self.accumulator)
-        save_state(accumulator=self.accumulator, duplicate_filter=self.duplicate_filter)
-        self.connection.acknowledge_message(method.delivery_tag)
+        self.commit(method.delivery_tag)
+
+    def checkpoint(self):
+        self.state.save(accumulator=self.accumulator, duplicate_filter=self.duplicate_filter)
 
     def end(self, ch, method, properties, body):
-        eof_message = json.loads(body)
+        eof_message = decode(body, properties)
         message_id = 1
         result = self.result_fn(eof_message, self.accumulator)
         messages = json.loads(result)
         for message in messages:
             message['message_id'] = message_id
             message_id += 1
-            self.connection.send_message(self.dst_exchange, self.routing_key, json.dumps(message))
+            self.connection.send_batch(self.dst_exchange, self.routing_key, message)
         eof_message['message_id'] = message_id
-        self.connection.send_message(self.dst_exchange, self.routing_key, json.dumps(eof_message))
+        self.connection.send_batch(self.dst_exchange, self.routing_key, eof_message)
 
 
 def wait_rabbitmq(host='rabbitmq', timeout=120, interval=10):
@@ -0,0 +1,114 @@
+import csv
+import os
+from io import StringIO
+from tempfile import TemporaryDirectory
+import unittest
+
+from client.batches import INDEX_SUFFIX, BatchIndex, cut_batches
+
+HEADER = b'Title,review/text\n'
+
+
+def records(batch):
+    return list(csv.reader(StringIO(batch.decode('utf-8'), newline='')))
+
+
+class CutBatchesTest(unittest.TestCase):
+    "Batches must hold whole records wherever the byte budget falls, and together the whole file."
+
+    def assert_whole_records(self, data, batch_bytes):
+        batches = list(cut_batches(data, len(HEADER), batch_bytes))
+        self.assertEqual(b''.join(batch for _offset, batch in batches), data[len(HEADER):])
+        self.assertEqual([offset for offset, _batch in batches], [len(HEADER) + sum(len(batch) for _offset, batch in batches[:i]) for i in range(len(batches))])
+        expected = records(data[len(HEADER):])
+        self.assertEqual([record for _offset, batch in batches for record in records(batch)], expected)
+        return batches
+
+    def test_quoted_newlines(self):
+        data = HEADER + b'A,"first line\nsecond line\nthird"\nB,plain\nC,"x\ny"\n'
+        for batch_bytes in range(1, len(data)):
+            self.assert_whole_records(data, batch_bytes)
+
+    def test_escaped_quotes_at_the_boundary(self):
+        data = HEADER + b'A,"he said ""hi""\nand ""bye"""\nB,"""\n"""\nC,end\n'
+        for batch_bytes in range(1, len(data)):
+            self.assert_whole_records(data, batch_bytes)
+
+    def test_crlf(self):
+        data = HEADER.replace(b'\n', b'\r\n') + b'A,"one\r\ntwo"\r\nB,plain\r\nC,last\r\n'
+        for batch_bytes in range(1, len(data)):
+            batches = list(cut_batches(data, len(HEADER) + 1, batch_bytes))
+            self.assertTrue(all(batch.endswith(b'\r\n') for _offset, batch in batches))
+            self.assertEqual([record for _offset, batch in batches for record in records(batch)], [['A', 'one\r\ntwo'], ['B', 'plain'], ['C', 'last']])
+
+    def test_last_record_without_newline(self):
+        data = HEADER + b'A,"x\ny"\nB,last'
+        batches = self.assert_whole_records(data, 4)
+        self.assertEqual(batches[-1][1], b'B,last')
+
+
+class BatchIndexTest(unittest.TestCase):
+    "A resumed upload must start at the same offset a full scan gives, whatever state the index was left in."
+
+    def setUp(self):
+        self.dir = TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'reviews.csv')
+        self.write(HEADER + b''.join(b'T%d,"review\n%d"\n' % (i, i) for i in range(20)))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        self.data = data
+
+    def scan(self, batch_bytes=40):
+        "Offsets of every batch, indexing them as the client does."
+        index = BatchIndex(self.path, batch_bytes)
+        offsets = []
+        for message_id, (offset, _batch) in enumerate(cut_batches(self.data, len(HEADER), batch_bytes), 1):
+            index.add(message_id, offset)
+            offsets.append(offset)
+        index.close()
+        return offsets
+
+    def test_resume_from_index(self):
+        offsets = self.scan()
+        index = BatchIndex(self.path, 40)
+        self.assertEqual(index.closest(5), (4, offsets[4]))
+        self.assertEqual(index.closest(len(offsets) + 3), (len(offsets) - 1, offsets[-1]))
+        index.close()
+
+    def test_truncated_index(self):
+        offsets = self.scan()
+        index_path = self.path + INDEX_SUFFIX
+        # A crash left the third entry half written.
+        os.truncate(index_path, os.path.getsize(index_path) - (len(offsets) - 3) * 8 - 3)
+        index = BatchIndex(self.path, 40)
+        self.assertEqual(index.closest(10), (1, offsets[1]))
+        # The upload resumes from there, indexing the rest again.
+        message_id, offset = index.closest(10)
+        for message_id, (offset, _batch) in enumerate(cut_batches(self.data, offset, 40), message_id + 1):
+            index.add(message_id, offset)
+        index.close()
+        index = BatchIndex(self.path, 40)
+        self.assertEqual(list(index.offsets), offsets)
+        index.close()
+
+    def test_stale_index(self):
+        self.scan()
+        self.write(HEADER + b'new,"first"\n' + self.data[len(HEADER):])
+        index = BatchIndex(self.path, 40)
+        self.assertEqual(index.closest(5), (0, None))
+        index.close()
+
+    def test_other_batch_size(self):
+        self.scan(40)
+        index = BatchIndex(self.path, 64)
+        self.assertEqual(index.closest(5), (0, None))
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
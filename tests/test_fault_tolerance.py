@@ -0,0 +1,120 @@
+from tempfile import TemporaryDirectory
+import unittest
+from unittest import mock
+
+from lib.fault_tolerance import FINISHED_MARKS, DeltaAccumulator, DeltaState, finish_request, is_duplicate, set_state_dir
+
+
+class DeltaStateTest(unittest.TestCase):
+    "Every change made to a DeltaAccumulator must be back after saving it and loading it again."
+
+    def setUp(self):
+        self.state_dir = TemporaryDirectory()
+        set_state_dir(self.state_dir.name)
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def round_trip(self, accumulator, mutations, compaction_size=1 << 20):
+        "Saves the accumulator after each mutation and returns what loading it gives."
+        state = DeltaState(compaction_size=compaction_size)
+        accumulator = DeltaAccumulator(accumulator)
+        state.save(acc=accumulator)
+        for mutate in mutations:
+            mutate(accumulator)
+            state.save(acc=accumulator)
+        return DeltaState(compaction_size=compaction_size).load().get('acc', {}), accumulator
+
+    def assert_round_trip(self, accumulator, *mutations, **kwargs):
+        loaded, expected = self.round_trip(accumulator, mutations, **kwargs)
+        self.assertEqual(loaded, expected)
+
+    def test_list_appended(self):
+        self.assert_round_trip({'r': [1]}, lambda acc: acc['r'].append(2), lambda acc: acc['r'].extend([3, 4]))
+
+    def test_list_cleared(self):
+        self.assert_round_trip({'r': [1, 2]}, lambda acc: acc['r'].clear())
+
+    def test_list_popped_to_empty(self):
+        self.assert_round_trip({'r': [1]}, lambda acc: acc['r'].pop())
+
+    def test_list_rewritten(self):
+        self.assert_round_trip({'r': [3, 1, 2]}, lambda acc: acc['r'].sort(), lambda acc: acc['r'].__setitem__(0, 9))
+
+    def test_dict_updated(self):
+        def count(acc):
+            acc['r']['a'] = acc['r'].get('a', 0) + 1
+        self.assert_round_trip({'r': {}}, count, count, lambda acc: acc['r'].pop('a'), count)
+
+    def test_dict_cleared(self):
+        self.assert_round_trip({'r': {'a': 1, 'b': 2}}, lambda acc: acc['r'].clear())
+
+    def test_dict_popped_to_empty(self):
+        self.assert_round_trip({'r': {'a': 1}}, lambda acc: acc['r'].pop('a'))
+
+    def test_nested_values_mutated(self):
+        def add_decade(acc):
+            acc['r'].setdefault('author', []).append(1990)
+        self.assert_round_trip({'r': {}}, add_decade, add_decade)
+
+    def test_values_mutated_through_items(self):
+        def add_all(acc):
+            for _key, decades in acc['r'].items():
+                decades.append(2000)
+        def add_values(acc):
+            for decades in acc['r'].values():
+                decades.append(2010)
+        self.assert_round_trip({'r': {'a': [1990], 'b': []}}, add_all, add_values)
+
+    def test_requests_replaced_and_dropped(self):
+        def replace(acc):
+            acc['r'] = {'a': 1}
+        def drop(acc):
+            acc.pop('s')
+        self.assert_round_trip({'r': [1], 's': [2]}, replace, drop, lambda acc: acc['r'].update({'b': 2}))
+
+    def test_compaction(self):
+        def count(acc):
+            acc['r']['a'] = acc['r'].get('a', 0) + 1
+            acc['r'][str(acc['r']['a'])] = [acc['r']['a']]
+        self.assert_round_trip({'r': {}}, *[count] * 20, lambda acc: acc['r'].clear(), count, compaction_size=64)
+
+
+class DuplicateFilterTest(unittest.TestCase):
+    def test_out_of_order_ids(self):
+        state = {}
+        self.assertEqual([is_duplicate('r', message_id, state) for message_id in [1, 3, 2, 3, 1, 5]], [False, False, False, True, True, False])
+        self.assertEqual(state['r']['ids'], [1, 4, 5, 6])
+
+    def test_finished_request(self):
+        state = {}
+        is_duplicate('r', 1, state)
+        finish_request('r', state)
+        self.assertTrue(is_duplicate('r', 2, state))
+
+    @mock.patch('lib.fault_tolerance.FINISHED_REQUESTS_KEPT', 2)
+    def test_old_finished_requests_evicted(self):
+        # Marks saved before they were numbered count as the oldest ones.
+        state = DeltaAccumulator({'old': {'finished': True}, 'open': {'ids': [1, 2]}})
+        state.delta()
+        for request_id in ['a', 'b', 'c']:
+            finish_request(request_id, state)
+        self.assertEqual(sorted(state), [FINISHED_MARKS, 'b', 'c', 'open'])
+        self.assertFalse(is_duplicate('a', 1, state))
+        self.assertTrue(is_duplicate('c', 1, state))
+
+    @mock.patch('lib.fault_tolerance.FINISHED_REQUESTS_KEPT', 2)
+    def test_eviction_only_changes_the_marks_involved(self):
+        state = DeltaAccumulator({'a': {'ids': [1, 2]}})
+        for request_id in ['a', 'b', 'c']:
+            finish_request(request_id, state)
+        state.delta()
+        finish_request('d', state)
+        changes = state.delta()
+        self.assertEqual(sorted(changes['drop']), ['b'])
+        self.assertEqual(changes['set'], {'d': {'finished': 4}})
+        self.assertEqual(changes['update'][FINISHED_MARKS], {'set': {'4': 'd', 'next': 5, 'first': 3}, 'deleted': ['2']})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+from csv import DictReader
+from io import StringIO
+import json
+import unittest
+
+from lib.projection import COLUMNS_KEY, ITEMS_KEY, project_columns, project_rows
+from lib.schema import ID_COLUMNS, TITLE_ID, title_id
+
+COLUMNS = ['Title', 'review/text']
+HEADER = 'Id,Title,User_id,review/text\n'
+
+
+def dict_reader_rows(message_csv, columns, ids=None):
+    "What the publishers sent before lib.projection, plus the ID columns."
+    rows = []
+    for row in DictReader(StringIO(message_csv, newline='')):
+        if row.get('type') == 'EOF':
+            rows.append({'type': 'EOF'})
+            continue
+        item = {column: row[column] for column in columns if column in row}
+        for column, (source, fn) in (ids or {}).items():
+            if source in row:
+                item[column] = None if row[source] is None else fn(row[source])
+        rows.append(item)
+    return rows
+
+
+class ProjectionTest(unittest.TestCase):
+    "Both layouts must hold the same items csv.DictReader gives, however the batch is quoted."
+
+    def assert_like_dict_reader(self, message_csv, columns=COLUMNS, ids=ID_COLUMNS):
+        expected = dict_reader_rows(message_csv, columns, ids)
+        items, eof_received = project_rows(message_csv, columns, ids)
+        self.assertEqual(json.loads(items), expected)
+        self.assertEqual(eof_received, {'type': 'EOF'} in expected)
+
+        key, batch, eof_received = project_columns(message_csv, columns, ids)
+        batch = json.loads(batch)
+        if key == COLUMNS_KEY:
+            batch = [dict(zip(batch, values)) for values in zip(*batch.values())]
+        self.assertEqual(batch, expected)
+        self.assertEqual(eof_received, {'type': 'EOF'} in expected)
+        return key
+
+    def test_regular_rows(self):
+        message_csv = HEADER + '1,Dune,A1,Great\n2,Emma,A2,Fine\n'
+        self.assertEqual(self.assert_like_dict_reader(message_csv), COLUMNS_KEY)
+        self.assertEqual(self.assert_like_dict_reader(message_csv, ids=None), COLUMNS_KEY)
+
+    def test_quoted_fields(self):
+        self.assert_like_dict_reader(HEADER + '1,"Dune, Messiah",A1,"He said ""great"", \\o/"\n2,"",A2,"\u00e9t\u00e9 \u2603 \t"\n')
+
+    def test_multiline_fields(self):
+        self.assert_like_dict_reader(HEADER + '1,"Two\nlines",A1,"One\r\ntwo\n\nthree"\n2,Emma,A2,"last\n"\n')
+
+    def test_crlf_rows(self):
+        self.assert_like_dict_reader(HEADER.replace('\n', '\r\n') + '1,Dune,A1,"x\r\ny"\r\n2,Emma,A2,z\r\n')
+
+    def test_empty_and_short_rows(self):
+        message_csv = HEADER + '1,Dune,A1,Great\n\n2,Emma\n3\n'
+        self.assertEqual(self.assert_like_dict_reader(message_csv), ITEMS_KEY)
+
+    def test_eof(self):
+        self.assertEqual(self.assert_like_dict_reader('type\nEOF'), ITEMS_KEY)
+        self.assert_like_dict_reader('Title,review/text,type\nDune,"a\nb",\n,,EOF\n')
+
+    def test_missing_columns(self):
+        self.assert_like_dict_reader('Id,Title\n1,Dune\n')
+        self.assert_like_dict_reader('Id,User_id\n1,A1\n')
+
+    def test_empty_batch(self):
+        self.assertEqual(project_rows('', COLUMNS), ('[]', False))
+        self.assert_like_dict_reader(HEADER)
+
+    def test_title_ids(self):
+        items, _eof = project_rows(HEADER + '1,Dune,A1,Great\n', COLUMNS, ID_COLUMNS)
+        self.assertEqual(json.loads(items)[0][TITLE_ID], title_id('Dune'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import socket
+import struct
+import threading
+import unittest
+import uuid
+
+from lib.transfer.transfer_protocol import (
+    COMPRESSED_FLAG, INITIAL_BUFFER_SIZE, MESSAGE_FLAG, ByteTransferProtocol, MessageTransferProtocol, ProtocolError,
+    decode_message, encode_message,
+)
+
+CLIENT_ID = uuid.uuid4()
+
+
+def frame(payload: bytes) -> bytes:
+    return struct.pack('!L', len(payload)) + payload
+
+
+class ShortSocket:
+    "Socket that sends and receives at most `limit` bytes per call, to force short reads and writes."
+    def __init__(self, conn, limit):
+        self.conn = conn
+        self.limit = limit
+
+    def sendmsg(self, buffers):
+        data = b''.join(bytes(buffer) for buffer in buffers)[:self.limit]
+        return self.conn.send(data)
+
+    def recv_into(self, view):
+        return self.conn.recv_into(view[:self.limit])
+
+
+class FramingTest(unittest.TestCase):
+    "Frames sent with send_frame must come out of receive_bytes whole, however the socket splits them."
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_short_reads_and_writes(self):
+        payload = bytes(range(256)) * 4
+        sent = []
+        thread = threading.Thread(target=lambda: sent.append(ByteTransferProtocol(ShortSocket(self.sender, 3)).send_frame(payload[:100], payload[100:])))
+        thread.start()
+        received = bytes(ByteTransferProtocol(ShortSocket(self.receiver, 5)).receive_bytes())
+        thread.join()
+        self.assertEqual(received, payload)
+        self.assertEqual(sent, [len(payload) + 4])
+
+    def test_several_frames_in_one_read(self):
+        self.sender.sendall(frame(b'first') + frame(b'') + frame(b'third'))
+        protocol = ByteTransferProtocol(self.receiver)
+        self.assertEqual([bytes(protocol.receive_bytes()) for _ in range(3)], [b'first', b'', b'third'])
+
+    def test_frame_bigger_than_the_buffer(self):
+        payload = b'x' * (INITIAL_BUFFER_SIZE * 3 + 1)
+        thread = threading.Thread(target=lambda: self.sender.sendall(frame(payload) + frame(b'next')))
+        thread.start()
+        protocol = ByteTransferProtocol(self.receiver)
+        self.assertEqual(bytes(protocol.receive_bytes()), payload)
+        self.assertEqual(bytes(protocol.receive_bytes()), b'next')
+        thread.join()
+
+    def test_view_held_across_receives(self):
+        # The view points into the reused buffer, it must be copied to outlive the next receive.
+        self.sender.sendall(frame(b'first') + frame(b'other'))
+        protocol = ByteTransferProtocol(self.receiver)
+        held = protocol.receive_bytes()
+        copy = bytes(held)
+        protocol.receive_bytes()
+        self.assertEqual(bytes(held), b'other')
+        self.assertEqual(copy, b'first')
+
+    def test_messages_held_across_receives(self):
+        sender = MessageTransferProtocol(self.sender)
+        receiver = MessageTransferProtocol(self.receiver)
+        sender.send_message(MESSAGE_FLAG['BOOK'], CLIENT_ID, 1, 'first')
+        sender.send_message(MESSAGE_FLAG['REVIEW'], CLIENT_ID, 2, 'second')
+        first = receiver.receive_message()
+        second = receiver.receive_message()
+        self.assertEqual(first, (MESSAGE_FLAG['BOOK'], CLIENT_ID, 1, 'first'))
+        self.assertEqual(second, (MESSAGE_FLAG['REVIEW'], CLIENT_ID, 2, 'second'))
+
+
+class DecodeMessageTest(unittest.TestCase):
+    "Malformed frames must raise a ConnectionError, which the gateway handles by dropping the client."
+
+    def frame(self, message, compression=None):
+        header, body = encode_message(MESSAGE_FLAG['BOOK'], CLIENT_ID, 7, message, compression, threshold=0)
+        return header + body
+
+    def test_compressed_round_trip(self):
+        message = 'Title,authors\n' * 100
+        frame = self.frame(message, 'zlib')
+        self.assertTrue(frame[0] & COMPRESSED_FLAG)
+        self.assertEqual(decode_message(frame, 'zlib'), (MESSAGE_FLAG['BOOK'], CLIENT_ID, 7, message))
+
+    def test_compressed_without_negotiated_codec(self):
+        frame = self.frame('Title,authors\n' * 100, 'zlib')
+        with self.assertRaises(ProtocolError) as raised:
+            decode_message(frame)
+        self.assertIsInstance(raised.exception, ConnectionError)
+
+    def test_invalid_compressed_body(self):
+        frame = self.frame('Title,authors\n' * 100, 'zlib')
+        with self.assertRaises(ProtocolError):
+            decode_message(frame[:-4], 'zlib')
+
+    def test_short_frame(self):
+        with self.assertRaises(ProtocolError):
+            decode_message(b'\x01\x02')
+
+    def test_invalid_utf8(self):
+        header, _body = encode_message(MESSAGE_FLAG['REVIEW'], CLIENT_ID, 1, '')
+        with self.assertRaises(ProtocolError):
+            decode_message(header + b'\xff\xfe')
+
+
+if __name__ == '__main__':
+    unittest.main()
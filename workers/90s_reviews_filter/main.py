@@ -1,6 +1,9 @@
 import logging
+from bisect import bisect_left
 from pika.exchange_type import ExchangeType
 from lib.broker import MessageBroker
+from lib.schema import row_title_id, title_id_lists, title_ids
+from lib.sharding import SHARD_ID
 from lib.workers import DynamicFilter
 
 def update_state(old_state, message):
@@ -8,26 +11,36 @@ def update_state(old_state, message):
         # delete info that was required to process the request, which has been fulfilled
         old_state.pop(message['request_id'], None)
     else:
-        logging.warning(message['titles'][:5])
-        old_state[message['request_id']] = message['titles']
+        # Barriers older than title IDs send the titles.
+        ids = message['title_ids'] if 'title_ids' in message else sorted(set(title_ids(message['titles'])))
+        logging.warning(ids[:5])
+        old_state[message['request_id']] = ids
     return old_state
 
 def filter_condition(state, msg):
-    # if review is in the list of 90s titles
-    return msg['Title'] in state[msg['request_id']]
+    # if review is in the sorted list of 90s title IDs
+    title_ids = state[msg['request_id']]
+    review_title_id = row_title_id(msg)
+    position = bisect_left(title_ids, review_title_id)
+    return position < len(title_ids) and title_ids[position] == review_title_id
 
-def main():
+def build_worker(connection):
     # Pending: move variables to env.
-    shard_id = 0
-    rabbit_hostname = 'rabbitmq'
+    shard_id = SHARD_ID
     src_routing_key = f'90s_titles_shard{shard_id}'
     src_queue = src_routing_key
     src_exchange = '90s_titles_barrier_exchange'
     dst_routing_key = f'90s_rev_shard{shard_id}_queue'
     tmp_queues_prefix = f'90s_reviews_shard{shard_id}'
+    worker = DynamicFilter(update_state, filter_condition, tmp_queues_prefix, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_exchange_type=ExchangeType.fanout, src_routing_key=src_routing_key, dst_routing_key=dst_routing_key)
+    title_id_lists(worker.filter_state)
+    return worker
+
+def main():
+    rabbit_hostname = 'rabbitmq'
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     connection = MessageBroker(rabbit_hostname)
-    worker = DynamicFilter(update_state, filter_condition, tmp_queues_prefix, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_exchange_type=ExchangeType.fanout, src_routing_key=src_routing_key, dst_routing_key=dst_routing_key)
+    worker = build_worker(connection)
     worker.start()
 
 if __name__ == '__main__':
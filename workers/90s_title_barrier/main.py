@@ -2,33 +2,40 @@ import json
 import logging
 from pika.exchange_type import ExchangeType
 from lib.broker import MessageBroker
+from lib.schema import row_title_id, title_ids
+from lib.sharding import SHARD_ID
 from lib.workers import Aggregate
 
 def aggregate(msg, accumulator):
     accumulator[msg['request_id']] = accumulator.get(msg['request_id'], [])
-    accumulator[msg['request_id']].append(msg['Title'])
+    accumulator[msg['request_id']].append(row_title_id(msg))
 
 def result(msg, accumulator):
-    titles = accumulator.pop(msg['request_id'], [])
-    return json.dumps([{'request_id': msg['request_id'], 'titles': titles}])
+    # Sorted, so the reviews filters look them up with a binary search.
+    # Requests saved before title IDs hold titles.
+    ids = sorted(set(title_ids(accumulator.pop(msg['request_id'], []))))
+    return json.dumps([{'request_id': msg['request_id'], 'title_ids': ids}])
 
-def main():
+def build_worker(connection):
     """
     Receives the books published in the 90s for this specific shard and waits until the last one arrives, acting as a barrier.
     Once all 90s books for a request_id have arrived, sends them all in a single message to the next exchange.
     """
     # Pending: move variables to env.
-    shard_id = 0
-    rabbit_hostname = 'rabbitmq'
+    shard_id = SHARD_ID
     src_routing_key = f'90s_books_shard{shard_id}'
     src_queue = src_routing_key + '_queue'
     src_exchange = '90s_books_sharded_exchange'
     dst_exchange = '90s_titles_barrier_exchange'
     dst_routing_key = f'90s_titles_shard{shard_id}'
     accumulator = {}
+    return Aggregate(aggregate, result, accumulator, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_routing_key=src_routing_key, dst_exchange=dst_exchange, dst_exchange_type=ExchangeType.fanout, dst_routing_key=dst_routing_key)
+
+def main():
+    rabbit_hostname = 'rabbitmq'
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     connection = MessageBroker(rabbit_hostname)
-    worker = Aggregate(aggregate, result, accumulator, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_routing_key=src_routing_key, dst_exchange=dst_exchange, dst_exchange_type=ExchangeType.fanout, dst_routing_key=dst_routing_key)
+    worker = build_worker(connection)
     worker.start()
 
 if __name__ == '__main__':
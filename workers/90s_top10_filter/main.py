@@ -12,16 +12,19 @@ def result(msg, accumulator):
     request_titles = accumulator.pop(msg['request_id'], [])
     return json.dumps([{'request_id': msg['request_id'], 'top10': [book for book in nlargest(10, request_titles, key=lambda title: title['count'])]}])
 
-def main():
+def build_worker(connection):
     # Pending: move variables to env.
-    rabbit_hostname = 'rabbitmq'
     src_queue = 'popular_90s_queue'
     src_routing_key = 'popular_90s_queue'
     src_exchange='popular_90s_exchange'
     dst_routing_key = 'top_90s_books'
     accumulator = {}
+    return Aggregate(aggregate, result, accumulator, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_routing_key=src_routing_key, dst_routing_key=dst_routing_key)
+
+def main():
+    rabbit_hostname = 'rabbitmq'
     connection = MessageBroker(rabbit_hostname)
-    worker = Aggregate(aggregate, result, accumulator, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_routing_key=src_routing_key, dst_routing_key=dst_routing_key)
+    worker = build_worker(connection)
     worker.start()
 
 if __name__ == '__main__':
@@ -1,8 +1,12 @@
 import json
 import logging
 from lib.broker import MessageBroker
+from lib.sharding import SHARD_ID, Sharder
 from lib.workers import Aggregate
 
+sharder = Sharder()
+shard_id = SHARD_ID
+
 def aggregate(msg, accumulator):
     date = msg['publishedDate']
     if not date:
@@ -17,6 +21,9 @@ def aggregate(msg, accumulator):
     # ignore brackets
     authors = msg['authors'][1:-1]
     for author in authors.split(','):
+        if sharder.shard(author) != shard_id:
+            # Counted by the shard of that author, which gets this book too.
+            continue
         accumulator[msg['request_id']] = accumulator.get(msg['request_id'], {})
         accumulator[msg['request_id']][author] = accumulator[msg['request_id']].get(author, [])
         if decade not in accumulator[msg['request_id']][author]:
@@ -26,18 +33,20 @@ def result(msg, accumulator):
     authors = [author for author, decades in accumulator.pop(msg['request_id'], {}).items() if len(decades) >= 10]
     return json.dumps([{'request_id': msg['request_id'], 'authors': authors}])
 
-def main():
+def build_worker(connection):
     # Pending: move variables to env.
-    shard_id = 0
     accumulator = {}
-    rabbit_hostname = 'rabbitmq'
     src_routing_key = f'authors_shard{shard_id}'
     src_queue = src_routing_key + '_queue'
     src_exchange = 'authors_sharded_exchange'
     dst_routing_key = 'author_decades'
+    return Aggregate(aggregate, result, accumulator, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_routing_key=src_routing_key, dst_routing_key=dst_routing_key)
+
+def main():
+    rabbit_hostname = 'rabbitmq'
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     connection = MessageBroker(rabbit_hostname)
-    worker = Aggregate(aggregate, result, accumulator, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_routing_key=src_routing_key, dst_routing_key=dst_routing_key)
+    worker = build_worker(connection)
     worker.start()
 
 if __name__ == '__main__':
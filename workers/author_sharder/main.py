@@ -1,31 +1,34 @@
-import json
 import logging
 from pika.exchange_type import ExchangeType
 from lib.broker import MessageBroker
-from lib.workers import Router
-SHARD_COUNT = 1
+from lib.sharding import Sharder
+from lib.workers import Router, record_partition
 
-def routing_fn(body):
-    "Shard by title and route to request specific tmp queues"
-    msg = json.loads(body)
+sharder = Sharder()
+
+def routing_fn(msg):
+    "Shard by author and route to the shards of every author of the book"
     if msg.get('type') == 'EOF':
-        return [f"authors_shard{shard_id}" for shard_id in range(SHARD_COUNT)]
+        return [f"authors_shard{shard_id}" for shard_id in sharder.shards()]
     else:
-        shard_ids = set(hash(author) % SHARD_COUNT for author in msg['authors']) 
+        # Authors as author_decades_filter splits them, ignoring the brackets.
+        shard_ids = set(sharder.shard(author) for author in msg['authors'][1:-1].split(','))
         return [f"authors_shard{shard_id}" for shard_id in shard_ids]
 
-def main():
+def build_worker(connection):
     # Pending: move variables to env.
-    # Pending: update SHARD_COUNT variable to match the env.
-    rabbit_hostname = 'rabbitmq'
     src_queue = 'authors_book_queue'
     src_exchange = 'books_exchange'
     dst_exchange = 'authors_sharded_exchange'
     dst_routing_key = 'authors'
     control_queue_prefix = 'ctrl_author_sharder'
+    return Router(record_partition(routing_fn), control_queue_prefix, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_exchange_type=ExchangeType.fanout, dst_exchange=dst_exchange, dst_routing_key=dst_routing_key)
+
+def main():
+    rabbit_hostname = 'rabbitmq'
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     connection = MessageBroker(rabbit_hostname)
-    worker = Router(routing_fn, control_queue_prefix, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_exchange_type=ExchangeType.fanout, dst_exchange=dst_exchange, dst_routing_key=dst_routing_key)
+    worker = build_worker(connection)
     worker.start()
 
 if __name__ == '__main__':
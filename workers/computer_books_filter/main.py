@@ -1,30 +1,32 @@
-import json
 import logging
 from pika.exchange_type import ExchangeType
 from lib.broker import MessageBroker
-from lib.workers import Filter
+from lib.workers import Filter, column_mask
 
-def title_filter(body):
-    msg = json.loads(body)
-    date = msg['publishedDate']
+def title_filter(title, date, categories):
     if not date:
         return False
     try:
         year = int(date.split('-', maxsplit=1)[0])
-        return 2000 <= year <= 2023 and 'Computers' in msg['categories'] and 'distributed' in msg['Title']
+        return 2000 <= year <= 2023 and 'Computers' in categories and 'distributed' in title
     except:
         return False
 
-def main():
+filter_batch = column_mask(title_filter, 'Title', 'publishedDate', 'categories')
+
+def build_worker(connection):
     # Pending: move variables to env.
-    rabbit_hostname = 'rabbitmq'
     src_queue = 'computers_queue'
     src_exchange = 'books_exchange'
     dst_routing_key = 'computer_books'
     control_queue_prefix = 'ctrl_computer_books_filter'
+    return Filter(filter_batch, control_queue_prefix, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_exchange_type=ExchangeType.fanout, dst_routing_key=dst_routing_key)
+
+def main():
+    rabbit_hostname = 'rabbitmq'
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     connection = MessageBroker(rabbit_hostname)
-    worker = Filter(title_filter, control_queue_prefix, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_exchange_type=ExchangeType.fanout, dst_routing_key=dst_routing_key)
+    worker = build_worker(connection)
     worker.start()
 
 if __name__ == '__main__':
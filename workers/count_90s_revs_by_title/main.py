@@ -1,31 +1,45 @@
 import json
 import logging
 from lib.broker import MessageBroker
+from lib.schema import row_title_id, title_id_keys
+from lib.sharding import SHARD_ID
 from lib.workers import Aggregate
 
 BATCH_SIZE = 100
 
 def aggregate(msg, accumulator):
     accumulator[msg['request_id']] = accumulator.get(msg['request_id'], {})
-    accumulator[msg['request_id']][msg['Title']] = accumulator[msg['request_id']].get(msg['Title'], 0) + 1
+    # Counted by title ID, the title is kept as it arrived for the result.
+    review_title_id = row_title_id(msg)
+    count, title = accumulator[msg['request_id']].get(review_title_id, (0, msg['Title']))
+    accumulator[msg['request_id']][review_title_id] = (count + 1, title)
+
+def legacy_count(title, value):
+    "Counts saved before title IDs are keyed by the title and don't hold it."
+    return (value, title) if isinstance(value, int) else None
 
 def result(msg, accumulator):
     acc = accumulator.pop(msg['request_id'], {})
-    popular_books = [{'request_id': msg['request_id'], 'Title': title, 'count': count} for title, count in acc.items() if count >= 500]
-    items = [{'Title': title, 'count': count} for title, count in acc.items() if count >= 500]
+    popular_books = [{'request_id': msg['request_id'], 'Title': title, 'count': count} for count, title in acc.values() if count >= 500]
+    items = [{'Title': title, 'count': count} for count, title in acc.values() if count >= 500]
     return json.dumps([{'request_id': msg['request_id'], 'items': items[i:i+BATCH_SIZE]} for i in range(0, len(items), BATCH_SIZE)])
 
-def main():
+def build_worker(connection):
     # Pending: move variables to env.
-    shard_id = 0
-    rabbit_hostname = 'rabbitmq'
+    shard_id = SHARD_ID
     src_queue = f'90s_rev_shard{shard_id}_queue'
     dst_exchange = 'popular_90s_exchange'
     dst_routing_key = 'popular_90s_queue'
     accumulator = {}
+    worker = Aggregate(aggregate, result, accumulator, connection=connection, src_queue=src_queue, dst_exchange=dst_exchange, dst_routing_key=dst_routing_key)
+    title_id_keys(worker.accumulator, legacy_count)
+    return worker
+
+def main():
+    rabbit_hostname = 'rabbitmq'
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     connection = MessageBroker(rabbit_hostname)
-    worker = Aggregate(aggregate, result, accumulator, connection=connection, src_queue=src_queue, dst_exchange=dst_exchange, dst_routing_key=dst_routing_key)
+    worker = build_worker(connection)
     worker.start()
 
 if __name__ == '__main__':
@@ -2,37 +2,52 @@ import logging
 from collections import namedtuple
 from pika.exchange_type import ExchangeType
 from lib.broker import MessageBroker
-from lib.workers import DynamicAggregate
+from lib.schema import title_id_keys, title_id_values
+from lib.sharding import SHARD_ID
+from lib.workers import DynamicAggregate, batch_records, column_values
 
-AvgAccumulator = namedtuple('AvgAccumulator', ['sum', 'count'])
+AvgAccumulator = namedtuple('AvgAccumulator', ['sum', 'count', 'title'])
 BATCH_SIZE = 100
 
 def aggregate(message, accumulator):
     accumulator[message['request_id']] = accumulator.get(message['request_id'], {})
-    for item in message['items']:
-        old_values = accumulator[message['request_id']].get(item['Title'], AvgAccumulator(sum=0, count=0))
-        new_values = AvgAccumulator(sum=old_values.sum + item['score'], count=old_values.count + 1)
-        accumulator[message['request_id']][item['Title']] = new_values
+    # Averaged by title ID, the title is kept as it arrived for the result.
+    records = batch_records(message)
+    for title_id, title, score in zip(title_id_values(records), *column_values(records, 'Title', 'score')):
+        # Values loaded from the saved state are plain lists.
+        old_values = AvgAccumulator(*accumulator[message['request_id']].get(title_id, (0, 0, title)))
+        new_values = AvgAccumulator(sum=old_values.sum + score, count=old_values.count + 1, title=old_values.title)
+        accumulator[message['request_id']][title_id] = new_values
+
+def legacy_average(title, value):
+    "Sums and counts saved before title IDs are keyed by the title and don't hold it."
+    return (*value, title) if len(value) == 2 else None
 
 def result(msg, accumulator):
     acc = accumulator.pop(msg['request_id'], {})
-    logging.warning(f'Received {sum(values.count for values in acc.values())} reviews across {len(acc)} books.')
-    items = [{'Title': title, 'average': round(values.sum/values.count, 5)} for title, values in acc.items()]
+    values = [AvgAccumulator(*title_values) for title_values in acc.values()]
+    logging.warning(f'Received {sum(title_values.count for title_values in values)} reviews across {len(acc)} books.')
+    items = [{'Title': title_values.title, 'average': round(title_values.sum/title_values.count, 5)} for title_values in values]
     return [{'request_id': msg['request_id'], 'items': items[i:i+BATCH_SIZE]} for i in range(0, len(items), BATCH_SIZE)]
 
-def main():
+def build_worker(connection):
     # Pending: move variables to env.
-    rabbit_hostname = 'rabbitmq'
-    shard_id = 0
+    shard_id = SHARD_ID
     src_routing_key = f'nlp_revs_shard{shard_id}'
     src_queue = src_routing_key + '_queue'
     src_exchange = 'nlp_revs_exchange'
     dst_exchange = 'avg_nlp_exchange'
     tmp_queues = [('avg_nlp','avg_nlp')]
     accumulator = {}
+    worker = DynamicAggregate(aggregate, result, accumulator, tmp_queues=tmp_queues, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_routing_key=src_routing_key, dst_exchange=dst_exchange, dst_routing_key='avg_nlp', dst_exchange_type=ExchangeType.topic)
+    title_id_keys(worker.accumulator, legacy_average)
+    return worker
+
+def main():
+    rabbit_hostname = 'rabbitmq'
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     connection = MessageBroker(rabbit_hostname)
-    worker = DynamicAggregate(aggregate, result, accumulator, tmp_queues=tmp_queues, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_routing_key=src_routing_key, dst_exchange=dst_exchange, dst_routing_key='avg_nlp', dst_exchange_type=ExchangeType.topic)
+    worker = build_worker(connection)
     worker.start()
 
 if __name__ == '__main__':
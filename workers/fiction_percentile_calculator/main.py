@@ -67,18 +67,21 @@ def swap(buffer, i, j):
     buffer[i] = buffer[j]
     buffer[j] = tmp
 
-def main():
+def build_worker(connection):
     # Pending: move variables to env.
-    rabbit_hostname = 'rabbitmq'
     src_queue = 'avg_nlp_queue'
     src_exchange = 'avg_nlp_exchange'
     src_routing_key = '#'
     dst_exchange = 'nlp_percentile_exchange'
     dst_routing_key = 'nlp_percentile_queue'
     accumulator = {}
+    return Aggregate(aggregate, result, accumulator, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_routing_key=src_routing_key, src_exchange_type=ExchangeType.topic, dst_exchange=dst_exchange, dst_exchange_type=ExchangeType.fanout, dst_routing_key=dst_routing_key)
+
+def main():
+    rabbit_hostname = 'rabbitmq'
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     connection = MessageBroker(rabbit_hostname)
-    worker = Aggregate(aggregate, result, accumulator, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_routing_key=src_routing_key, src_exchange_type=ExchangeType.topic, dst_exchange=dst_exchange, dst_exchange_type=ExchangeType.fanout, dst_routing_key=dst_routing_key)
+    worker = build_worker(connection)
     worker.start()
 
 if __name__ == '__main__':
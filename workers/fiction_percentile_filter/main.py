@@ -15,17 +15,20 @@ def filter_condition(state, msg):
     # if Book's average review NLP is greater than the 10th percentile from state
     return msg['average'] >= state[msg['request_id']]
 
-def main():
+def build_worker(connection):
     # Pending: move variables to env.
-    rabbit_hostname = 'rabbitmq'
     src_exchange = 'nlp_percentile_exchange'
     src_queue = 'nlp_percentile'
     src_routing_key = src_queue
     dst_routing_key = 'top_fiction_books'
     tmp_queues_prefix = 'avg_nlp'
+    return DynamicFilter(update_state, filter_condition, tmp_queues_prefix, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_exchange_type=ExchangeType.fanout, src_routing_key=src_routing_key, dst_routing_key=dst_routing_key)
+
+def main():
+    rabbit_hostname = 'rabbitmq'
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     connection = MessageBroker(rabbit_hostname)
-    worker = DynamicFilter(update_state, filter_condition, tmp_queues_prefix, connection=connection, src_queue=src_queue, src_exchange=src_exchange, src_exchange_type=ExchangeType.fanout, src_routing_key=src_routing_key, dst_routing_key=dst_routing_key)
+    worker = build_worker(connection)
     worker.start()
 
 if __name__ == '__main__':
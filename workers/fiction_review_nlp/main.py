@@ -1,23 +1,28 @@
 import logging
 from lib.broker import MessageBroker
+from lib.schema import TITLE_ID, row_title_id
+from lib.sharding import SHARD_ID
 from lib.workers import Map
 from nltk.sentiment.vader import SentimentIntensityAnalyzer
 
 def sentiment(review):
     score = SentimentIntensityAnalyzer().polarity_scores(review['review/text'])['compound']
-    return {'Title': review['Title'], 'score': score}
+    return {TITLE_ID: row_title_id(review), 'Title': review['Title'], 'score': score}
 
-def main():
+def build_worker(connection):
     # Pending: move variables to env.
-    shard_id = 0
-    rabbit_hostname = 'rabbitmq'
+    shard_id = SHARD_ID
     src_queue = f'fiction_rev_shard{shard_id}_queue'
     dst_exchange = 'nlp_revs_exchange'
     dst_routing_key = f'nlp_revs_shard{shard_id}'
     control_queue_prefix = 'ctrl_fiction_review_nlp'
+    return Map(sentiment, control_queue_prefix, connection=connection, src_queue=src_queue, dst_exchange=dst_exchange, dst_routing_key=dst_routing_key)
+
+def main():
+    rabbit_hostname = 'rabbitmq'
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     connection = MessageBroker(rabbit_hostname)
-    worker = Map(sentiment, control_queue_prefix, connection=connection, src_queue=src_queue, dst_exchange=dst_exchange, dst_routing_key=dst_routing_key)
+    worker = build_worker(connection)
     worker.start()
 
 if __name__ == '__main__':